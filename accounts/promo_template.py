@@ -0,0 +1,79 @@
+""" Шаблон промо-рассылки.
+    Текст разбирается один раз, плейсхолдеры товаров {% product|id|поле %}
+    подставляются сразу для всей рассылки (один запрос на все товары).
+    Для каждого получателя остаются только {% username %}, {% balance %}
+    и {% oncepromo %}, поэтому render() - просто склейка строк.
+"""
+import os
+import re
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from product import models as models_shop
+
+
+PLACEHOLDER = re.compile(r'{% (.*?) %}')
+
+
+class PromoTemplate:
+
+    def __init__(self, text):
+        # четные элементы - текст, нечетные - содержимое плейсхолдеров
+        parts = PLACEHOLDER.split(text or '')
+        products = self.load_products(parts[1::2])
+        self.parts = []
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                self.add_text(part)
+                continue
+            args = part.split('|')
+            if args[0] == 'product':
+                self.add_text(self.product_value(products, args))
+            elif args[0] in ('username', 'balance', 'oncepromo'):
+                self.parts.append(args[0])
+        self.uses_promo = 'oncepromo' in self.parts
+
+    def add_text(self, text):
+        if self.parts and isinstance(self.parts[-1], list):
+            self.parts[-1][0] += text
+        else:
+            self.parts.append([text])
+
+    def load_products(self, placeholders):
+        ids = set()
+        for placeholder in placeholders:
+            args = placeholder.split('|')
+            if args[0] == 'product' and len(args) > 1 and args[1].isdigit():
+                ids.add(int(args[1]))
+        return models_shop.Product.objects.in_bulk(ids) if ids else {}
+
+    def product_value(self, products, args):
+        while len(args) <= 2:
+            args.append('')
+        product = products.get(int(args[1])) if args[1].isdigit() else None
+        if product is None:
+            return ''
+        if args[2] == 'name':
+            return product.title
+        elif args[2] == 'oldprice':
+            return str(product.old_price)
+        elif args[2] == 'price':
+            return str(product.price)
+        elif args[2] == 'link':
+            return f'{os.environ.get("LINK_SITE")}{product.get_absolute_url()}'
+        return ''
+
+    def render(self, user, promo=None):
+        """ promo - персональный промокод для {% oncepromo %} """
+        result = []
+        for part in self.parts:
+            if isinstance(part, list):
+                result.append(part[0])
+            elif part == 'username':
+                result.append(user.username or user.email or '')
+            elif part == 'balance':
+                result.append(str(round(user.balance, 2)))
+            elif part == 'oncepromo':
+                result.append(promo or '')
+        return ''.join(result)
@@ -6,9 +6,8 @@ from dotenv import load_dotenv
 load_dotenv()
 import os
 import re
-
-
-TG_TOKEN = os.environ.get('TG_TOKEN')
+from accounts import telegram
+from accounts.promo_template import PromoTemplate
 
 
 def geo_ip_info(ip_address):
@@ -28,9 +27,7 @@ def subscribe_answer_support(id_user, text_answer):
         return False
     
     message = f'Вы получили ответ на ваше обращение: \n\n{text_answer}'
-    id_tg = user.user.id_tg
-    link = f'https://api.telegram.org/bot{TG_TOKEN}/sendMessage?chat_id={id_tg}&parse_mode=HTML&text={message[:200]}'
-    req = requests.get(link)
+    return telegram.send_message(user.user.id_tg, message)
 
 
 def subscribe_create_order(id_user, id_order, url_order):
@@ -40,11 +37,7 @@ def subscribe_create_order(id_user, id_order, url_order):
         return False
     
     message = f'Вы оформили заказ с ID {id_order}\nСсылка на заказ: {os.environ.get("LINK_SITE")}{url_order}'
-    id_tg = user.user.id_tg
-    link = f'https://api.telegram.org/bot{TG_TOKEN}/sendMessage?chat_id={id_tg}&parse_mode=HTML&text={message}'
-    req = requests.get(link)
-    print(link)
-    print(req.text)
+    return telegram.send_message(user.user.id_tg, message)
 
 
 def subscribe_authorization(id_user, session_key, ip):
@@ -56,80 +49,25 @@ def subscribe_authorization(id_user, session_key, ip):
     ip_info = geo_ip_info(ip)
     str_ip_info = '/'.join(ip_info.values())
     message = f'В ваш аккаунт был выполнен вход с IP-адреса {ip} ({str_ip_info})\nЕсли это были не вы - нажмите кнопку ниже.'
-    id_tg = user.user.id_tg
-    link = f'https://api.telegram.org/bot{TG_TOKEN}/sendMessage?chat_id={id_tg}&parse_mode=HTML&text={message}&reply_markup={{"inline_keyboard":[[{{"text":"Закрыть сеанс","callback_data":"type_action:close_session:{session_key}"}}]]}}'
-    req = requests.get(link)
-
-
-def promo_replace_username(user = None):
-    if user.username:
-        return user.username
-    else:
-        return user.email
-
-
-def promo_replace_oncepromo():
-    promo = models_shop.Promocode.generate_new_promocode()
-    if promo:
-        return promo[0]
-    return None
-
-
-def promo_replace_balance(user = None):
-    return str(round(user.balance, 2))
-
-
-def promo_replace_product(element):
-    lst = element.split('|')
-    while len(lst) <= 2:
-        lst.append('')
-    product = {'id':lst[1], 'type':lst[2]}
-    try:
-        product_info = models_shop.Product.objects.get(pk = product['id'])
-        if product['type'] == 'name':
-            return product_info.title
-        elif product['type'] == 'oldprice':
-            return str(product_info.old_price)
-        elif product['type'] == 'price':
-            return str(product_info.price)
-        elif product['type'] == 'link':
-            return f'{os.environ.get("LINK_SITE")}{product_info.get_absolute_url()}'
-    except models_shop.Product.DoesNotExist:
-        return None
+    reply_markup = {'inline_keyboard': [[{'text': 'Закрыть сеанс', 'callback_data': f'type_action:close_session:{session_key}'}]]}
+    return telegram.send_message(user.user.id_tg, message, reply_markup)
 
 
 def replace_text(text, user = None):
-    origin_text = text
-    r = re.findall(r'(\{\% .*? \%\})', origin_text)
-    for i in r:
-        el = re.search(r'{% (.*?) %}', i)
-        if el:
-            element = el.group(1)
-            name_element = element.split('|')[0]
-            if name_element == 'username':
-                repl = promo_replace_username(user = user)
-            elif name_element == 'oncepromo':
-                repl = promo_replace_oncepromo()  
-            elif name_element == 'product':
-                repl = promo_replace_product(element)
-            elif name_element == 'balance':
-                repl = promo_replace_balance(user = user)
-            if not repl:
-                repl = ''
-            origin_text = origin_text.replace(i, repl)
-            
-    return origin_text
+    template = PromoTemplate(text)
+    promo = models_shop.Promocode.generate_new_promocode()[0] if template.uses_promo else None
+    return template.render(user, promo)
 
 
 def subscribe_promo(text_msg):
-    users = Subscribe.objects.filter(is_promo = True)
-    for user in users:
-        id_tg = user.user.id_tg
-        message = replace_text(text_msg, user = user.user)
-        
-        link = f'https://api.telegram.org/bot{TG_TOKEN}/sendMessage?chat_id={id_tg}&parse_mode=HTML&text={message[:200]}'
-        req = requests.get(link)
-        print(req.json())
+    users = [sub.user for sub in Subscribe.objects.filter(is_promo = True).select_related('user')]
+    template = PromoTemplate(text_msg)
+    promos = models_shop.Promocode.generate_new_promocode(cnt = len(users)) if template.uses_promo and users else [None] * len(users)
+    messages = [
+        (user.id_tg, telegram.message(template.render(user, promo)))
+        for user, promo in zip(users, promos)
+    ]
+    return telegram.send_messages(messages)
     
     
 def subscribe_get_file_in_order(id_order):
@@ -148,7 +86,7 @@ def subscribe_get_file_in_order(id_order):
         if product.type_product == 'file':
             token_file = product.filetelegram_set.all()
             file_id = ''
-            link = f'https://api.telegram.org/bot{TG_TOKEN}/sendDocument?chat_id={user.user.id_tg}&parse_mode=HTML'
+            link = f'{telegram.api_url("sendDocument")}?chat_id={user.user.id_tg}&parse_mode=HTML'
             if token_file:
                 file_id = token_file.first().id_file
                 files = {'document':file_id}
@@ -166,17 +104,21 @@ def subscribe_get_file_in_order(id_order):
 
 
 def subscribe_edit_price(lst, name, new_price):
-    message = f'Изменилась цена на товар {name}\nНовая цена - {new_price}'
-    for id_tg in lst:
-        link = f'https://api.telegram.org/bot{TG_TOKEN}/sendMessage?chat_id={id_tg}&parse_mode=HTML&text={message[:200]}'
-        req = requests.get(link)
+    return subscribe_edit_price_batch([[lst, name, new_price]])
+
+
+def subscribe_edit_price_batch(items):
+    """ items - список [список id_tg подписчиков, название, новая цена] """
+    messages = []
+    for lst, name, new_price in items:
+        payload = telegram.message(f'Изменилась цена на товар {name}\nНовая цена - {new_price}')
+        messages += [(id_tg, payload) for id_tg in lst]
+    return telegram.send_messages(messages)
 
 
 def subscribe_active_product(lst, product_name, price, items):
-    message = f'Товар "{product_name}" снова в наличии! Успей купить по цене {price}'
-    for id_tg in lst:
-        link = f'https://api.telegram.org/bot{TG_TOKEN}/sendMessage?chat_id={id_tg}&parse_mode=HTML&text={message[:200]}'
-        req = requests.get(link)
-        print(req.json())
+    payload = telegram.message(f'Товар "{product_name}" снова в наличии! Успей купить по цене {price}')
+    result = telegram.send_messages([(id_tg, payload) for id_tg in lst])
     all_items = models_shop.SubActivateProduct.objects.filter(pk__in = items)
-    all_items.delete()
\ No newline at end of file
+    all_items.delete()
+    return result
\ No newline at end of file
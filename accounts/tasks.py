@@ -9,7 +9,7 @@ def send_authorizations(id_user, session_key, ip):
 
 @app.task
 def send_promo(msg_text):
-    subscribe.subscribe_promo(msg_text)
+    return subscribe.subscribe_promo(msg_text)
 
 
 @app.task
@@ -22,6 +22,11 @@ def send_edit_price(lst, title, price):
     subscribe.subscribe_edit_price(lst, title, price)
 
 
+@app.task
+def send_edit_price_batch(items):
+    return subscribe.subscribe_edit_price_batch(items)
+
+
 @app.task
 def send_activate_product(lst, title, price, items):
     subscribe.subscribe_active_product(lst, title, price, items)
@@ -0,0 +1,98 @@
+""" Рассылка сообщений через Telegram Bot API.
+    Сообщения отправляются параллельно (TG_CONCURRENCY потоков с общим пулом
+    соединений), частота ограничена TG_RATE сообщений в секунду на всех
+    воркерах вместе (счетчик в общем кэше). На ответ 429 запрос повторяется
+    через retry_after секунд из ответа, пауза действует для всех воркеров.
+    Для каждого сообщения возвращается результат отправки.
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from dotenv import load_dotenv
+load_dotenv()
+
+from shop.throttling import SharedRateLimiter
+
+
+logger = logging.getLogger(__name__)
+
+TG_TOKEN = os.environ.get('TG_TOKEN')
+MESSAGE_MAX_LENGTH = 4096
+
+bucket = SharedRateLimiter('telegram', settings.TG_RATE)
+
+
+def api_url(method):
+    return f'{settings.TG_API_URL}/bot{TG_TOKEN}/{method}'
+
+
+def message(text, reply_markup=None):
+    """ payload для sendMessage """
+    payload = {'text': text[:MESSAGE_MAX_LENGTH], 'parse_mode': 'HTML'}
+    if reply_markup:
+        payload['reply_markup'] = json.dumps(reply_markup)
+    return payload
+
+
+class Dispatcher:
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or settings.TG_CONCURRENCY
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, method, chat_id, payload):
+        outcome = {'chat_id': chat_id, 'ok': False, 'attempts': 0, 'error': None}
+        while outcome['attempts'] <= settings.TG_MAX_RETRIES:
+            outcome['attempts'] += 1
+            bucket.acquire()
+            try:
+                req = self.session.post(
+                    api_url(method), data=dict(payload, chat_id=chat_id), timeout=settings.TG_TIMEOUT)
+                result = req.json()
+            except (requests.RequestException, ValueError) as error:
+                outcome['error'] = str(error)
+                time.sleep(outcome['attempts'])
+                continue
+            if result.get('ok'):
+                outcome['ok'] = True
+                outcome['error'] = None
+                return outcome
+            outcome['error'] = result.get('description', req.status_code)
+            if req.status_code != 429:
+                return outcome
+            # лимит общий для бота, поэтому пауза для всех потоков и процессов
+            bucket.delay(result.get('parameters', {}).get('retry_after', 1))
+        return outcome
+
+    def send(self, messages, method='sendMessage'):
+        """ messages - список (chat_id, payload). Возвращает результаты в том же порядке """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            outcomes = list(executor.map(lambda item: self.post(method, *item), messages))
+        self.session.close()
+        return outcomes
+
+
+def send_messages(messages, method='sendMessage'):
+    """ отправить сообщения и вернуть сводку: сколько отправлено и какие не ушли """
+    messages = [(chat_id, payload) for chat_id, payload in messages if chat_id]
+    if not messages:
+        return {'sent': 0, 'failed': []}
+    outcomes = Dispatcher().send(messages, method)
+    failed = [outcome for outcome in outcomes if not outcome['ok']]
+    if failed:
+        logger.warning('Telegram: %s of %s messages failed, first error: %s',
+            len(failed), len(outcomes), failed[0]['error'])
+    return {'sent': len(outcomes) - len(failed), 'failed': failed}
+
+
+def send_message(chat_id, text, reply_markup=None):
+    return send_messages([(chat_id, message(text, reply_markup))])
@@ -1,3 +1,94 @@
-from django.test import TestCase
+from urllib.parse import parse_qs
+import time
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from accounts import telegram
+from accounts.models import CustomUser
+from accounts.promo_template import PromoTemplate
+from shop.throttling import SharedRateLimiter
+from product.models import Product
+from product.tests import FakeServer
+
+
+class TelegramDispatchTest(SimpleTestCase):
+    """ рассылка через локальный сервер вместо Bot API """
+
+    def handler(self, method, path, body):
+        chat_id = parse_qs(body.decode())['chat_id'][0]
+        self.calls.append(chat_id)
+        if chat_id == '403':
+            return 403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+        if chat_id == '429' and self.calls.count(chat_id) == 1:
+            return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}}
+        return 200, {'ok': True, 'result': {'message_id': len(self.calls)}}
+
+    def setUp(self):
+        self.calls = []
+        self.api = FakeServer(self.handler).__enter__()
+        self.addCleanup(self.api.__exit__)
+        override = override_settings(TG_API_URL=self.api.url)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_outcomes(self):
+        messages = [(chat_id, telegram.message('Новый товар')) for chat_id in (1, 403, 2)]
+        outcomes = telegram.Dispatcher(concurrency=2).send(messages)
+        self.assertEqual([(item['chat_id'], item['ok'], item['attempts']) for item in outcomes],
+            [(1, True, 1), (403, False, 1), (2, True, 1)])
+        self.assertIn('blocked', outcomes[1]['error'])
+        self.assertTrue(all(path.endswith('/sendMessage') for method, path, body in self.api.requests))
+
+    def test_retry_after(self):
+        started = time.monotonic()
+        outcome = telegram.Dispatcher(concurrency=1).post('sendMessage', 429, telegram.message('текст'))
+        self.assertEqual((outcome['ok'], outcome['attempts'], outcome['error']), (True, 2, None))
+        self.assertGreaterEqual(time.monotonic() - started, 0.9)
+
+    def test_send_messages_summary(self):
+        messages = [(chat_id, telegram.message('текст')) for chat_id in (1, None, 403, 429, 2)]
+        with self.assertLogs('accounts.telegram', 'WARNING'):
+            summary = telegram.send_messages(messages)
+        self.assertEqual(summary['sent'], 3)
+        self.assertEqual([item['chat_id'] for item in summary['failed']], [403])
+        self.assertEqual(sorted(set(self.calls)), ['1', '2', '403', '429'])
+
+
+    def test_rate_is_shared_between_processes(self):
+        """ два ограничителя с одним именем - как в двух воркерах """
+        workers = [SharedRateLimiter('test-shared', 20), SharedRateLimiter('test-shared', 20)]
+        started = time.monotonic()
+        for i in range(20):
+            workers[i % 2].acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.8)
+        workers[0].delay(0.5)
+        started = time.monotonic()
+        workers[1].acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.4)
+
+
+class PromoTemplateTest(TestCase):
+    """ шаблон разбирается один раз, товары - одним запросом на рассылку """
+
+    def setUp(self):
+        self.products = [Product.objects.create(title=f'Товар {i}', price=100 + i, old_price=200) for i in range(3)]
+        self.user = CustomUser(email='user@example.com', username='Иван', balance=12.345)
+
+    def test_one_query_per_mailing(self):
+        text = ''.join(f'{{% product|{product.pk}|name %}} {{% product|{product.pk}|price %}}; '
+            for product in self.products) + '{% product|999999|name %}{% username %}'
+        with self.assertNumQueries(1):
+            template = PromoTemplate(text)
+        with self.assertNumQueries(0):
+            rendered = template.render(self.user)
+        self.assertEqual(rendered, 'Товар 0 100.0; Товар 1 101.0; Товар 2 102.0; Иван')
+
+    def test_render(self):
+        product = self.products[0]
+        template = PromoTemplate(f'{{% username %}}, {{% balance %}}: {{% product|{product.pk}|oldprice %}} '
+            f'{{% product|{product.pk}|unknown %}}{{% oncepromo %}} {{% other %}}')
+        self.assertTrue(template.uses_promo)
+        self.assertEqual(template.render(self.user, 'CODE'), 'Иван, 12.35: 200.0 CODE ')
+        self.assertEqual(PromoTemplate('{% username %}').render(CustomUser(email='a@example.com')), 'a@example.com')
+        self.assertFalse(PromoTemplate('Без промокода').uses_promo)
@@ -1,3 +1,43 @@
-from django.test import TestCase
+from importlib import import_module
 
-# Create your tests here.
+from django.conf import settings
+from django.test import Client, TestCase, override_settings
+from rest_framework.test import APIClient
+
+from accounts.models import CustomUser
+
+
+class CloseSessionTest(TestCase):
+    """ закрытие сеанса работает с любым движком сессий """
+
+    def setUp(self):
+        self.user = CustomUser.objects.create(email='owner@example.com')
+        self.api = APIClient()
+        self.api.force_authenticate(self.user)
+
+    def open_session(self, user):
+        browser = Client()
+        browser.force_login(user)
+        return browser.session.session_key
+
+    def close(self, session_key):
+        return self.api.delete('/api/close_session/', {'session_key': session_key}).json()
+
+    def check_engine(self):
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        session_key = self.open_session(self.user)
+        other_key = self.open_session(CustomUser.objects.create(email='other@example.com'))
+        self.assertEqual(self.close(other_key), {'error': 'user unautentificated'})
+        self.assertTrue(store().exists(other_key))
+        self.assertEqual(self.close(session_key), {'success': 'session close'})
+        self.assertFalse(store().exists(session_key))
+        self.assertEqual(self.close(session_key), {'error': 'session key not found'})
+        self.assertEqual(self.close(''), {'error': 'session key not found'})
+
+    def test_db_sessions(self):
+        with override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db'):
+            self.check_engine()
+
+    def test_cache_sessions(self):
+        with override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cache'):
+            self.check_engine()
@@ -18,9 +18,12 @@ from api import serializers
 from rest_framework import permissions, viewsets, generics, pagination
 from accounts.models import CustomUser
 from product.models import *
-from django.contrib.sessions.models import Session
-from product import services
+from importlib import import_module
+from django.conf import settings
+from product import services, search
 from django_filters import rest_framework as drf_filters
+from rest_framework.exceptions import NotFound
+from product.pagination import KeysetPaginator, InvalidCursor
 
 
 @api_view(['POST'])
@@ -45,17 +48,17 @@ def connect_tg(request, format=None):
 @api_view(['DELETE'])
 @permission_classes([permissions.IsAuthenticated, ])
 def close_session(request, format=None):
+    """ закрытие сеанса пользователя; через SessionStore, чтобы работать с любым SESSION_ENGINE """
     session_key = request.POST.get('session_key')
     content = {}
-    try: 
-        user_session = Session.objects.get(session_key = session_key)
-        user_session_info = user_session.get_decoded()
-        if str(request.user.id) == user_session_info.get('_auth_user_id'):
-            user_session.delete()
+    store = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    if session_key and store.exists(session_key):
+        if str(request.user.id) == store.load().get('_auth_user_id'):
+            store.delete(session_key)
             content['success'] = 'session close'
         else:
             content['error'] = 'user unautentificated'
-    except Session.DoesNotExist:
+    else:
         content['error'] = 'session key not found'
     
     return Response(content)
@@ -317,12 +320,47 @@ class ProductAPI(APIView):
         return Response(context)
 
 class DefaultPagination(pagination.PageNumberPagination):
+    """ ?page=N - постранично, ?count=0 - без подсчета COUNT(*),
+    ?cursor=<токен>&ordering=id|date_add - keyset пагинация, токен следующей
+    страницы возвращается в заголовке X-Next-Cursor. """
     page_size = 50
     page_size_query_param = 'page_size'
     max_page_size = 1000
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    cursor_orderings = {
+        'id': ('id',),
+        'date_add': ('-date_add', '-id'),
+    }
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.next_cursor = None
+        page_size = self.get_page_size(request)
+        if self.cursor_query_param in request.query_params:
+            ordering = self.cursor_orderings.get(request.query_params.get('ordering', 'id'))
+            if not ordering:
+                raise NotFound('Invalid ordering')
+            paginator = KeysetPaginator(queryset, ordering, page_size)
+            try:
+                page = paginator.page(request.query_params.get(self.cursor_query_param))
+            except InvalidCursor:
+                raise NotFound('Invalid cursor')
+            self.next_cursor = page.next_cursor
+            return page.object_list
+        if request.query_params.get(self.count_query_param) in ('0', 'false'):
+            try:
+                page_number = max(int(request.query_params.get(self.page_query_param, 1)), 1)
+            except ValueError:
+                page_number = 1
+            offset = (page_number - 1) * page_size
+            return list(queryset[offset:offset + page_size])
+        return super().paginate_queryset(queryset, request, view)
     
     def get_paginated_response(self, data):
-        return Response(data)
+        response = Response(data)
+        if self.next_cursor:
+            response['X-Next-Cursor'] = self.next_cursor
+        return response
 
 
 class CharFilterDef(drf_filters.BaseInFilter, drf_filters.CharFilter):
@@ -333,23 +371,36 @@ class ProductFilter(drf_filters.FilterSet):
     price = drf_filters.RangeFilter()
     rating = drf_filters.RangeFilter()
     title = CharFilterDef(field_name = 'title', lookup_expr='in')
-    in_title = drf_filters.CharFilter(field_name = 'title', lookup_expr='contains')
-    in_desc = drf_filters.CharFilter(field_name = 'desc', lookup_expr='contains')
+    in_title = drf_filters.CharFilter(method = 'filter_full_text')
+    in_desc = drf_filters.CharFilter(method = 'filter_full_text')
     category = drf_filters.BaseInFilter(field_name = 'cid__pk', lookup_expr='in')
 
     class Meta:
         model = Product
         fields = ['price', 'rating', 'title', 'in_title', 'in_desc', 'category',]
 
+    def filter_full_text(self, queryset, name, value):
+        field = 'title' if name == 'in_title' else 'desc'
+        return search.search_products(queryset, value, fields=[field])
+
+
+class ProductSearchFilter(filters.BaseFilterBackend):
+    """ поиск по полнотекстовому индексу, результаты отсортированы по релевантности """
+    search_param = 'search'
+
+    def filter_queryset(self, request, queryset, view):
+        text = request.query_params.get(self.search_param)
+        if not text:
+            return queryset
+        return search.search_products(queryset, text)
+
 
 class ProductListAPI(generics.ListAPIView):
     serializer_class = serializers.ProductSerializer
-    filter_backends = (drf_filters.DjangoFilterBackend, filters.SearchFilter,)
+    filter_backends = (drf_filters.DjangoFilterBackend, ProductSearchFilter,)
     filterset_class = ProductFilter
     filter_fields = ['price',]
     pagination_class = DefaultPagination
 
-    search_fields = ['title','desc',]
-
     def get_queryset(self):
         return Product.objects.filter().order_by('id')
\ No newline at end of file
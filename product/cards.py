@@ -0,0 +1,45 @@
+""" Краткая информация о товарах (карточки) в общем кэше.
+    Нужна для данных, которые в сессии хранятся только id: просмотренные
+    товары и корзина анонимного пользователя. Промахи загружаются одним
+    запросом, запись сбрасывается при сохранении/удалении товара, а также
+    после массовых изменений (update_with_events, bulk_update_with_events,
+    RatingProduct.change_counters).
+"""
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+
+
+CARD_FIELDS = ('id', 'title', 'type_product', 'price', 'desc')
+
+
+def cache_key(product_id):
+    return f'product_card:{product_id}'
+
+
+def get_cards(product_ids):
+    """ {id товара: карточка} для существующих товаров из product_ids """
+    product_ids = [int(product_id) for product_id in product_ids]
+    cached = cache.get_many([cache_key(product_id) for product_id in product_ids])
+    cards = {}
+    missing = []
+    for product_id in product_ids:
+        card = cached.get(cache_key(product_id))
+        if card is None:
+            missing.append(product_id)
+        else:
+            cards[product_id] = card
+    if missing:
+        Product = apps.get_model('product', 'Product')
+        loaded = {card['id']: card for card in Product.objects.filter(id__in=missing).values(*CARD_FIELDS)}
+        cache.set_many({cache_key(product_id): card for product_id, card in loaded.items()}, settings.PRODUCT_CARD_TTL)
+        cards.update(loaded)
+    return cards
+
+
+def invalidate(product_id):
+    cache.delete(cache_key(product_id))
+
+
+def invalidate_many(product_ids):
+    cache.delete_many([cache_key(product_id) for product_id in product_ids])
@@ -0,0 +1,141 @@
+""" Отслеживание изменений товара и побочные эффекты этих изменений.
+    Старые значения отслеживаемых полей берутся из строки, прочитанной из базы
+    (Product.from_db хранит ссылку на нее), и сравниваются только при сохранении.
+    Поля, не прочитанные вместе с товаром (.only()/.defer()), перед сравнением
+    дочитываются одним запросом (Product.add_unloaded_values).
+    События с внешними побочными эффектами пишутся в таблицу ProductEvent (outbox)
+    в той же транзакции, что и изменение товара, поэтому откат не оставляет событий,
+    а сохранение товара не зависит от брокера. Задача relay_product_events
+    периодически забирает события пачками и отправляет их в Celery:
+        edit_price - изменилась цена активного товара (уведомление подписчикам);
+        active_product - товар снова появился в наличии (уведомление подписчикам).
+    Несколько изменений одного товара, пришедшие в пределах OUTBOX_DEDUPE_WINDOW
+    секунд, отправляются одним событием с последними значениями.
+    file_changed (заменен файл товара) в outbox не попадает: id файла в Telegram
+    удаляются сразу в транзакции сохранения, иначе до отправки события
+    покупатель получил бы старый файл.
+"""
+from collections import defaultdict
+import datetime
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from accounts import tasks as acc_tasks
+
+
+TRACKED_FIELDS = ('price', 'stock', 'is_active', 'file_digit')
+OUTBOX_EVENTS = ('edit_price', 'active_product')
+STATS_KEY = 'product_events:relay'
+
+
+def file_name(value):
+    return getattr(value, 'name', value) or None
+
+
+def detect(old, new):
+    """ old, new - {поле: значение} до и после изменения; множество событий.
+    Поля, которых нет в old (например, отложенные), не сравниваются """
+    events = set()
+    if 'price' in old and old['price'] != new['price'] and old.get('is_active') and new.get('is_active'):
+        events.add('edit_price')
+    if old.get('stock') == 0 and (new.get('stock') or 0) > 0 and new.get('is_active'):
+        events.add('active_product')
+    if 'file_digit' in old and file_name(old['file_digit']) != file_name(new['file_digit']):
+        events.add('file_changed')
+    return events
+
+
+def record(rows):
+    """ rows - [(id товара, название, цена, события)]; запись событий в outbox
+    одним INSERT, file_changed - удаление id файлов в Telegram. Вызывать в
+    транзакции, в которой меняется товар """
+    ProductEvent = apps.get_model('product', 'ProductEvent')
+    FileTelegram = apps.get_model('product', 'FileTelegram')
+    changed_files = [product_id for product_id, title, price, events in rows if 'file_changed' in events]
+    if changed_files:
+        FileTelegram.objects.filter(product_id__in = changed_files).delete()
+    ProductEvent.objects.bulk_create([
+        ProductEvent(product_id = product_id, type_event = event, title = title, price = price)
+        for product_id, title, price, events in rows for event in sorted(events) if event in OUTBOX_EVENTS
+    ])
+
+
+def relay(batch_size = None):
+    """ отправка готовых событий из outbox. Событие готово, если оно старше
+    OUTBOX_DEDUPE_WINDOW секунд; вместе с ним забираются и более новые события
+    того же товара и типа, отправляются последние значения """
+    ProductEvent = apps.get_model('product', 'ProductEvent')
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    stats = {'sent': 0, 'deduped': 0, 'max_lag': 0}
+    started = time.monotonic()
+    while True:
+        now = timezone.now()
+        cutoff = now - datetime.timedelta(seconds = settings.OUTBOX_DEDUPE_WINDOW)
+        with transaction.atomic():
+            ready = list(ProductEvent.objects.select_for_update(skip_locked = True).filter(
+                date_create__lte = cutoff).order_by('id').values_list('product_id', flat = True)[:batch_size])
+            if not ready:
+                break
+            rows = list(ProductEvent.objects.select_for_update(skip_locked = True).filter(
+                product_id__in = set(ready)).order_by('id').values_list(
+                'id', 'product_id', 'type_event', 'title', 'price', 'date_create'))
+            events = defaultdict(dict)
+            first = {}
+            for id, product_id, type_event, title, price, date_create in rows:
+                events[type_event][product_id] = (title, price)
+                first.setdefault((type_event, product_id), date_create)
+            ProductEvent.objects.filter(id__in = [row[0] for row in rows]).delete()
+            dispatch(events)
+        stats['sent'] += len(first)
+        stats['deduped'] += len(rows) - len(first)
+        stats['max_lag'] = max([stats['max_lag']] + [(now - date).total_seconds() for date in first.values()])
+    stats['duration'] = round(time.monotonic() - started, 3)
+    stats['date'] = timezone.now().isoformat()
+    cache.set(STATS_KEY, stats, None)
+    return stats
+
+
+def metrics():
+    """ размер очереди, возраст самого старого события (сек.) и итоги последнего запуска relay """
+    ProductEvent = apps.get_model('product', 'ProductEvent')
+    pending = ProductEvent.objects.aggregate(oldest = Min('date_create'))
+    oldest = pending['oldest']
+    return {
+        'pending': ProductEvent.objects.count(),
+        'oldest_age': (timezone.now() - oldest).total_seconds() if oldest else 0,
+        'last_relay': cache.get(STATS_KEY),
+    }
+
+
+def dispatch(events):
+    """ обработка событий пакета: по одному запросу на тип события """
+    SubEditPrice = apps.get_model('product', 'SubEditPrice')
+    SubActivateProduct = apps.get_model('product', 'SubActivateProduct')
+
+    edit_price = events.get('edit_price')
+    if edit_price:
+        subscribers = defaultdict(list)
+        for product_id, id_tg in SubEditPrice.objects.filter(
+                product_id__in = edit_price).values_list('product_id', 'user__id_tg'):
+            subscribers[product_id].append(id_tg)
+        notifications = [[lst, edit_price[product_id][0], edit_price[product_id][1]]
+            for product_id, lst in subscribers.items()]
+        if notifications:
+            acc_tasks.send_edit_price_batch.delay(notifications)
+
+    active_product = events.get('active_product')
+    if active_product:
+        subscribers = defaultdict(lambda: ([], []))
+        for pk, product_id, id_tg in SubActivateProduct.objects.filter(
+                product_id__in = active_product).values_list('pk', 'product_id', 'user__id_tg'):
+            subscribers[product_id][0].append(id_tg)
+            subscribers[product_id][1].append(pk)
+        for product_id, (lst, items) in subscribers.items():
+            title, price = active_product[product_id]
+            acc_tasks.send_activate_product.delay(lst, title, price, items)
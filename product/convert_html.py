@@ -1,7 +1,6 @@
 def viewed_products(data):
-    data = dict(reversed(list(data.items())))
     responce_html = ''
-    for i in data.values():
+    for i in data:
         responce_html += (
             f'<div class="card" style="width: 18rem;">'
             f'<div class="card-body">'
@@ -43,6 +42,16 @@ def pagination(item, func='spage'):
     return html_result
 
 
+def cursor_pagination(page, func='cpage'):
+    html_result = ''
+    html_result += '<span class="step-links">'
+    html_result += f'<a href="#" onclick="{func}(\'\')">First</a> '
+    if page.has_next():
+        html_result += f'<a href="#" onclick="{func}(\'{page.next_cursor}\')">Next</a>'
+    html_result += '</span>'
+    return html_result
+
+
 def my_wishlist(data):
     responce_html = ''
     for item in data:
@@ -66,9 +75,9 @@ def recommend_products(data):
         responce_html += (
             f'<div class="card" style="width: 18rem;">'
             f'<div class="card-body">'
-            f'<h5 class="card-title">{i.title}</h5>'
-            f'<p class="card-text">{i.desc}</p>'
-            f'<a href="/shop/product/{i.id}" class="btn btn-primary">open page</a></div></div>'
+            f'<h5 class="card-title">{i["title"]}</h5>'
+            f'<p class="card-text">{i["desc"]}</p>'
+            f'<a href="/shop/product/{i["id"]}" class="btn btn-primary">open page</a></div></div>'
         )
     return responce_html
 
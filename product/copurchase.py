@@ -0,0 +1,88 @@
+""" Матрица совместных покупок товаров.
+    Позиции оплаченных заказов читаются одним потоковым проходом в массивы
+    numpy, дальше считается разреженная матрица заказ x товар:
+        B[заказ, товар] - купленное количество,
+        P = (B > 0) - был ли товар в заказе,
+        C = P.T * B - для пары (a, b) сумма количеств b в заказах, где есть a
+    (то же, что прежний Sum('qty') по заказам с товаром a). Для каждого товара
+    сохраняются top-K соседей по C.
+"""
+from array import array
+
+import numpy as np
+from scipy import sparse
+
+from django.conf import settings
+
+from product.models import OrderItem
+
+
+PAID_STATUSES = ('paid', 'finished')
+
+
+def load_items(order_ids=None):
+    """ (order_id, product_id, qty) оплаченных заказов в виде трех массивов numpy """
+    items = OrderItem.objects.filter(order__status__in=PAID_STATUSES, product__isnull=False)
+    if order_ids is not None:
+        items = items.filter(order_id__in=order_ids)
+    orders, products, qtys = array('q'), array('q'), array('d')
+    for order_id, product_id, qty in items.values_list('order_id', 'product_id', 'qty').iterator(
+            chunk_size=settings.RECOMMEND_BATCH_SIZE):
+        orders.append(order_id)
+        products.append(product_id)
+        qtys.append(qty)
+    return np.array(orders, dtype=np.int64), np.array(products, dtype=np.int64), np.array(qtys)
+
+
+def cooccurrence(orders, products, qtys):
+    """ (id товаров, матрица C в формате csr) по позициям заказов """
+    product_ids, columns = np.unique(products, return_inverse=True)
+    _order_ids, rows = np.unique(orders, return_inverse=True)
+    shape = (len(_order_ids), len(product_ids))
+    bought = sparse.csr_matrix((qtys, (rows, columns)), shape=shape)
+    bought.sum_duplicates()
+    present = bought.copy()
+    present.data = np.ones_like(present.data)
+    matrix = (present.T @ bought).tocsr()
+    matrix = (matrix - sparse.diags(matrix.diagonal())).tocsr()
+    matrix.eliminate_zeros()
+    return product_ids, matrix
+
+
+def top_neighbours(product_ids, matrix, limit):
+    """ {id товара: [[id соседа, количество], ...]} - limit соседей с наибольшим количеством,
+    limit=None - все соседи """
+    result = {}
+    for row in range(matrix.shape[0]):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        if start == end:
+            continue
+        values = matrix.data[start:end]
+        columns = matrix.indices[start:end]
+        if limit is not None and len(values) > limit:
+            best = np.argpartition(-values, limit)[:limit]
+            values, columns = values[best], columns[best]
+        order = np.lexsort((product_ids[columns], -values))
+        result[int(product_ids[row])] = [
+            [int(product_ids[column]), int(value) if float(value).is_integer() else float(value)]
+            for column, value in zip(columns[order], values[order])
+        ]
+    return result
+
+
+def build():
+    """ top RECOMMEND_TOGETHER_LIMIT совместных покупок по всем оплаченным заказам """
+    orders, products, qtys = load_items()
+    if not len(orders):
+        return {}
+    product_ids, matrix = cooccurrence(orders, products, qtys)
+    return top_neighbours(product_ids, matrix, settings.RECOMMEND_TOGETHER_LIMIT)
+
+
+def delta(order_ids):
+    """ все совместные покупки только по заказам order_ids - для инкрементального обновления """
+    orders, products, qtys = load_items(order_ids)
+    if not len(orders):
+        return {}
+    product_ids, matrix = cooccurrence(orders, products, qtys)
+    return top_neighbours(product_ids, matrix, None)
@@ -0,0 +1,38 @@
+""" Справочник валют в памяти процесса.
+    Загружается одним запросом при первом обращении и перечитывается после
+    изменения Currency (сигнал увеличивает версию в общем кэше; без общего
+    кэша другие процессы перечитают справочник через PROCESS_CACHE_TTL секунд).
+"""
+from django.apps import apps
+
+from shop.process_cache import VersionedCache
+
+
+DEFAULT_CODE = 'UAH'
+DEFAULT_CURRENCY = {'name': 'ГРН', 'rate': 1, 'disp': 'грн'}
+
+
+def load_currencies(key):
+    Currency = apps.get_model('product', 'Currency')
+    currencies = list(Currency.objects.all())
+    if not any(curr.code == DEFAULT_CODE for curr in currencies):
+        default, _create = Currency.objects.get_or_create(code = DEFAULT_CODE, defaults = DEFAULT_CURRENCY)
+        currencies.append(default)
+    return currencies
+
+
+registry = VersionedCache('currency', load_currencies)
+
+
+def all_currencies():
+    return registry.get('all')
+
+
+def get_currency(code):
+    """ валюта по коду, для неизвестного кода - валюта по умолчанию """
+    by_code = {curr.code: curr for curr in all_currencies()}
+    return by_code.get(code) or by_code[DEFAULT_CODE]
+
+
+def selected(request):
+    return get_currency(request.session.get('curr_id', DEFAULT_CODE))
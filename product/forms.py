@@ -1,4 +1,5 @@
 from django import forms
+from django.conf import settings
 from product.models import Order, OrderItem, Promocode
 
 
@@ -18,4 +19,13 @@ class ChangeStatusOrder(forms.ModelForm):
 class CreatePromo(forms.ModelForm):
     class Meta:
         model = Promocode
-        fields = ['code', 'type_code', 'amount_of_discount', 'type_promo', 'status', 'start_promo', 'end_promo']
\ No newline at end of file
+        fields = ['code', 'type_code', 'amount_of_discount', 'type_promo', 'status', 'start_promo', 'end_promo']
+
+
+class GeneratePromo(forms.Form):
+    cnt = forms.IntegerField(min_value=1, max_value=settings.PROMO_MAX_GENERATE, initial=1000, label='Количество')
+    type_code = forms.ChoiceField(choices=Promocode.type_discount_choices, initial='relative')
+    amount_of_discount = forms.FloatField(initial=-10)
+    type_promo = forms.ChoiceField(choices=Promocode.type_promo_choices, initial='onceuse')
+    start_promo = forms.DateField(required=False)
+    end_promo = forms.DateField(required=False)
\ No newline at end of file
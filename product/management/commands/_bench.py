@@ -0,0 +1,49 @@
+""" Общие помощники для команд bench_*: замер времени и данные, которые
+    откатываются после замера, чтобы бенчмарк не оставлял строк в базе. """
+from contextlib import contextmanager
+import statistics
+import time
+
+from django.db import transaction
+
+
+class Rollback(Exception):
+    pass
+
+
+@contextmanager
+def rolled_back():
+    """ все изменения базы внутри блока откатываются """
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback
+    except Rollback:
+        pass
+
+
+def measure(func, repeat):
+    """ (результат последнего вызова, {'median', 'p95', 'max'} в миллисекундах) """
+    timings = []
+    result = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return result, {
+        'median': round(statistics.median(timings), 2),
+        'p95': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+        'max': round(timings[-1], 2),
+    }
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
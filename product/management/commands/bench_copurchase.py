@@ -0,0 +1,66 @@
+import random
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+
+from accounts.models import CustomUser
+from product import copurchase
+from product.models import Currency, Order, OrderItem, Product
+from product.management.commands._bench import batches, measure, rolled_back
+
+
+class Command(BaseCommand):
+    help = ('Матрица совместных покупок: расчет по синтетическим заказам в памяти (--orders) '
+        'и через базу против прежнего Sum-запроса на товар (--db-orders). Данные откатываются.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=1000000)
+        parser.add_argument('--products', type=int, default=20000)
+        parser.add_argument('--db-orders', type=int, default=20000)
+        parser.add_argument('--sample', type=int, default=50, help='товаров для прежнего запроса')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def synthetic(self, rng, orders, products):
+        """ 1-5 позиций в заказе, популярность товаров по закону Ципфа """
+        sizes = rng.integers(1, 6, orders)
+        order_ids = np.repeat(np.arange(orders, dtype=np.int64), sizes)
+        product_ids = (rng.zipf(1.3, len(order_ids)) - 1) % products
+        qtys = rng.integers(1, 4, len(order_ids)).astype(float)
+        return order_ids, product_ids.astype(np.int64), qtys
+
+    def old_query(self, product_id):
+        return list(OrderItem.objects.filter(
+            order__in=OrderItem.objects.filter(product_id=product_id, order__status__in=copurchase.PAID_STATUSES).values('order_id'),
+        ).exclude(product_id=product_id).values('product').annotate(all_qty=Sum('qty')).order_by('-all_qty')[:10])
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        random.seed(options['seed'])
+        arrays = self.synthetic(rng, options['orders'], options['products'])
+        (product_ids, matrix), stats = measure(lambda: copurchase.cooccurrence(*arrays), 1)
+        self.stdout.write(f'{options["orders"]} заказов, {len(arrays[0])} позиций: матрица {stats["max"]} мс, '
+            f'{matrix.nnz} пар')
+        together, stats = measure(lambda: copurchase.top_neighbours(product_ids, matrix, 10), 1)
+        self.stdout.write(f'top-10 для {len(together)} товаров: {stats["max"]} мс')
+
+        with rolled_back():
+            currency = Currency.objects.create(code='BNC', name='BNC', rate=1, disp='BNC')
+            user = CustomUser.objects.create(email='bench_copurchase@example.com')
+            before = Product.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            Product.objects.bulk_create([Product(title=f'Товар {i}', price=1) for i in range(options['products'])])
+            ids = list(Product.objects.filter(id__gt=before).order_by('id').values_list('id', flat=True))
+            order_ids, product_idx, qtys = self.synthetic(rng, options['db_orders'], options['products'])
+            Order.objects.bulk_create([Order(user=user, currency=currency, status='paid')
+                for i in range(options['db_orders'])], batch_size=5000)
+            orders = list(Order.objects.filter(user=user).order_by('id').values_list('id', flat=True))
+            items = (OrderItem(order_id=orders[order], product_id=ids[product], qty=int(qty))
+                for order, product, qty in zip(order_ids, product_idx, qtys))
+            for batch in batches(items, 5000):
+                OrderItem.objects.bulk_create(batch)
+            together, stats = measure(copurchase.build, 1)
+            self.stdout.write(f'{options["db_orders"]} заказов в базе: build() {stats["max"]} мс на все товары')
+            sample = random.sample(list(together), min(options['sample'], len(together)))
+            _result, stats = measure(lambda: [self.old_query(product_id) for product_id in sample], 1)
+            self.stdout.write(f'прежний запрос: {round(stats["max"] / max(len(sample), 1), 2)} мс на товар, '
+                f'~{round(stats["max"] / max(len(sample), 1) * len(together))} мс на все товары')
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+
+from product.models import Product
+from product.management.commands._bench import batches, measure, rolled_back
+from product.pagination import KeysetPaginator, encode_cursor
+
+
+ORDERING = ('-date_add', '-id')
+
+
+class Command(BaseCommand):
+    help = 'Задержка первой и глубокой страницы каталога: OFFSET (с COUNT и без) против keyset-курсора. Данные откатываются.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=110000)
+        parser.add_argument('--per-page', type=int, default=20)
+        parser.add_argument('--page', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def handle(self, *args, **options):
+        per_page = options['per_page']
+        with rolled_back():
+            products = (Product(title=f'Товар {i}', price=i % 1000) for i in range(options['size']))
+            for batch in batches(products, 5000):
+                Product.objects.bulk_create(batch)
+            queryset = Product.objects.all()
+            for number in (1, options['page']):
+                offset = (number - 1) * per_page
+                cursor = None
+                if offset:
+                    # курсор предыдущей страницы, как его вернул бы клиенту keyset-запрос
+                    cursor = encode_cursor(list(queryset.order_by(*ORDERING).values_list(
+                        'date_add', 'id')[offset - 1]))
+                variants = {
+                    'offset+count': lambda: list(Paginator(queryset.order_by(*ORDERING), per_page).page(number).object_list),
+                    'offset': lambda: list(queryset.order_by(*ORDERING)[offset:offset + per_page]),
+                    'keyset': lambda: KeysetPaginator(queryset, ORDERING, per_page).page(cursor).object_list,
+                }
+                results = {}
+                for name, func in variants.items():
+                    page, stats = measure(func, options['repeat'])
+                    results[name] = [product.id for product in page]
+                    self.stdout.write(f'страница {number:5} {name:13} median {stats["median"]} мс, p95 {stats["p95"]} мс')
+                if len({tuple(ids) for ids in results.values()}) != 1:
+                    self.stderr.write(f'страница {number}: результаты вариантов не совпадают')
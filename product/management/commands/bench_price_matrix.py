@@ -0,0 +1,59 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from product import price_matrix
+from product.models import PriceMatrix, PriceMatrixItem
+from product.management.commands._bench import measure, rolled_back
+
+
+def scan(items, total_amount):
+    """ прежний расчет: перебор строк матрицы """
+    cost_of_delivery = 0
+    for item in items:
+        if item.min_value <= total_amount < item.max_value:
+            if item.type_item == 'fixed':
+                cost_of_delivery = item.value
+                break
+            elif item.type_item == 'relative':
+                cost_of_delivery = total_amount / 100 * item.value
+                break
+    return round(cost_of_delivery, 2)
+
+
+class Command(BaseCommand):
+    help = 'Стоимость доставки по матрице: перебор строк против скомпилированной таблицы. Данные откатываются.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, nargs='+', default=[10, 100, 1000])
+        parser.add_argument('--lookups', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        for count in options['items']:
+            with rolled_back():
+                matrix = PriceMatrix.objects.create(name='bench')
+                PriceMatrixItem.objects.bulk_create([
+                    PriceMatrixItem(matrix=matrix, min_value=i * 100, max_value=(i + 1) * 100,
+                        type_item=random.choice(['fixed', 'relative']), value=random.randint(1, 50))
+                    for i in range(count)
+                ])
+                amounts = [random.uniform(0, count * 110) for i in range(options['lookups'])]
+                lookups = amounts[:max(1, len(amounts) // 20)]
+                _result, with_query = measure(
+                    lambda: [scan(matrix.pricematrixitem_set.all(), amount) for amount in lookups], 1)
+                items = list(matrix.pricematrixitem_set.all())
+                expected, in_memory = measure(lambda: [scan(items, amount) for amount in amounts], 1)
+                price_matrix.matrices.invalidate()
+                compiled, stats = measure(
+                    lambda: [price_matrix.get_matrix(matrix.pk).cost(amount) for amount in amounts], 1)
+                table = price_matrix.get_matrix(matrix.pk)
+                _result, bare = measure(lambda: [table.cost(amount) for amount in amounts], 1)
+                per_call = lambda stats, calls: round(stats['max'] * 1000 / calls, 2)
+                self.stdout.write(
+                    f'{count} строк: перебор с запросом {per_call(with_query, len(lookups))} мкс, '
+                    f'перебор в памяти {per_call(in_memory, len(amounts))} мкс, '
+                    f'get_matrix + bisect {per_call(stats, len(amounts))} мкс, '
+                    f'bisect {per_call(bare, len(amounts))} мкс на расчет, '
+                    f'совпадает: {compiled == expected}')
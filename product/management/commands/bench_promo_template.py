@@ -0,0 +1,43 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from accounts.models import CustomUser
+from accounts.promo_template import PromoTemplate
+from product.models import Product, Promocode
+from product.management.commands._bench import measure, rolled_back
+
+
+TEXT = ('Привет, {% username %}! На балансе {% balance %} грн.\n'
+    '{% product|ID1|name %} теперь {% product|ID1|price %} вместо {% product|ID1|oldprice %}: {% product|ID1|link %}\n'
+    '{% product|ID2|name %} за {% product|ID2|price %}: {% product|ID2|link %}\n'
+    'Ваш промокод: {% oncepromo %}')
+
+
+class Command(BaseCommand):
+    help = ('Рассылка по шаблону на N получателей: разбор шаблона и товары один раз на рассылку '
+        'против разбора на каждого получателя. Данные откатываются.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, nargs='+', default=[10000, 100000])
+        parser.add_argument('--per-user-sample', type=int, default=1000,
+            help='сколько получателей обработать по-старому (время пересчитывается на всех)')
+
+    def handle(self, *args, **options):
+        with rolled_back():
+            products = [Product.objects.create(title=f'Товар {i}', price=100 + i, old_price=150 + i) for i in range(2)]
+            text = TEXT.replace('ID1', str(products[0].pk)).replace('ID2', str(products[1].pk))
+            for count in options['recipients']:
+                users = [CustomUser(email=f'user{i}@example.com', username=f'user{i}', balance=random.random() * 1000)
+                    for i in range(count)]
+                promos, generate = measure(lambda: Promocode.generate_new_promocode(cnt=count), 1)
+                template, compile_ = measure(lambda: PromoTemplate(text), 1)
+                messages, render = measure(
+                    lambda: [template.render(user, promo) for user, promo in zip(users, promos)], 1)
+                sample = users[:options['per_user_sample']]
+                _result, per_user = measure(
+                    lambda: [PromoTemplate(text).render(user, promo) for user, promo in zip(sample, promos)], 1)
+                self.stdout.write(
+                    f'{count} получателей: промокоды {generate["max"]} мс, шаблон {compile_["max"]} мс, '
+                    f'сборка {render["max"]} мс ({len(set(messages))} разных сообщений); '
+                    f'разбор на каждого ~{round(per_user["max"] * count / len(sample))} мс')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from product.models import Promocode
+from product.management.commands._bench import measure, rolled_back
+
+
+class Command(BaseCommand):
+    help = 'Скорость генерации одноразовых промокодов пачками. Данные откатываются.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, nargs='+', default=[10000, 200000])
+
+    def handle(self, *args, **options):
+        for count in options['count']:
+            with rolled_back():
+                codes, stats = measure(lambda: Promocode.generate_new_promocode(cnt=count), 1)
+                stored = Promocode.objects.filter(code__in=codes[:5000]).count()
+                self.stdout.write(f'{count} кодов: {stats["max"]} мс, '
+                    f'{round(len(codes) / stats["max"] * 1000)} кодов/с, уникальных {len(set(codes))}, '
+                    f'в базе из первых {min(len(codes), 5000)}: {stored}')
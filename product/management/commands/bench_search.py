@@ -0,0 +1,49 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from product import search
+from product.models import Product
+from product.management.commands._bench import batches, measure, rolled_back
+
+
+WORDS = ['телефон', 'чехол', 'кабель', 'ноутбук', 'зарядка', 'наушники', 'мышь', 'клавиатура',
+    'монитор', 'колонка', 'камера', 'планшет', 'часы', 'роутер', 'флешка', 'адаптер']
+# редкое слово есть в 0.1% товаров: icontains без индекса просматривает всю таблицу
+RARE = 'тепловизор'
+QUERIES = ['телефон', 'чехол телефон', 'наушн', 'монитор камера часы', RARE, f'{RARE} камера']
+
+
+class Command(BaseCommand):
+    help = 'Задержка поиска по синтетическому каталогу: индекс текущей СУБД против icontains. Данные откатываются.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=500000)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--batch', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def make_products(self, size):
+        for i in range(size):
+            title = ' '.join(random.sample(WORDS, 3)) + f' {i}'
+            if i % 1000 == 0:
+                title = f'{RARE} {title}'
+            desc = ' '.join(random.choices(WORDS, k=12))
+            yield Product(title=title, desc=desc, price=random.randint(1, 10000))
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        backend = search.get_backend()
+        plain = search.BaseSearchBackend()
+        with rolled_back():
+            for batch in batches(self.make_products(options['size']), options['batch']):
+                Product.objects.bulk_create(batch)
+            _result, stats = measure(backend.rebuild, 1)
+            self.stdout.write(f'{Product.objects.count()} товаров, {type(backend).__name__}.rebuild: {stats["max"]} мс')
+            for text in QUERIES:
+                for name, engine in (('index', backend), ('icontains', plain)):
+                    found, stats = measure(
+                        lambda: list(engine.search(Product.objects.all(), text).values_list('id', flat=True)[:20]),
+                        options['repeat'] if name == 'index' else max(1, options['repeat'] // 10))
+                    self.stdout.write(f'{text!r:28} {name:10} {len(found):3} шт. '
+                        f'median {stats["median"]} мс, p95 {stats["p95"]} мс')
@@ -0,0 +1,27 @@
+# Generated by Django 3.1.7 on 2026-10-18 17:49
+
+from django.db import migrations, models
+
+
+def merge_duplicate_basket_items(apps, schema_editor):
+    BasketItem = apps.get_model('product', 'BasketItem')
+    duplicates = BasketItem.objects.values('user', 'product').annotate(
+        cnt=models.Count('id'), last_id=models.Max('id')).filter(cnt__gt=1)
+    for item in duplicates:
+        BasketItem.objects.filter(user=item['user'], product=item['product']).exclude(
+            id=item['last_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0050_auto_20210504_2153'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_basket_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='basketitem',
+            constraint=models.UniqueConstraint(fields=('user', 'product'), name='unique_basket_item'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.1.7 on 2026-10-18 18:05
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS product_product_fts USING fts5(title, description)')
+        schema_editor.execute(
+            'INSERT INTO product_product_fts (rowid, title, description) '
+            'SELECT id, title, "desc" FROM product_product')
+    elif vendor == 'postgresql':
+        schema_editor.execute('ALTER TABLE product_product ADD COLUMN search_vector tsvector')
+        schema_editor.execute(
+            "UPDATE product_product SET search_vector = "
+            "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+            "setweight(to_tsvector('simple', coalesce(\"desc\", '')), 'B')")
+        schema_editor.execute(
+            'CREATE INDEX product_product_search_vector ON product_product USING GIN (search_vector)')
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS product_product_fts')
+    elif vendor == 'postgresql':
+        schema_editor.execute('ALTER TABLE product_product DROP COLUMN IF EXISTS search_vector')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0051_unique_basket_item'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
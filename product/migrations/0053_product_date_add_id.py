@@ -0,0 +1,17 @@
+# Generated by Django 3.1.7 on 2026-10-18 17:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0052_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['date_add', 'id'], name='product_date_add_id'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.7 on 2026-10-18 18:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0053_product_date_add_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductRecommendation',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='recommendation', serialize=False, to='product.product')),
+                ('recommended', models.JSONField(default=list, verbose_name='Рекомендуемые товары категорий')),
+                ('similar', models.JSONField(default=list, verbose_name='Товары категорий с близкой ценой')),
+                ('bought_together', models.JSONField(default=list, verbose_name='Покупают вместе: [id, количество]')),
+                ('date_update', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
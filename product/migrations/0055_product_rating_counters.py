@@ -0,0 +1,35 @@
+# Generated by Django 3.1.7 on 2026-10-18 18:08
+
+from django.db import migrations, models
+
+
+def fill_rating_counters(apps, schema_editor):
+    Product = apps.get_model('product', 'Product')
+    RatingProduct = apps.get_model('product', 'RatingProduct')
+    totals = RatingProduct.objects.values('product').annotate(
+        total=models.Sum('value_rating'), cnt=models.Count('id')).order_by()
+    products = [
+        Product(pk=row['product'], rating_sum=row['total'], rating_count=row['cnt'], rating=row['total'] / row['cnt'])
+        for row in totals
+    ]
+    Product.objects.bulk_update(products, ['rating_sum', 'rating_count', 'rating'], batch_size=1000)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0054_product_recommendation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.IntegerField(default=0, verbose_name='Количество оценок'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.IntegerField(default=0, verbose_name='Сумма оценок'),
+        ),
+        migrations.RunPython(fill_rating_counters, migrations.RunPython.noop),
+    ]
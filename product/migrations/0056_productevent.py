@@ -0,0 +1,25 @@
+# Generated by Django 3.1.7 on 2026-10-18 18:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0055_product_rating_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type_event', models.CharField(choices=[('edit_price', 'Изменение цены'), ('active_product', 'Снова в наличии'), ('file_changed', 'Замена файла')], max_length=50)),
+                ('title', models.CharField(default='', max_length=300)),
+                ('price', models.FloatField(null=True)),
+                ('date_create', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='product.product')),
+            ],
+        ),
+    ]
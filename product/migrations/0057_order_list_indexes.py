@@ -0,0 +1,25 @@
+# Generated by Django 3.1.7 on 2026-10-18 18:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0056_productevent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'date_create'], name='order_status_date_create'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['date_create', 'id'], name='order_date_create_id'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['total_amount'], name='order_total_amount'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.1.7 on 2026-10-18 18:20
+
+from django.db import migrations, models
+
+
+def fill_id_good(apps, schema_editor):
+    OrderItem = apps.get_model('product', 'OrderItem')
+    OrderItem.objects.exclude(id_good=models.F('product_id')).update(id_good=models.F('product_id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0057_order_list_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_id_good, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.1.7 on 2026-10-18 18:15
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('product', '0058_orderitem_id_good'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type_entry', models.CharField(choices=[('payment', 'Оплата заказа'), ('refund', 'Возврат за отмененный заказ')], max_length=50, verbose_name='Тип')),
+                ('amount', models.FloatField(verbose_name='Изменение баланса')),
+                ('balance_after', models.FloatField(verbose_name='Баланс после операции')),
+                ('date_create', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='product.order', verbose_name='Заказ')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='balanceentry',
+            constraint=models.UniqueConstraint(fields=('order', 'type_entry'), name='unique_order_balance_entry'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.7 on 2026-10-18 18:55
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0059_balanceentry'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='wishlist',
+            options={'permissions': (('show_all_wishlist', 'Просматривать список желаний других пользователей'),)},
+        ),
+    ]
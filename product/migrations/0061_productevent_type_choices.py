@@ -0,0 +1,28 @@
+# Generated by Django 3.1.7 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+def apply_file_changed(apps, schema_editor):
+    # file_changed больше не обрабатывается relay: сбросить id файлов по оставшимся событиям
+    ProductEvent = apps.get_model('product', 'ProductEvent')
+    FileTelegram = apps.get_model('product', 'FileTelegram')
+    events = ProductEvent.objects.filter(type_event='file_changed')
+    FileTelegram.objects.filter(product_id__in=events.values('product_id')).delete()
+    events.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0060_wishlist_options'),
+    ]
+
+    operations = [
+        migrations.RunPython(apply_file_changed, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='productevent',
+            name='type_event',
+            field=models.CharField(choices=[('edit_price', 'Изменение цены'), ('active_product', 'Снова в наличии')], max_length=50),
+        ),
+    ]
@@ -1,14 +1,18 @@
-from django.db import models, utils
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction, utils
 from accounts.models import CustomUser
-from django.db.models.signals import post_delete
+from django.db.models.functions import Cast
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.core.exceptions import ValidationError
 from django.urls import reverse
 from datetime import date
+import hashlib
 from dotenv import load_dotenv
 load_dotenv()
-import requests
-import os
 from django.utils.crypto import get_random_string
-from accounts import tasks as acc_tasks
+from product import cards, changes, currency, novaposhta, payments, price_matrix, search
 
 
 class PriceMatrix(models.Model):
@@ -26,6 +30,59 @@ class PriceMatrixItem(models.Model):
     value = models.FloatField(default=0, verbose_name='Значение')
     matrix = models.ForeignKey(PriceMatrix, on_delete=models.CASCADE)
 
+    def clean(self):
+        rows = list(PriceMatrixItem.objects.filter(matrix_id=self.matrix_id).exclude(
+            pk=self.pk).values_list('min_value', 'max_value'))
+        rows.append((self.min_value, self.max_value))
+        problems = price_matrix.check_intervals(rows, with_gaps=False)
+        if problems:
+            raise ValidationError(problems)
+
+
+class ProductQuerySet(models.QuerySet):
+
+    def update_with_events(self, **kwargs):
+        """ update() с теми же событиями изменения, что и у Product.save() """
+        fields = ('id', 'title') + changes.TRACKED_FIELDS
+        with transaction.atomic():
+            if not any(field in kwargs for field in changes.TRACKED_FIELDS):
+                ids = list(self.values_list('id', flat = True))
+                transaction.on_commit(lambda: cards.invalidate_many(ids))
+                return self.model.objects.filter(pk__in = ids).update(**kwargs)
+            before = {row[0]: row for row in self.values_list(*fields)}
+            count = self.model.objects.filter(pk__in = before).update(**kwargs)
+            transaction.on_commit(lambda: cards.invalidate_many(before))
+            rows = []
+            for row in self.model.objects.filter(pk__in = before).values_list(*fields):
+                new = dict(zip(fields, row))
+                events = changes.detect(dict(zip(fields, before[row[0]])), new)
+                if events:
+                    rows.append((row[0], new['title'], new['price'], events))
+            changes.record(rows)
+        return count
+
+    def bulk_update_with_events(self, objs, fields, batch_size = None):
+        """ bulk_update() с событиями изменения для объектов, прочитанных из базы """
+        rows = []
+        olds = {obj.pk: obj.loaded_values() for obj in objs if hasattr(obj, '_loaded_row')}
+        Product.add_unloaded_values(olds)
+        for obj in objs:
+            old = {field: value for field, value in olds.get(obj.pk, {}).items() if field in fields or field == 'is_active'}
+            events = changes.detect(old, obj.current_values(old))
+            if events:
+                rows.append((obj.pk, obj.title, obj.price, events))
+        with transaction.atomic():
+            self.bulk_update(objs, fields, batch_size = batch_size)
+            changes.record(rows)
+            ids = [obj.pk for obj in objs]
+            transaction.on_commit(lambda: cards.invalidate_many(ids))
+        for obj in objs:
+            obj.remember_loaded(olds.get(obj.pk))
+
+
+class ProductManager(models.Manager.from_queryset(ProductQuerySet)):
+    pass
+
 
 class Product(models.Model):
     author = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True)
@@ -45,63 +102,86 @@ class Product(models.Model):
     photo = models.FileField(default=None, null=True, blank=True)
     is_recommend = models.BooleanField(default=False, verbose_name='Рекомендовать')
     rating = models.FloatField(null=True, verbose_name='Рейтинг', blank=True)
+    rating_sum = models.IntegerField(default=0, verbose_name='Сумма оценок')
+    rating_count = models.IntegerField(default=0, verbose_name='Количество оценок')
     is_active = models.BooleanField(default=True, verbose_name='Активный')
+
+    objects = ProductManager()
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['date_add', 'id'], name='product_date_add_id'),
+        ]
 
     def __str__(self):
         return self.title
 
-    __origin_price = None
-    __origin_stock = None
-    __origin_is_active = None
-    __origin_file_digit = None
-
-    def __init__(self, *args, **kwargs):
-        super(Product, self).__init__(*args, **kwargs)
-        self.__origin_price = self.price
-        self.__origin_stock = self.stock
-        self.__origin_is_active = self.is_active
-        self.__origin_file_digit = self.file_digit
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Product, cls).from_db(db, field_names, values)
+        # только ссылка на прочитанную строку, значения разбираются при сохранении
+        instance._loaded_row = (field_names, values)
+        return instance
+
+    def loaded_values(self):
+        """ отслеживаемые поля в том виде, в котором они были прочитаны из базы """
+        field_names, values = getattr(self, '_loaded_row', ((), ()))
+        return {field: value for field, value in zip(field_names, values) if field in changes.TRACKED_FIELDS}
+
+    def current_values(self, old):
+        """ текущие значения полей old; не прочитанное и не присвоенное поле не менялось """
+        deferred = self.get_deferred_fields()
+        return {field: old[field] if field in deferred else getattr(self, field) for field in old}
+
+    @staticmethod
+    def add_unloaded_values(olds):
+        """ olds - {id: loaded_values()} товаров, прочитанных из базы. Отслеживаемые поля,
+        не прочитанные вместе с товаром (.only()/.defer()), дочитываются одним запросом,
+        иначе, например, edit_price без is_active не определился бы """
+        missing = [pk for pk, old in olds.items() if len(old) < len(changes.TRACKED_FIELDS)]
+        if not missing:
+            return
+        for pk, *values in Product._base_manager.filter(pk__in = missing).values_list('id', *changes.TRACKED_FIELDS):
+            for field, value in zip(changes.TRACKED_FIELDS, values):
+                olds[pk].setdefault(field, value)
+
+    def remember_loaded(self, old = None):
+        """ old - значения до сохранения, для полей, которые так и остались не прочитанными """
+        values = self.current_values(old) if old else {}
+        row = []
+        for field in changes.TRACKED_FIELDS:
+            value = values[field] if field in values else getattr(self, field)
+            row.append(changes.file_name(value) if field == 'file_digit' else value)
+        self._loaded_row = (changes.TRACKED_FIELDS, tuple(row))
 
     def save(self, *args, **kwargs):
-        self.price = round(self.price, 2)
-        self.old_price = round(self.old_price, 2)
-        if self.__origin_price != self.price and self.is_active and self.__origin_is_active:
-            self.get_list_tg_sub(type_sub='edit_price')
-        if self.__origin_stock == 0 and self.stock > 0 and self.is_active:
-            self.get_list_tg_sub(type_sub='active_product')
-        if self.__origin_file_digit != self.file_digit:
-            print(self.filetelegram_set.all())
-            print(self.filetelegram_set.all().delete())
-        super(Product, self).save(*args, **kwargs)
+        deferred = self.get_deferred_fields()
+        for field in ('price', 'old_price'):
+            if field not in deferred:
+                setattr(self, field, round(getattr(self, field), 2))
+        loaded = old = self.loaded_values()
+        if self.pk is not None and hasattr(self, '_loaded_row'):
+            Product.add_unloaded_values({self.pk: loaded})
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            old = {field: value for field, value in old.items() if field in update_fields or field == 'is_active'}
+        events = changes.detect(old, self.current_values(old))
+        if events:
+            with transaction.atomic():
+                super(Product, self).save(*args, **kwargs)
+                changes.record([(self.pk, self.title, self.price, events)])
+        else:
+            super(Product, self).save(*args, **kwargs)
+        self.remember_loaded(loaded)
     
 
     def get_absolute_url(self):
         return reverse('product_page', args=[self.id])
 
 
-    def get_list_tg_sub(self, type_sub):
-        lst = []
-        items = []
-        if type_sub == 'edit_price':
-            all_user = self.subeditprice_set.all()
-        elif type_sub == 'active_product':
-            all_user = self.subactivateproduct_set.all()
-        else:
-            return
-        for user_sub in all_user:
-            lst.append(user_sub.user.id_tg)
-            items.append(user_sub.pk)
-        
-        if type_sub == 'edit_price':
-            acc_tasks.send_edit_price.delay(lst, self.title, self.price)
-        elif type_sub == 'active_product':
-            acc_tasks.send_activate_product.delay(lst, self.title, self.price, items)
-            
         
     def product_rating(self):
-        rating = self.rating_product.values('value_rating').aggregate(rating=models.Avg('value_rating'))
-        return rating.get('rating')
+        return self.rating_sum / self.rating_count if self.rating_count else None
 
     
     def select_rating(self, user):
@@ -165,41 +245,12 @@ class Delivery(models.Model):
     ##### похоже от этого избавился, перепроверить и удалить.
     @classmethod
     def calc_cost_of_delivery(cls, id_delivery, total_amount):
-        delivery = cls.objects.get(pk=id_delivery)
-        delivery_matrix = delivery.matrix
-        if not delivery_matrix:
-            return 0
-        items = delivery_matrix.pricematrixitem_set.all()
-        cost_of_delivery = 0
-        for item in items:
-            if item.min_value <= total_amount < item.max_value:
-                if item.type_item =='fixed':
-                    cost_of_delivery = item.value
-                    break
-                elif item.type_item == 'relative':
-                    cost_of_delivery = total_amount /100 * item.value
-                    break
-
-        cost_of_delivery = round(cost_of_delivery, 2)
-        return cost_of_delivery
+        return cls.objects.get(pk=id_delivery).calculate_cost_of_delivery(total_amount)
 
     def calculate_cost_of_delivery(self, total_amount):
-        delivery_matrix = self.matrix
-        if not delivery_matrix:
+        if not self.matrix_id:
             return 0
-        items = delivery_matrix.pricematrixitem_set.all()
-        cost_of_delivery = 0
-        for item in items:
-            if item.min_value <= total_amount < item.max_value:
-                if item.type_item =='fixed':
-                    cost_of_delivery = item.value
-                    break
-                elif item.type_item == 'relative':
-                    cost_of_delivery = total_amount /100 * item.value
-                    break
-
-        cost_of_delivery = round(cost_of_delivery, 2)
-        return cost_of_delivery
+        return price_matrix.get_matrix(self.matrix_id).cost(total_amount)
 
 class Promocode(models.Model):
     #table with promocode
@@ -222,25 +273,48 @@ class Promocode(models.Model):
     def __str__(self):
         return self.code
 
+    @staticmethod
+    def cache_key(code):
+        return 'promo:' + hashlib.md5(code.encode()).hexdigest()
+
+    @classmethod
+    def get_valid(cls, code):
+        """ Действующий промокод (активный, в пределах дат) или None.
+            Проверка - один запрос по уникальному индексу code, результат
+            (в том числе отсутствие кода) кэшируется на PROMO_CACHE_TTL секунд.
+        """
+        if not code:
+            return None
+        key = cls.cache_key(code)
+        promo = cache.get(key)
+        if promo is None:
+            today = date.today()
+            promo = cls.objects.filter(
+                models.Q(start_promo__isnull = True) | models.Q(start_promo__lte = today),
+                models.Q(end_promo__isnull = True) | models.Q(end_promo__gte = today),
+                code = code, status = True,
+            ).first() or False
+            cache.set(key, promo, settings.PROMO_CACHE_TTL)
+        return promo or None
+
     @classmethod
     def is_promo(cls, promocode):
-        is_promo = cls.objects.filter(code = promocode, status = True)
-        if is_promo:
-            is_promo = is_promo[0]
-            if is_promo.start_promo:
-                if is_promo.end_promo:
-                    if is_promo.start_promo <= date.today() <= is_promo.end_promo:
-                        return True
-                else:
-                    if is_promo.start_promo <= date.today():
-                        return True
-            elif is_promo.end_promo:
-                if date.today() <= is_promo.end_promo:
-                    return True
-            else:
-                return True
-            return False
-        return False
+        return cls.get_valid(promocode) is not None
+
+    def consume(self):
+        """ Использование промокода при оформлении заказа.
+            Одноразовый код гасится условным UPDATE, поэтому из двух одновременных
+            заказов код получит только один. False - код уже использован.
+            Кэш сбрасывается после фиксации транзакции: до нее параллельный запрос
+            прочитал бы из базы старую строку и снова положил бы ее в кэш.
+        """
+        if self.type_promo != 'onceuse':
+            return True
+        used = Promocode.objects.filter(pk = self.pk, status = True).update(status = False)
+        key = self.cache_key(self.code)
+        transaction.on_commit(lambda: cache.delete(key))
+        self.status = False
+        return bool(used)
     
     #### похоже тоже ненужное. проверить еще раз и удалить
     @classmethod
@@ -263,22 +337,32 @@ class Promocode(models.Model):
     
     @classmethod
     def generate_new_promocode(cls, type_code = 'relative', type_promo = 'onceuse', value = '-10', start = None, end = None, str_len = 15, cnt = 1):
-        promo = []
-        for _ in range(cnt):
-            while True:
-                try:
-                    obj = cls.objects.create(
-                        code=get_random_string(str_len),
-                        type_code=type_code,
-                        type_promo=type_promo,
-                        amount_of_discount=value,
-                    )
-                    promo.append(obj.code)
-                    break
-                except utils.IntegrityError:
-                    continue
-        return promo
-        
+        return list(cls.iter_new_promocodes(cnt, type_code, type_promo, value, start, end, str_len))
+
+    @classmethod
+    def iter_new_promocodes(cls, cnt, type_code = 'relative', type_promo = 'onceuse', value = '-10', start = None, end = None, str_len = 15):
+        """ Генерация cnt новых кодов пачками по PROMO_BATCH_SIZE, коды отдаются по мере вставки.
+            Кандидаты сверяются с уже существующими кодами одним запросом на пачку,
+            вставка - bulk_create(ignore_conflicts=True). Строки, пропущенные вставкой
+            из-за конфликта, не отдаются и не считаются: после вставки пачка перечитывается
+            с отбором по параметрам генерации, недостающие коды догенерируются.
+        """
+        left = cnt
+        while left > 0:
+            codes = set()
+            while len(codes) < min(left, settings.PROMO_BATCH_SIZE):
+                codes.add(get_random_string(str_len))
+            codes -= set(cls.objects.filter(code__in = codes).values_list('code', flat = True))
+            cls.objects.bulk_create([
+                cls(code=code, type_code=type_code, type_promo=type_promo, amount_of_discount=value,
+                    start_promo=start, end_promo=end)
+                for code in codes
+            ], ignore_conflicts=True)
+            inserted = list(cls.objects.filter(code__in = codes, type_code = type_code, type_promo = type_promo,
+                amount_of_discount = value, start_promo = start, end_promo = end).values_list('code', flat = True))
+            left -= len(inserted)
+            yield from inserted
+
 
 
 class Order(models.Model):
@@ -311,12 +395,35 @@ class Order(models.Model):
 
     class Meta:
         permissions = (('change_status','Can change status order'),)
+        indexes = [
+            models.Index(fields=['status', 'date_create'], name='order_status_date_create'),
+            models.Index(fields=['date_create', 'id'], name='order_date_create_id'),
+            models.Index(fields=['total_amount'], name='order_total_amount'),
+        ]
+
+    COURIERS_CACHE_KEY = 'order:couriers'
+    FINAL_STATUSES = ('finished', 'cancel')
 
 
     def get_absolute_url(self):
         return reverse('invoice_page', args=[self.id])
 
 
+    @staticmethod
+    def invoice_cache_key(order_id):
+        return f'invoice:{order_id}'
+
+
+    @staticmethod
+    def couriers():
+        """ курьеры [{'pk', 'email'}] из кэша, сбрасывается при изменении групп пользователей """
+        couriers = cache.get(Order.COURIERS_CACHE_KEY)
+        if couriers is None:
+            couriers = list(CustomUser.objects.filter(groups__name='Courier').order_by('email').values('pk', 'email'))
+            cache.set(Order.COURIERS_CACHE_KEY, couriers, settings.COURIERS_CACHE_TTL)
+        return couriers
+
+
     def save(self, *args, **kwargs):
         self.full_amount = round(self.full_amount, 2)
         self.total_amount = round(self.total_amount, 2)
@@ -326,24 +433,10 @@ class Order(models.Model):
     
 
     def payment(self):
-        if self.user.balance >= self.total_amount:
-            self.is_paid = True
-            self.status = 'paid'
-            self.user.balance = self.user.balance - self.total_amount
-            self.user.save()
-            self.save()
-            acc_tasks.send_file_in_order.delay(self.pk)
-            return True
-        return False
+        return payments.pay(self)
 
     def cancel_order(self):
-        self.status = 'cancel'
-        if self.is_paid:
-            self.is_paid = False
-            self.user.balance += self.total_amount
-            self.user.save()
-        self.save()
-        return True
+        return payments.cancel(self)
 
     #убрать классметод и во вьюшке переписать
     @classmethod
@@ -352,11 +445,13 @@ class Order(models.Model):
         obj.status = new_status
         obj.save()
 
-    def recalc_order(self):
-        order_item = self.orderitem_set.all()
-        self.full_amount = order_item.get_total_amount()
+    def recalc_order(self, order_items=None):
+        """ order_items - уже загруженные позиции заказа (список OrderItem),
+        чтобы не перечитывать их из базы при оформлении заказа """
+        if order_items is None:
+            order_items = self.orderitem_set.all()
+        self.full_amount = sum(item.qty * item.cost for item in order_items)
         promo = self.promo.get_sum_discount(self.full_amount) if self.promo else 0
-        print(self.delivery_method)
         if self.delivery_method.type_delivery == 'normal':
             cost_of_delivery = self.delivery_method.calculate_cost_of_delivery(self.full_amount + promo)
             #Delivery.calc_cost_of_delivery(self.delivery_method.id, self.full_amount + promo)
@@ -420,6 +515,7 @@ class OrderItem(models.Model):
                 cls.objects.create(
                     order=data.get('order'),
                     product=data.get('product'),
+                    id_good=data['product'].id,
                     title_good=data.get('title', data['product'].title),
                     qty=data.get('qty', 1),
                     cost=data.get('price', data['product'].price)
@@ -435,13 +531,44 @@ class FileTelegram(models.Model):
     id_file = models.CharField(max_length=100)
 
 
+class BalanceEntry(models.Model):
+    #журнал списаний и возвратов баланса пользователя (см. product/payments.py)
+    type_entry_choices = [
+        ('payment', 'Оплата заказа'),
+        ('refund', 'Возврат за отмененный заказ'),
+    ]
+    user = models.ForeignKey(CustomUser, on_delete=models.PROTECT, verbose_name='Пользователь')
+    order = models.ForeignKey(Order, on_delete=models.PROTECT, verbose_name='Заказ')
+    type_entry = models.CharField(max_length=50, choices=type_entry_choices, verbose_name='Тип')
+    amount = models.FloatField(verbose_name='Изменение баланса')
+    balance_after = models.FloatField(verbose_name='Баланс после операции')
+    date_create = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'type_entry'], name='unique_order_balance_entry'),
+        ]
+
+
+class ProductEvent(models.Model):
+    #события изменения товаров, ожидающие отправки (см. product/changes.py)
+    type_event_choices = [
+        ('edit_price', 'Изменение цены'),
+        ('active_product', 'Снова в наличии'),
+    ]
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    type_event = models.CharField(max_length=50, choices=type_event_choices)
+    title = models.CharField(max_length=300, default='')
+    price = models.FloatField(null=True)
+    date_create = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
 class BasketQuerySet(models.QuerySet):
 
     def get_total_amount(self):
-        total = 0
-        for i in self:
-            total += i.qty * i.price
-        return total
+        total = self.aggregate(total=models.Sum(
+            models.F('qty') * models.F('price'), output_field=models.FloatField()))
+        return total['total'] or 0
 
 class BasketManager(models.Manager):
     _queryset_class = BasketQuerySet
@@ -461,7 +588,10 @@ class BasketItem(models.Model):
         
         permissions = (
             ('show_all_baskets', 'Просматривать корзины других пользователей'),
-        )        
+        )
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='unique_basket_item'),
+        ]
 
 
 class Wishlist(models.Model):
@@ -502,15 +632,70 @@ class RatingProduct(models.Model):
     value_rating = models.IntegerField()
 
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(RatingProduct, cls).from_db(db, field_names, values)
+        instance._origin_value = instance.__dict__.get('value_rating')
+        instance._origin_product_id = instance.__dict__.get('product_id')
+        return instance
+
     def save(self, *args, **kwargs):
-        super(RatingProduct, self).save(*args, **kwargs)
-        self.recalc_rating()
-    
-    
-    def recalc_rating(self):
-        pr_rating = RatingProduct.objects.filter(product = self.product).aggregate(avg=models.Avg('value_rating'))
-        self.product.rating = pr_rating.get('avg')
-        self.product.save()
+        origin_value = getattr(self, '_origin_value', None)
+        origin_product_id = getattr(self, '_origin_product_id', None)
+        with transaction.atomic():
+            super(RatingProduct, self).save(*args, **kwargs)
+            value = int(self.value_rating)
+            if origin_product_id is None:
+                RatingProduct.change_counters(self.product_id, value, 1)
+            elif origin_product_id != self.product_id:
+                RatingProduct.change_counters(origin_product_id, -origin_value, -1)
+                RatingProduct.change_counters(self.product_id, value, 1)
+            elif origin_value != value:
+                RatingProduct.change_counters(self.product_id, value - origin_value, 0)
+        self._origin_value = value
+        self._origin_product_id = self.product_id
+
+    @staticmethod
+    def change_counters(product_id, delta_sum, delta_count):
+        """ Изменение суммы/количества оценок товара одним UPDATE, без Product.save().
+            rating пересчитывается в том же запросе из новых значений счетчиков. """
+        new_sum = models.F('rating_sum') + delta_sum
+        new_count = models.F('rating_count') + delta_count
+        Product.objects.filter(pk = product_id).update(
+            rating_sum = new_sum,
+            rating_count = new_count,
+            rating = models.Case(
+                models.When(rating_count__gt = -delta_count,
+                    then = Cast(new_sum, models.FloatField()) / new_count),
+                default = None, output_field = models.FloatField(),
+            ),
+        )
+        transaction.on_commit(lambda: cards.invalidate(product_id))
+
+    @staticmethod
+    def reconcile():
+        """ сверка счетчиков с таблицей оценок, исправляются только разошедшиеся товары """
+        actual = {row['product']: (row['total'], row['cnt']) for row in RatingProduct.objects.values('product').annotate(
+            total = models.Sum('value_rating'), cnt = models.Count('id')).order_by()}
+        drifted = []
+        stored = Product.objects.filter(models.Q(rating_count__gt = 0) | models.Q(pk__in = list(actual))).values_list(
+            'id', 'rating_sum', 'rating_count', 'rating')
+        for product_id, rating_sum, rating_count, rating in stored.iterator():
+            total, cnt = actual.get(product_id, (0, 0))
+            avg = total / cnt if cnt else None
+            if (rating_sum, rating_count) != (total, cnt) or rating != avg:
+                drifted.append(Product(pk = product_id, rating_sum = total, rating_count = cnt, rating = avg))
+        Product.objects.bulk_update(drifted, ['rating_sum', 'rating_count', 'rating'], batch_size = 1000)
+        return len(drifted)
+
+
+class ProductRecommendation(models.Model):
+    """ заранее посчитанные рекомендации для страницы товара (см. product/recommendations.py) """
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name='recommendation')
+    recommended = models.JSONField(default=list, verbose_name='Рекомендуемые товары категорий')
+    similar = models.JSONField(default=list, verbose_name='Товары категорий с близкой ценой')
+    bought_together = models.JSONField(default=list, verbose_name='Покупают вместе: [id, количество]')
+    date_update = models.DateTimeField(auto_now=True)
 
 
 class DeliveryCitiesNP(models.Model):
@@ -523,33 +708,7 @@ class DeliveryCitiesNP(models.Model):
     cityID = models.IntegerField(default=0)
 
     def calc_cost_of_delivery(self, total_amount):
-        link = 'https://api.novaposhta.ua/v2.0/json/'
-        headers = {'Content-Type':'application/json',}
-        
-        data = (
-            '{"modelName": "InternetDocument",'
-            '"calledMethod": "getDocumentPrice",'
-            '"methodProperties": {'
-            '"CitySender": "ae14ae5b-b77a-11e9-8c22-005056b24375",'
-            f'"CityRecipient": "{self.city_ref}",'
-            '"Weight": "10",'
-            '"ServiceType": "WarehouseWarehouse",'
-            f'"Cost": "{total_amount}",'
-            '"CargoType": "Cargo",'
-            '"SeatsAmount": "1",'
-            '"OptionsSeat": [{"weight": 10,'
-            '"volumetricWidth": 30,'
-            '"volumetricLength": 30,'
-            '"volumetricHeight": 30}]},'
-            f'"apiKey": "{os.environ.get("TOKEN_NP")}"}}'
-        )
-        
-        req = requests.post(link, data=data, headers=headers)
-        responce = req.json()
-        if responce['success']:
-            return responce['data'][0]['Cost']
-        else:
-            return False
+        return novaposhta.get_delivery_cost(self.city_ref, total_amount)
 
 
 class DeliveryWarehousesNP(models.Model):
@@ -561,4 +720,55 @@ class DeliveryWarehousesNP(models.Model):
     short_address_ru = models.CharField(max_length=250, blank=True, default='')
     ref_warehouse = models.CharField(max_length=250, blank=True, default='')
     number_warehouse = models.IntegerField(default=0)
-    
\ No newline at end of file
+    
+
+
+@receiver([post_save, post_delete], sender=PriceMatrixItem)
+def invalidate_price_matrix(sender, instance, **kwargs):
+    price_matrix.matrices.invalidate()
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    search.get_backend().index_many([instance.pk])
+    cards.invalidate(instance.pk)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    search.get_backend().remove(instance.pk)
+    cards.invalidate(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Promocode)
+def invalidate_promocode(sender, instance, **kwargs):
+    key = Promocode.cache_key(instance.code)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+@receiver([post_save, post_delete], sender=Currency)
+def invalidate_currency(sender, instance, **kwargs):
+    currency.registry.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Order)
+def invalidate_invoice(sender, instance, **kwargs):
+    # после коммита: иначе параллельный запрос успеет закэшировать старые данные
+    key = Order.invoice_cache_key(instance.pk)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+@receiver([post_save, post_delete], sender=OrderItem)
+def invalidate_invoice_items(sender, instance, **kwargs):
+    key = Order.invoice_cache_key(instance.order_id)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+@receiver(m2m_changed, sender=CustomUser.groups.through)
+def invalidate_couriers(sender, **kwargs):
+    cache.delete(Order.COURIERS_CACHE_KEY)
+
+
+@receiver(post_delete, sender=RatingProduct)
+def remove_rating(sender, instance, **kwargs):
+    RatingProduct.change_counters(instance.product_id, -instance.value_rating, -1)
@@ -0,0 +1,150 @@
+import json
+import logging
+import math
+import os
+import threading
+
+import requests
+from cachetools import LRUCache, TTLCache
+from django.conf import settings
+from dotenv import load_dotenv
+load_dotenv()
+
+
+logger = logging.getLogger(__name__)
+
+CITY_SENDER = 'ae14ae5b-b77a-11e9-8c22-005056b24375'
+
+# габариты посылки, по которым считается стоимость доставки
+DEFAULT_PARCEL = {
+    'service_type': 'WarehouseWarehouse',
+    'weight': 10,
+    'width': 30,
+    'length': 30,
+    'height': 30,
+}
+
+
+class NovaPoshtaError(Exception):
+    pass
+
+
+def api_request(model_name, called_method, method_properties=None):
+    """ POST-запрос к API Новой Почты. Возвращает ответ в виде dict. """
+    data = {
+        'modelName': model_name,
+        'calledMethod': called_method,
+        'methodProperties': method_properties or {},
+        'apiKey': os.environ.get('TOKEN_NP'),
+    }
+    req = requests.post(
+        settings.NP_API_URL,
+        data=json.dumps(data),
+        headers={'Content-Type': 'application/json'},
+        timeout=settings.NP_API_TIMEOUT,
+    )
+    return req.json()
+
+
+class QuoteCache:
+    """ Кэш расчетов стоимости доставки.
+        - записи живут ttl секунд, при переполнении вытесняются по LRU;
+        - одинаковые одновременные запросы объединяются: в API идет
+          только один из них, остальные ждут его результат;
+        - если свежей записи нет, но есть устаревшая - она отдается сразу,
+          а обновление идет в фоне (stale-while-revalidate). Устаревшая
+          запись так же отдается, если API не ответил.
+    """
+
+    def __init__(self, maxsize, ttl, wait_timeout):
+        self.fresh = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.stale = LRUCache(maxsize=maxsize)
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    def get(self, key, fetch):
+        with self.lock:
+            if key in self.fresh:
+                return self.fresh[key]
+            stale_value = self.stale.get(key)
+            event = self.inflight.get(key)
+            is_leader = event is None
+            if is_leader:
+                event = self.inflight[key] = threading.Event()
+
+        if not is_leader:
+            if stale_value is None:
+                event.wait(self.wait_timeout)
+            with self.lock:
+                return self.fresh.get(key, self.stale.get(key))
+
+        if stale_value is not None:
+            threading.Thread(target=self.refresh, args=(key, fetch, event), daemon=True).start()
+            return stale_value
+        self.refresh(key, fetch, event)
+        with self.lock:
+            return self.stale.get(key)
+
+    def refresh(self, key, fetch, event):
+        value = None
+        try:
+            value = fetch()
+        except (requests.RequestException, ValueError, KeyError, IndexError, TypeError) as error:
+            # сетевая ошибка или ответ API неожиданного формата
+            logger.warning('Nova Poshta request %s failed: %s', key, error)
+        finally:
+            with self.lock:
+                if value is not None:
+                    self.fresh[key] = value
+                    self.stale[key] = value
+                self.inflight.pop(key, None)
+            event.set()
+
+    def clear(self):
+        with self.lock:
+            self.fresh.clear()
+            self.stale.clear()
+
+
+quote_cache = QuoteCache(
+    maxsize=settings.NP_QUOTE_CACHE_SIZE,
+    ttl=settings.NP_QUOTE_TTL,
+    wait_timeout=settings.NP_API_TIMEOUT,
+)
+
+
+def cost_bucket(total_amount):
+    """ Округление суммы заказа вверх до шага NP_QUOTE_COST_BUCKET,
+    чтобы близкие суммы попадали в одну запись кэша. """
+    step = settings.NP_QUOTE_COST_BUCKET
+    return int(math.ceil(total_amount / step) * step) if total_amount > 0 else 0
+
+
+def request_delivery_cost(city_ref, cost, parcel):
+    responce = api_request('InternetDocument', 'getDocumentPrice', {
+        'CitySender': CITY_SENDER,
+        'CityRecipient': city_ref,
+        'Weight': str(parcel['weight']),
+        'ServiceType': parcel['service_type'],
+        'Cost': str(cost),
+        'CargoType': 'Cargo',
+        'SeatsAmount': '1',
+        'OptionsSeat': [{
+            'weight': parcel['weight'],
+            'volumetricWidth': parcel['width'],
+            'volumetricLength': parcel['length'],
+            'volumetricHeight': parcel['height'],
+        }],
+    })
+    if responce.get('success'):
+        return responce['data'][0]['Cost']
+    return None
+
+
+def get_delivery_cost(city_ref, total_amount, parcel=DEFAULT_PARCEL):
+    """ Стоимость доставки в город city_ref. False - если API не смог посчитать. """
+    cost = cost_bucket(total_amount)
+    key = (city_ref, cost, tuple(sorted(parcel.items())))
+    result = quote_cache.get(key, lambda: request_delivery_cost(city_ref, cost, parcel))
+    return False if result is None else result
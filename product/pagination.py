@@ -0,0 +1,86 @@
+""" Keyset (cursor) пагинация.
+    Следующая страница выбирается условием по ключу последней записи
+    предыдущей страницы (WHERE (date_add, id) < (...)), поэтому глубина
+    страницы не влияет на скорость, и не нужен COUNT(*).
+    Курсор - непрозрачный токен (base64 от значений ключа).
+"""
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    data = json.dumps(values, default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursor(token)
+
+
+class KeysetPage:
+
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+class KeysetPaginator:
+    """ ordering - поля ключа, например ('-date_add', '-id').
+    Последнее поле должно быть уникальным. """
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = ordering
+        self.fields = [field.lstrip('-') for field in ordering]
+        self.per_page = per_page
+
+    def cursor_filter(self, token):
+        values = decode_cursor(token)
+        if not isinstance(values, list) or len(values) != len(self.fields):
+            raise InvalidCursor(token)
+        try:
+            values = [self.queryset.model._meta.get_field(field).to_python(value)
+                for field, value in zip(self.fields, values)]
+        except ValidationError:
+            raise InvalidCursor(token)
+        condition = Q()
+        for idx, order in enumerate(self.ordering):
+            lookup = 'lt' if order.startswith('-') else 'gt'
+            equal = {field: value for field, value in zip(self.fields[:idx], values[:idx])}
+            condition |= Q(**equal, **{f'{self.fields[idx]}__{lookup}': values[idx]})
+        # избыточная граница по первому полю: по ней СУБД идет диапазоном индекса,
+        # OR из условий выше сам по себе индекс не использует
+        bound = 'lte' if self.ordering[0].startswith('-') else 'gte'
+        return Q(**{f'{self.fields[0]}__{bound}': values[0]}) & condition
+
+    def page(self, cursor=None):
+        queryset = self.queryset.order_by(*self.ordering)
+        if cursor:
+            queryset = queryset.filter(self.cursor_filter(cursor))
+        object_list = list(queryset[:self.per_page + 1])
+        next_cursor = None
+        if len(object_list) > self.per_page:
+            object_list = object_list[:self.per_page]
+            last = object_list[-1]
+            next_cursor = encode_cursor([getattr(last, field) for field in self.fields])
+        return KeysetPage(object_list, next_cursor)
@@ -1,54 +1,128 @@
+""" Загрузка товаров категории с Rozetka.
+    Страницы категории скачиваются параллельно (ROZETKA_CONCURRENCY потоков
+    с общим пулом соединений), частота запросов ограничена ROZETKA_RATE в секунду.
+    Названия категорий запрашиваются один раз за запуск. Товары каждой страницы
+    сохраняются одной пачкой. Обработанные страницы запоминаются в кэше,
+    поэтому прерванный запуск продолжается с того места, где остановился.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+
 import requests
-from product.models import Product, Categories
-import re
-from time import sleep
-
-
-
-def get_all_ids_goods(id_cat):
-    req = requests.get(f'https://xl-catalog-api.rozetka.com.ua/v3/goods/get?front-type=xl&category_id={id_cat}')
-    if req.status_code == 200:
-        all_request = req.json()
-        ids_goods = all_request['data']['ids']
-        get_goods_info(ids_goods, id_cat)
-        total_pages_category = all_request['data']['total_pages']
-        for id_page in range(2, total_pages_category+1):
-            sleep(1)
-            req_for_get_id_goods = requests.get(f'https://xl-catalog-api.rozetka.com.ua/v3/goods/get?front-type=xl&category_id={id_cat}&page={id_page}')
-            if req_for_get_id_goods.status_code == 200:
-                temp_ids_goods = req_for_get_id_goods.json()
-                get_goods_info(temp_ids_goods, id_cat)
-                ids_goods += temp_ids_goods['data']['ids']
-
-    else:
-        return('Категория не найдена. Попробуй ввести другой ID', req.url)
-            
-
-        
-def get_goods_info(lst_ids, id_category):
-    req_goods = requests.get(f'https://xl-catalog-api.rozetka.com.ua/v3/goods/getDetails?product_ids={lst_ids}')
-    if req_goods.status_code == 200:
-        all_goods = req_goods.json()
-        all_goods = all_goods['data']
-        good_info = {}
-        for good in all_goods:
-            #собираем нужную инфу про товар
-            title_product = good.get('title')
-            link = f'https://xl-catalog-api.rozetka.com.ua/v4/categories/get?front-type=xl&country=UA&lang=ru&id={good.get("category_id")}'
-            req = requests.get(link).json()
-            cat_name = req['data']['category']['title']
-            category, cr = Categories.objects.get_or_create(
-                name = cat_name
-            )
-            good_info['brand'] = good.get('brand')
-            good_info['desc'] = good.get('docket').replace('\n', '').replace('\r', '')
-            good_info['price'] = good.get('price')
-            good_info['old_price'] = good.get('old_price')
-            product_obj, product_new = Product.objects.update_or_create(
-                title = title_product,
-                defaults = good_info
-            )
-            if product_new:
-                product_obj.cid.add(category)
-            else:
-                product_obj.cid.set([category])
\ No newline at end of file
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import cache
+
+from product.services import ImportSheet
+from shop.throttling import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_FIELDS = ['brand', 'desc', 'price', 'old_price']
+PROGRESS_TIMEOUT = 60*60*24
+
+
+class RozetkaCrawler:
+
+    def __init__(self, category_id, concurrency=None, rate=None):
+        self.category_id = category_id
+        self.concurrency = concurrency or settings.ROZETKA_CONCURRENCY
+        self.bucket = TokenBucket(rate or settings.ROZETKA_RATE)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.category_locks = {}
+        self.category_titles = {}
+        self.categories_lock = threading.Lock()
+        self.progress_key = f'rozetka:{category_id}:pages'
+
+    def get_json(self, path, params):
+        self.bucket.acquire()
+        req = self.session.get(
+            f'{settings.ROZETKA_API_URL}{path}', params=params, timeout=settings.ROZETKA_TIMEOUT)
+        req.raise_for_status()
+        return req.json()
+
+    def get_page_ids(self, page):
+        data = self.get_json('/v3/goods/get', {'front-type': 'xl', 'category_id': self.category_id, 'page': page})
+        return data['data']
+
+    def get_category_title(self, category_id):
+        """ название категории запрашивается один раз, остальные потоки ждут его """
+        with self.categories_lock:
+            lock = self.category_locks.setdefault(category_id, threading.Lock())
+        with lock:
+            if category_id not in self.category_titles:
+                data = self.get_json('/v4/categories/get', {'front-type': 'xl', 'country': 'UA', 'lang': 'ru', 'id': category_id})
+                self.category_titles[category_id] = data['data']['category']['title']
+            return self.category_titles[category_id]
+
+    def get_goods(self, ids):
+        """ информация о товарах страницы в формате ImportSheet.apply_batch """
+        if not ids:
+            return []
+        data = self.get_json('/v3/goods/getDetails', {'product_ids': ','.join(str(id) for id in ids)})
+        goods = []
+        for good in data['data']:
+            if not good.get('title'):
+                continue
+            goods.append({
+                'category': self.get_category_title(good.get('category_id')),
+                'title': good.get('title'),
+                'brand': good.get('brand'),
+                'desc': (good.get('docket') or '').replace('\n', '').replace('\r', ''),
+                'price': round(float(good.get('price') or 0), 2),
+                'old_price': round(float(good.get('old_price') or 0), 2),
+            })
+        return goods
+
+    def fetch_page(self, page):
+        return self.get_goods(self.get_page_ids(page)['ids'])
+
+    def save_page(self, page, goods, stats):
+        ImportSheet.apply_batch(goods, stats, fields=PRODUCT_FIELDS)
+        done = cache.get(self.progress_key, [])
+        done.append(page)
+        cache.set(self.progress_key, done, PROGRESS_TIMEOUT)
+        stats['pages'] += 1
+
+    def run(self):
+        stats = {'pages': 0, 'skipped_pages': 0, 'failed_pages': 0, 'created': 0, 'updated': 0}
+        try:
+            first_page = self.get_page_ids(1)
+        except (requests.RequestException, ValueError, KeyError) as error:
+            logger.warning('Rozetka category %s not found: %s', self.category_id, error)
+            return {'error': 'Категория не найдена. Попробуй ввести другой ID'}
+
+        done = set(cache.get(self.progress_key, []))
+        stats['skipped_pages'] = len(done)
+        pages = [page for page in range(1, first_page['total_pages'] + 1) if page not in done]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {}
+            for page in pages:
+                if page == 1:
+                    futures[executor.submit(self.get_goods, first_page['ids'])] = page
+                else:
+                    futures[executor.submit(self.fetch_page, page)] = page
+            # запись в базу идет в текущем потоке по мере готовности страниц
+            for future in as_completed(futures):
+                page = futures[future]
+                try:
+                    goods = future.result()
+                except (requests.RequestException, ValueError, KeyError) as error:
+                    logger.warning('Rozetka category %s page %s failed: %s', self.category_id, page, error)
+                    stats['failed_pages'] += 1
+                    continue
+                self.save_page(page, goods, stats)
+
+        if not stats['failed_pages']:
+            cache.delete(self.progress_key)
+        self.session.close()
+        return stats
+
+
+def crawl_category(id_cat):
+    return RozetkaCrawler(id_cat).run()
@@ -0,0 +1,102 @@
+""" Оплата заказа с баланса пользователя и возврат при отмене.
+    Заказ и баланс меняются условными UPDATE в одной транзакции:
+        заказ - только если он еще не оплачен (is_paid=False), поэтому
+                повторная или параллельная оплата того же заказа не спишет деньги дважды;
+        баланс - только если balance >= суммы, поэтому параллельные оплаты
+                 разных заказов не уведут баланс в минус.
+    Каждое списание/возврат записывается в BalanceEntry (не больше одной
+    записи каждого типа на заказ), поэтому отмененный и снова открытый заказ
+    повторно не оплачивается и не возвращается - pay/cancel вернут False.
+    Блокировки берутся в одном порядке - заказ, затем пользователь. Кэш счета сбрасывается после фиксации транзакции.
+"""
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from accounts import tasks as acc_tasks
+
+
+PAYABLE_STATUSES = ('new', 'processing')
+
+
+class InsufficientFunds(Exception):
+    pass
+
+
+class AlreadyInLedger(Exception):
+    pass
+
+
+def pay(order):
+    """ списание суммы заказа с баланса; True - заказ оплачен (в том числе раньше) """
+    Order = apps.get_model('product', 'Order')
+    BalanceEntry = apps.get_model('product', 'BalanceEntry')
+    CustomUser = apps.get_model('accounts', 'CustomUser')
+    try:
+        with transaction.atomic():
+            marked = Order.objects.filter(pk = order.pk, is_paid = False, status__in = PAYABLE_STATUSES,
+                user__isnull = False).update(is_paid = True, status = 'paid')
+            if not marked:
+                return Order.objects.filter(pk = order.pk, is_paid = True).exists()
+            if BalanceEntry.objects.filter(order_id = order.pk, type_entry = 'payment').exists():
+                raise AlreadyInLedger(order.pk)
+            user_id, amount = Order.objects.values_list('user_id', 'total_amount').get(pk = order.pk)
+            charged = CustomUser.objects.filter(pk = user_id, balance__gte = amount).update(
+                balance = F('balance') - amount)
+            if not charged:
+                raise InsufficientFunds(order.pk)
+            balance = CustomUser.objects.values_list('balance', flat = True).get(pk = user_id)
+            BalanceEntry.objects.create(user_id = user_id, order_id = order.pk, type_entry = 'payment',
+                amount = -amount, balance_after = balance)
+            transaction.on_commit(lambda: on_paid(order.pk))
+    except (InsufficientFunds, AlreadyInLedger):
+        return False
+    order.is_paid, order.status = True, 'paid'
+    if order.user is not None:
+        order.user.balance = balance
+    return True
+
+
+def on_paid(order_id):
+    """ после фиксации оплаты: сброс кэша счета, файлы и рекомендации """
+    from product import tasks
+    Order = apps.get_model('product', 'Order')
+    cache.delete(Order.invoice_cache_key(order_id))
+    acc_tasks.send_file_in_order.delay(order_id)
+    tasks.update_recommendations_for_order.delay(order_id)
+
+
+def cancel(order):
+    """ отмена заказа; для оплаченного - возврат списанной суммы на баланс.
+    False - возврат по заказу уже был, заказ не меняется """
+    Order = apps.get_model('product', 'Order')
+    BalanceEntry = apps.get_model('product', 'BalanceEntry')
+    CustomUser = apps.get_model('accounts', 'CustomUser')
+    try:
+        with transaction.atomic():
+            refunded = Order.objects.filter(pk = order.pk, is_paid = True).update(is_paid = False, status = 'cancel')
+            if refunded:
+                if BalanceEntry.objects.filter(order_id = order.pk, type_entry = 'refund').exists():
+                    raise AlreadyInLedger(order.pk)
+                payment = BalanceEntry.objects.filter(order_id = order.pk, type_entry = 'payment').values_list(
+                    'user_id', 'amount').first()
+                if payment:
+                    user_id, amount = payment[0], -payment[1]
+                else:
+                    # заказ оплачен до появления журнала
+                    user_id, amount = Order.objects.values_list('user_id', 'total_amount').get(pk = order.pk)
+                CustomUser.objects.filter(pk = user_id).update(balance = F('balance') + amount)
+                balance = CustomUser.objects.values_list('balance', flat = True).get(pk = user_id)
+                BalanceEntry.objects.create(user_id = user_id, order_id = order.pk, type_entry = 'refund',
+                    amount = amount, balance_after = balance)
+                if order.user is not None and order.user.pk == user_id:
+                    order.user.balance = balance
+            else:
+                Order.objects.filter(pk = order.pk).update(status = 'cancel')
+            key = Order.invoice_cache_key(order.pk)
+            transaction.on_commit(lambda: cache.delete(key))
+    except AlreadyInLedger:
+        return False
+    order.is_paid, order.status = False, 'cancel'
+    return True
@@ -0,0 +1,76 @@
+import bisect
+import logging
+
+from django.apps import apps
+
+from shop.process_cache import VersionedCache
+
+
+logger = logging.getLogger(__name__)
+
+
+def check_intervals(rows, with_gaps=True):
+    """ Проверка интервалов матрицы. rows - список (min_value, max_value, ...).
+    Возвращает список найденных проблем: пустые интервалы, пересечения и,
+    если with_gaps, разрывы между соседними интервалами. """
+    problems = []
+    prev = None
+    for row in sorted(rows, key=lambda row: (row[0], row[1])):
+        if row[0] >= row[1]:
+            problems.append(f'Пустой интервал {row[0]} - {row[1]}')
+            continue
+        if prev is not None:
+            if row[0] < prev[1]:
+                problems.append(f'Интервал {row[0]} - {row[1]} пересекается с {prev[0]} - {prev[1]}')
+                continue
+            if with_gaps and row[0] > prev[1]:
+                problems.append(f'Разрыв между {prev[1]} и {row[0]}')
+        prev = row
+    return problems
+
+
+class CompiledMatrix:
+    """ Неизменяемая таблица интервалов матрицы, отсортированная по min_value.
+    Поиск интервала для суммы - бинарный (bisect). """
+
+    __slots__ = ('lows', 'highs', 'types', 'values')
+
+    def __init__(self, rows):
+        lows, highs, types, values = [], [], [], []
+        for min_value, max_value, type_item, value in sorted(rows, key=lambda row: (row[0], row[1])):
+            if min_value >= max_value or (highs and min_value < highs[-1]):
+                continue
+            lows.append(min_value)
+            highs.append(max_value)
+            types.append(type_item)
+            values.append(value)
+        self.lows = tuple(lows)
+        self.highs = tuple(highs)
+        self.types = tuple(types)
+        self.values = tuple(values)
+
+    def cost(self, total_amount):
+        idx = bisect.bisect_right(self.lows, total_amount) - 1
+        if idx < 0 or total_amount >= self.highs[idx]:
+            return 0
+        cost_of_delivery = 0
+        if self.types[idx] == 'fixed':
+            cost_of_delivery = self.values[idx]
+        elif self.types[idx] == 'relative':
+            cost_of_delivery = total_amount / 100 * self.values[idx]
+        return round(cost_of_delivery, 2)
+
+
+def compile_matrix(matrix_id):
+    rows = list(apps.get_model('product', 'PriceMatrixItem').objects.filter(
+        matrix_id=matrix_id).values_list('min_value', 'max_value', 'type_item', 'value'))
+    for problem in check_intervals(rows):
+        logger.warning('PriceMatrix %s: %s', matrix_id, problem)
+    return CompiledMatrix(rows)
+
+
+matrices = VersionedCache('price_matrix', compile_matrix)
+
+
+def get_matrix(matrix_id):
+    return matrices.get(matrix_id)
@@ -0,0 +1,161 @@
+""" Рекомендации для страницы товара.
+    Списки считаются заранее задачей build_recommendations и хранятся
+    в ProductRecommendation (строка на товар):
+        recommended - товары с is_recommend из тех же категорий;
+        similar - товары тех же категорий с ценой в пределах 0.7 - 1.3 от цены товара,
+                  ближайшие по цене;
+        bought_together - [id, количество] из оплаченных заказов, по убыванию
+                          (считается матрицей совместных покупок, см. copurchase.py).
+    Страница товара читает одну строку по первичному ключу и берет карточки
+    из кэша; для товара без строки (новый товар) списки считаются запросами
+    на лету и не сохраняются - строку создаст следующий build_recommendations.
+    После оплаты заказа bought_together дополняется инкрементально.
+    Инкрементальное обновление приблизительное: хранится только top-K, поэтому
+    сосед, которого в списке не было, получает лишь количество из новых заказов.
+    Точные значения восстанавливает ночной полный пересчет (build_recommendations).
+"""
+from collections import Counter, defaultdict
+import random
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+
+from product import cards, copurchase
+from product.copurchase import PAID_STATUSES
+from product.models import OrderItem, Product, ProductRecommendation
+
+
+PRICE_RANGE = (0.7, 1.3)
+
+
+def nearest_by_price(ids, prices, idx, limit):
+    """ до limit соседей ids[idx] из отсортированного по цене списка, ближайшие по цене
+    и строго внутри PRICE_RANGE """
+    price = prices[idx]
+    low, high = price * PRICE_RANGE[0], price * PRICE_RANGE[1]
+    left, right = idx - 1, idx + 1
+    result = []
+    while len(result) < limit:
+        can_left = left >= 0 and prices[left] > low
+        can_right = right < len(ids) and prices[right] < high
+        if not can_left and not can_right:
+            break
+        if can_left and (not can_right or price - prices[left] <= prices[right] - price):
+            result.append(ids[left])
+            left -= 1
+        else:
+            result.append(ids[right])
+            right += 1
+    return result
+
+
+def build_category_lists():
+    """ {id товара: (recommended, similar)} для всех товаров одним проходом по категориям.
+    Рекомендуемые товары категории перед раздачей всем ее товарам ограничиваются
+    случайной выборкой из RECOMMEND_SIMILAR_LIMIT + 1 (сам товар потом исключается),
+    иначе работа растет как товары категории * рекомендуемые в ней """
+    products = {id: (price, is_recommend) for id, price, is_recommend in
+        Product.objects.values_list('id', 'price', 'is_recommend').iterator()}
+    categories = defaultdict(list)
+    for category_id, product_id in Product.cid.through.objects.values_list('categories_id', 'product_id').iterator():
+        categories[category_id].append(product_id)
+
+    recommended = defaultdict(set)
+    similar = defaultdict(list)
+    limit = settings.RECOMMEND_SIMILAR_LIMIT
+    for product_ids in categories.values():
+        # товары, добавленные между двумя запросами, попадут в следующий пересчет
+        product_ids = [id for id in product_ids if id in products]
+        category_recommended = [id for id in product_ids if products[id][1]]
+        if len(category_recommended) > limit + 1:
+            category_recommended = random.sample(category_recommended, limit + 1)
+        priced = sorted((products[id][0], id) for id in product_ids if products[id][0] is not None)
+        prices = [price for price, id in priced]
+        ids = [id for price, id in priced]
+        for idx, id in enumerate(ids):
+            similar[id] += nearest_by_price(ids, prices, idx, limit)
+        for id in product_ids:
+            recommended[id].update(category_recommended)
+
+    result = {}
+    for id in products:
+        rec = [rec_id for rec_id in recommended[id] if rec_id != id]
+        sim = list(dict.fromkeys(sim_id for sim_id in similar[id] if sim_id != id))
+        result[id] = (
+            random.sample(rec, min(len(rec), limit)),
+            sim[:limit],
+        )
+    return result
+
+
+def build_all():
+    """ полный пересчет рекомендаций всех товаров """
+    category_lists = build_category_lists()
+    together = copurchase.build()
+    rows = [
+        ProductRecommendation(product_id=id, recommended=rec, similar=sim, bought_together=together.get(id, []))
+        for id, (rec, sim) in category_lists.items()
+    ]
+    with transaction.atomic():
+        ProductRecommendation.objects.all().delete()
+        ProductRecommendation.objects.bulk_create(rows, batch_size=settings.RECOMMEND_BATCH_SIZE)
+    return {'products': len(rows), 'with_bought_together': len(together)}
+
+
+def build_for_product(product):
+    """ рекомендации одного товара запросами к базе - если строки еще нет (новый товар).
+    Возвращает несохраненный ProductRecommendation """
+    category_ids = list(product.cid.values_list('id', flat=True))
+    others = Product.objects.filter(cid__in=category_ids).exclude(pk=product.pk)
+    recommended = list(others.filter(is_recommend=True).values_list('id', flat=True).distinct()[:settings.RECOMMEND_SIMILAR_LIMIT])
+    similar = []
+    if product.price is not None:
+        candidates = others.filter(
+            price__gt=product.price*PRICE_RANGE[0],
+            price__lt=product.price*PRICE_RANGE[1]).values_list('id', 'price').distinct()
+        similar = [id for id, price in sorted(candidates, key=lambda row: abs(row[1] - product.price))]
+    bought_together = OrderItem.objects.filter(
+        order__in=OrderItem.objects.filter(product=product, order__status__in=PAID_STATUSES).values('order_id'),
+        product__isnull=False,
+    ).exclude(product=product).values('product').annotate(all_qty=Sum('qty')).order_by('-all_qty')
+    return ProductRecommendation(
+        product_id=product.pk,
+        recommended=recommended,
+        similar=similar[:settings.RECOMMEND_SIMILAR_LIMIT],
+        bought_together=[[row['product'], row['all_qty']] for row in bought_together[:settings.RECOMMEND_TOGETHER_LIMIT]],
+    )
+
+
+def add_orders(order_ids):
+    """ инкрементальное обновление bought_together после оплаты заказов.
+    Приблизительное: дельта прибавляется к сохраненному top-K, количества соседей,
+    не попавших в top-K, теряются до следующего build_all """
+    changes = copurchase.delta(order_ids)
+    if not changes:
+        return 0
+    with transaction.atomic():
+        rows = list(ProductRecommendation.objects.select_for_update().filter(product_id__in=changes))
+        for rec in rows:
+            counter = Counter({id: qty for id, qty in rec.bought_together})
+            for other_id, qty in changes[rec.product_id]:
+                counter[other_id] += qty
+            rec.bought_together = [list(pair) for pair in counter.most_common(settings.RECOMMEND_TOGETHER_LIMIT)]
+        ProductRecommendation.objects.bulk_update(rows, ['bought_together'])
+    return len(rows)
+
+
+def get_for_page(product, limit=5):
+    """ (рекомендуемые карточки, покупают вместе) для страницы товара """
+    rec = ProductRecommendation.objects.filter(product_id=product.pk).first() or build_for_product(product)
+    picked = random.sample(rec.recommended, min(1, len(rec.recommended)))
+    similar = [id for id in rec.similar if id not in picked]
+    picked += random.sample(similar, min(limit - len(picked), len(similar)))
+    together = rec.bought_together[:limit]
+    product_cards = cards.get_cards(picked + [id for id, qty in together])
+    recommend = [product_cards[id] for id in picked if id in product_cards]
+    buy_together = [
+        {'product': id, 'product__title': product_cards[id]['title'], 'all_qty': qty}
+        for id, qty in together if id in product_cards
+    ]
+    return recommend, buy_together
@@ -0,0 +1,153 @@
+""" Полнотекстовый поиск по товарам.
+    Бэкенд выбирается по СУБД (или задается в settings.PRODUCT_SEARCH_BACKEND):
+    SQLite - виртуальная таблица FTS5, PostgreSQL - колонка tsvector с GIN-индексом,
+    остальные - обычный icontains. Индекс обновляется из сигналов Product,
+    для массовых изменений есть index_many() и rebuild().
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+
+SEARCH_FIELDS = ('title', 'desc')
+
+
+def split_words(text):
+    return re.findall(r'\w+', text or '')
+
+
+class BaseSearchBackend:
+    """ Поиск без индекса: все слова запроса должны встречаться в полях. """
+
+    def index_many(self, product_ids):
+        pass
+
+    def remove(self, product_id):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def search(self, queryset, text, fields=SEARCH_FIELDS):
+        words = split_words(text)
+        if not words:
+            return queryset.none()
+        for word in words:
+            condition = Q()
+            for field in fields:
+                condition |= Q(**{f'{field}__icontains': word})
+            queryset = queryset.filter(condition)
+        return queryset
+
+
+class SqliteSearchBackend(BaseSearchBackend):
+    table = 'product_product_fts'
+    columns = {'title': 'title', 'desc': 'description'}
+
+    def index_many(self, product_ids):
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid IN ({placeholders})', product_ids)
+            cursor.execute(
+                f'INSERT INTO {self.table} (rowid, title, description) '
+                f'SELECT id, title, "desc" FROM product_product WHERE id IN ({placeholders})',
+                product_ids)
+
+    def remove(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE rowid = %s', [product_id])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+            cursor.execute(
+                f'INSERT INTO {self.table} (rowid, title, description) '
+                f'SELECT id, title, "desc" FROM product_product')
+
+    def match_query(self, words, fields):
+        columns = ' '.join(self.columns[field] for field in fields)
+        terms = ' '.join(f'"{word}"*' for word in words)
+        return f'{{{columns}}} : ({terms})'
+
+    def search(self, queryset, text, fields=SEARCH_FIELDS):
+        words = split_words(text)
+        if not words:
+            return queryset.none()
+        query = self.match_query(words, fields)
+        if self.table in queryset.query.extra_tables:
+            # второе условие поиска (in_title + in_desc) - подзапросом, ранг остается от первого
+            return queryset.filter(RawSQL(
+                f'"product_product"."id" IN (SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s)',
+                [query], output_field=BooleanField(),
+            ))
+        # JOIN с FTS-таблицей: MATCH и bm25() считаются за один проход индекса,
+        # коррелированный подзапрос для ранга повторял бы MATCH на каждую строку
+        return queryset.extra(
+            tables=[self.table],
+            where=[f'{self.table}.rowid = "product_product"."id"', f'{self.table} MATCH %s'],
+            params=[query],
+            select={'search_rank': f'bm25({self.table})'},
+        ).order_by('search_rank', 'id')
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    weights = {'title': 'A', 'desc': 'B'}
+    vector = (
+        "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('simple', coalesce(\"desc\", '')), 'B')"
+    )
+
+    def index_many(self, product_ids):
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE product_product SET search_vector = {self.vector} WHERE id = ANY(%s)',
+                [product_ids])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'UPDATE product_product SET search_vector = {self.vector}')
+
+    def search(self, queryset, text, fields=SEARCH_FIELDS):
+        words = split_words(text)
+        if not words:
+            return queryset.none()
+        labels = ''.join(self.weights[field] for field in fields)
+        query = ' & '.join(f'{word}:*{labels}' for word in words)
+        return queryset.filter(RawSQL(
+            "\"product_product\".\"search_vector\" @@ to_tsquery('simple', %s)",
+            [query], output_field=BooleanField(),
+        )).annotate(search_rank=RawSQL(
+            "ts_rank(\"product_product\".\"search_vector\", to_tsquery('simple', %s))",
+            [query], output_field=FloatField(),
+        )).order_by('-search_rank', 'id')
+
+
+BACKENDS = {
+    'sqlite': SqliteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'PRODUCT_SEARCH_BACKEND', None)
+        backend_class = import_string(path) if path else BACKENDS.get(connection.vendor, BaseSearchBackend)
+        _backend = backend_class()
+    return _backend
+
+
+def search_products(queryset, text, fields=SEARCH_FIELDS):
+    return get_backend().search(queryset, text, fields)
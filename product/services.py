@@ -11,14 +11,29 @@ import apiclient.discovery
 from oauth2client.service_account import ServiceAccountCredentials
 from googleapiclient.errors import HttpError
 import datetime
+import time
+import logging
 from django.forms.models import model_to_dict
 from django.shortcuts import get_object_or_404
+from django.http import Http404
+from django.db import transaction, IntegrityError
+from django.db.models import Count, F, FloatField, Func, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
 from dotenv import load_dotenv
 load_dotenv()
 import os
 
 from shop.storage_backends import MediaStorage
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
+from django.utils.crypto import get_random_string
+from collections import defaultdict
+from itertools import islice
+import tempfile
+from product import cards, novaposhta, search
+from accounts import tasks as acc_tasks
+
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -26,57 +41,116 @@ from django.core.files.base import ContentFile
 class Basket:
 
     def get_basket(user_id = None):
+        """ корзина пользователя одним запросом, без загрузки самих товаров """
         basket = {}
         if user_id:
-            user = get_object_or_404(CustomUser, id = user_id)
-            basket_obj = BasketItem.objects.filter(user_id = user)
-            full_sum = 0 
-            for i in basket_obj:
-                basket[str(i.product.id)] = {
-                    'id': i.product.id,
-                    'title': i.product.title,
-                    'type_product':i.product.type_product,
-                    'qty': i.qty,
-                    'price': i.price,
+            basket_items = BasketItem.objects.filter(user_id = user_id, product__isnull = False).values_list(
+                'product_id', 'product__title', 'product__type_product', 'qty', 'price').order_by('id')
+            for product_id, title, type_product, qty, price in basket_items:
+                basket[str(product_id)] = {
+                    'id': product_id,
+                    'title': title,
+                    'type_product': type_product,
+                    'qty': qty,
+                    'price': price,
+                }
+        return basket
+
+    def get_session_basket(session):
+        """ корзина анонимного пользователя: в сессии хранится только {id товара: количество},
+        остальное берется из карточек товаров """
+        items = Basket.session_items(session)
+        product_cards = cards.get_cards(items)
+        basket = {}
+        for product_id, qty in items.items():
+            card = product_cards.get(int(product_id))
+            if card:
+                basket[product_id] = {
+                    'id': card['id'],
+                    'title': card['title'],
+                    'type_product': card['type_product'],
+                    'qty': qty,
+                    'price': card['price'],
                 }
-                full_sum += i.qty * i.price
         return basket
+
+    def session_items(session):
+        items = session.get('basket', {})
+        # старый формат сессии: {id: {'id', 'title', 'qty', ...}}
+        return {str(product_id): item['qty'] if isinstance(item, dict) else item for product_id, item in items.items()}
+
+    def save_session_basket(session, basket):
+        """ сессия сохраняется только если корзина изменилась """
+        items = {product_id: good['qty'] for product_id, good in basket.items()}
+        if session.get('basket') != items:
+            session['basket'] = items
+
+    def get_request_basket(request):
+        if request.user.is_authenticated:
+            return Basket.get_basket(request.user.id)
+        return Basket.get_session_basket(request.session)
+
+    def get_total(user_id):
+        return BasketItem.objects.filter(user_id = user_id).get_total_amount()
     
     def add2basket(basket, product_id, qty, user_id = None, _type = 'add'):
-        product = get_object_or_404(Product, id = product_id)
-        product_info = model_to_dict(product)
-        del(product_info['cid'])
-        del(product_info['photo'])
-        del(product_info['file_digit'])
-        if not basket.get(str(product_id)):
+        product_info = basket.get(str(product_id))
+        if not product_info:
+            product_info = Product.objects.filter(id = product_id).values('id', 'title', 'type_product', 'price').first()
+            if not product_info:
+                raise Http404
             basket[str(product_id)] = product_info
-        now_qty = basket[str(product_id)].get('qty', 0)
+        now_qty = product_info.get('qty', 0)
         end_qty = 1
         if _type == 'add':
             end_qty = now_qty + int(qty)
         elif _type == 'edit':
             end_qty = int(qty)
-        basket[str(product_id)]['qty'] = end_qty
+        product_info['qty'] = end_qty
         if user_id:
-            bsk, create_basket = BasketItem.objects.get_or_create(
-                user = CustomUser.objects.get(id = user_id),
-                product = product,
-                defaults = {'qty' : end_qty,
-                    'price' : product.price,})
-            if not create_basket:
-                bsk.qty = end_qty
-                bsk.save()
+            new_qty = F('qty') + int(qty) if _type == 'add' else end_qty
+            basket_item = BasketItem.objects.filter(user_id = user_id, product_id = product_info['id'])
+            if not basket_item.update(qty = new_qty):
+                try:
+                    with transaction.atomic():
+                        BasketItem.objects.create(user_id = user_id, product_id = product_info['id'],
+                            qty = end_qty, price = product_info['price'])
+                except IntegrityError:
+                    basket_item.update(qty = new_qty)
         return basket
 
 
     def del2basket(basket, product_id, user_id = None):
-        del(basket[str(product_id)])
+        basket.pop(str(product_id), None)
         if user_id:
-            product = Product.objects.get(id = product_id)
-            BasketItem.objects.filter(user = CustomUser.objects.get(id = user_id), product=product).delete()
+            BasketItem.objects.filter(user_id = user_id, product_id = product_id).delete()
         return basket
 
 class OrderServise:
+
+    def fill_order_from_basket(order, basket):
+        """ Наполнение нового заказа товарами из корзины за один проход:
+            один запрос на все товары корзины, один bulk_create позиций
+            и один пересчет итогов/доставки. Вызывать внутри transaction.atomic.
+        """
+        products = Product.objects.in_bulk([int(good['id']) for good in basket.values()])
+        order_items = []
+        for good in basket.values():
+            product = products.get(int(good['id']))
+            if not product:
+                continue
+            order_items.append(OrderItem(
+                order=order,
+                product=product,
+                id_good=product.id,
+                title_good=product.title,
+                qty=good['qty'],
+                cost=product.price,
+            ))
+        OrderItem.objects.bulk_create(order_items)
+        order.recalc_order(order_items)
+        return order_items
+
     def filter_order(data):
         filter_order = {}
         date_default = {}
@@ -101,9 +175,60 @@ class OrderServise:
         
         return filter_order
 
+    def invoice_data(order):
+        """ неизменяемая часть страницы заказа: позиции (с товаром одним JOIN),
+        ссылки на файлы оплаченного заказа и адрес отделения (с городом одним JOIN).
+        Для завершенных и отмененных заказов хранится в кэше """
+        cacheable = order.status in Order.FINAL_STATUSES
+        if cacheable:
+            data = cache.get(Order.invoice_cache_key(order.pk))
+            if data is not None:
+                return data
+        goods = list(order.orderitem_set.order_by('id').values(
+            'id', 'product_id', 'title_good', 'cost', 'qty', 'product__type_product', 'product__file_digit'))
+        digital = {}
+        if order.status == 'paid':
+            storage = Product._meta.get_field('file_digit').storage
+            digital = {good['title_good']: storage.url(good['product__file_digit']) for good in goods
+                if good['product__type_product'] == 'file' and good['product__file_digit']}
+        delivery_department = None
+        if order.delivery_department:
+            warehouse = DeliveryWarehousesNP.objects.filter(ref_warehouse = order.delivery_department).values_list(
+                'city__city', 'description_ru').first()
+            if warehouse:
+                delivery_department = f'{warehouse[0]}, <br>{warehouse[1]}'
+        data = {'goods': goods, 'digital': digital, 'delivery_department': delivery_department}
+        if cacheable:
+            cache.set(Order.invoice_cache_key(order.pk), data, settings.INVOICE_CACHE_TTL)
+        return data
+
+    def list_orders(filter_order):
+        """ заказы для списка: связанные объекты одним JOIN, количество и сумма
+        позиций - подзапросами, которые считаются только для строк страницы """
+        items = OrderItem.objects.filter(order = OuterRef('pk')).order_by().values('order')
+        return Order.objects.filter(**filter_order).select_related(
+            'user', 'currency', 'promo', 'delivery_method', 'courier',
+        ).annotate(
+            items_count = Coalesce(Subquery(items.annotate(cnt = Count('id')).values('cnt')), 0),
+            items_total = Coalesce(Subquery(items.annotate(total = Sum(
+                F('qty') * F('cost'), output_field = FloatField())).values('total')), 0.0),
+        )
+
 
 class ProductServices:
 
+    def viewed_products(session, product_id, limit = 6):
+        """ В сессии - список id последних просмотренных товаров.
+        Добавляет product_id и возвращает карточки ранее просмотренных, начиная с последнего """
+        viewed = session.get('viewed_products', [])
+        if isinstance(viewed, dict):
+            viewed = [int(id) for id in viewed]
+        previous = [id for id in viewed if id != product_id][-(limit - 1):]
+        if previous + [product_id] != viewed:
+            session['viewed_products'] = previous + [product_id]
+        product_cards = cards.get_cards(previous)
+        return [product_cards[id] for id in reversed(previous) if id in product_cards]
+
     def filter_product(data):
         filter_product = {}
         if data.get('pid'):
@@ -117,95 +242,62 @@ class ProductServices:
             filter_product['price__lte'] = data.get('max_price')         
         return filter_product
 
-    def export_to_file(type_file):
-        if type_file == 'csv':
-            with open('export.csv', 'w', newline='',encoding='utf-8') as f:
-                export_file = csv.DictWriter(f, fieldnames = [
-                    'Название',
-                    'Остаток',
-                    'Бренд',
-                    'Описание',
-                    'Артикул',
-                    'Цена',
-                    'Старая цена',
-                    'Категория',
-                ], delimiter = '|')
-
-                export_file.writeheader()
-
-                all_products = Product.objects.all()
-                for item in all_products:
-                    all_categories = item.cid.all()
-                    lst_categories = []
-                    for i in all_categories:
-                        lst_categories.append(i.name)
-                    export_file.writerow({
-                        'Название':item.title,
-                        'Остаток':item.stock,
-                        'Бренд':item.brand,
-                        'Описание':item.desc,
-                        'Артикул':item.vendor_code,
-                        'Цена':item.price,
-                        'Старая цена':item.old_price,
-                        'Категория':';'.join(lst_categories),
-                    })
-
-            csv_file = MediaStorage().save(name = 'export.csv', content = ContentFile(open('export.csv', 'rb').read()))
-            if csv_file:
-                return MediaStorage().url(csv_file)
-            else:
-                return None
-        elif type_file == 'xlsx':
-            workbook = xlsxwriter.Workbook('price.xlsx')
-            worksheet = workbook.add_worksheet()
-            # Some data we want to write to the worksheet.
-            data_for_export = (
-                ['Название',
-                'Остаток',
-                'Бренд',
-                'Описание',
-                'Артикул',
-                'Цена',
-                'Старая цена',
-                'Категория'],
-            )
-
-            row = 0
-            col = 0
-
-            all_products = Product.objects.all()
-            for item in all_products:
-                all_categories = item.cid.all()
-                lst_categories = []
-                for i in all_categories:
-                    lst_categories.append(i.name)
-                data_for_export = data_for_export + ([
-                    item.title,
-                    item.stock,
-                    item.brand,
-                    item.desc,
-                    item.vendor_code,
-                    item.price,
-                    item.old_price,
-                    ';'.join(lst_categories),
-                ],)
-
-            for nm, st, br, ds, vn, pr, oldpr, cat in (data_for_export):
-                worksheet.write(row, col,     nm)
-                worksheet.write(row, col + 1, st)
-                worksheet.write(row, col + 2, br)
-                worksheet.write(row, col + 3, ds)
-                worksheet.write(row, col + 4, vn)
-                worksheet.write(row, col + 5, pr)
-                worksheet.write(row, col + 6, oldpr)
-                worksheet.write(row, col + 7, cat)
-                row += 1
-            workbook.close()
-            xlsx_file = MediaStorage().save(name = 'price.xlsx', content = ContentFile(open('export.csv', 'rb').read()))
-            if xlsx_file:
-                return MediaStorage().url(xlsx_file)
-            else:
-                return None
+    EXPORT_HEADER = ['Название', 'Остаток', 'Бренд', 'Описание', 'Артикул', 'Цена', 'Старая цена', 'Категория']
+
+    def iter_export_rows(chunk_size):
+        """ строки прайса для экспорта. Товары читаются итератором пачками по
+        chunk_size, категории пачки - одним запросом к промежуточной таблице """
+        category_names = dict(Categories.objects.values_list('id', 'name'))
+        products = Product.objects.order_by('id').values_list(
+            'id', 'title', 'stock', 'brand', 'desc', 'vendor_code', 'price', 'old_price',
+        ).iterator(chunk_size=chunk_size)
+        while True:
+            chunk = list(islice(products, chunk_size))
+            if not chunk:
+                return
+            product_categories = defaultdict(list)
+            for product_id, category_id in Product.cid.through.objects.filter(
+                    product_id__in=[row[0] for row in chunk]).values_list('product_id', 'categories_id'):
+                product_categories[product_id].append(category_names.get(category_id, ''))
+            for product_id, *fields in chunk:
+                yield fields + [';'.join(product_categories[product_id])]
+
+    def export_to_file(type_file, progress=None):
+        """ выгрузка прайса в csv/xlsx во временный файл и загрузка в MediaStorage.
+        progress(done, total) - вызывается после каждой пачки товаров """
+        if type_file not in ('csv', 'xlsx'):
+            return None
+        chunk_size = settings.EXPORT_CHUNK_SIZE
+        total = Product.objects.count()
+        rows = ProductServices.iter_export_rows(chunk_size)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, f'price.{type_file}')
+            if type_file == 'csv':
+                with open(path, 'w', newline='', encoding='utf-8') as f:
+                    export_file = csv.writer(f, delimiter = '|')
+                    export_file.writerow(ProductServices.EXPORT_HEADER)
+                    for done, row in enumerate(rows, 1):
+                        export_file.writerow(row)
+                        if progress and done % chunk_size == 0:
+                            progress(done, total)
+            elif type_file == 'xlsx':
+                workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+                worksheet = workbook.add_worksheet()
+                worksheet.write_row(0, 0, ProductServices.EXPORT_HEADER)
+                for done, row in enumerate(rows, 1):
+                    worksheet.write_row(done, 0, row)
+                    if progress and done % chunk_size == 0:
+                        progress(done, total)
+                workbook.close()
+
+            name = f'export/price_{datetime.datetime.now():%Y%m%d_%H%M%S}_{get_random_string(6)}.{type_file}'
+            with open(path, 'rb') as f:
+                export_file_name = MediaStorage().save(name = name, content = File(f))
+        if progress:
+            progress(total, total)
+        if export_file_name:
+            return MediaStorage().url(export_file_name)
+        return None
 
 
     def data_preparation_edit_price(lst_data) -> dict :
@@ -243,39 +335,82 @@ class ProductServices:
         return Product.objects.filter(cid__pk__in = lts_categories)
 
 
-    def edit_price_products(lst_cats, type_edit: str, value_edit: float, is_edit_old_price = False):
-        products = ProductServices.get_all_products_in_categories(lst_cats)
-        for product in products:
-            new_price = product.price
-            if type_edit == 'fix':
-                new_price = product.price + value_edit
-            elif type_edit == 'relative':
-                new_price = product.price + product.price * value_edit/100
-            new_price = new_price if new_price>= 0 else 0
+    def price_expression(type_edit: str, value_edit: float):
+        """ новая цена в виде SQL-выражения: округление до копеек, не меньше нуля """
+        if type_edit == 'fix':
+            new_price = F('price') + value_edit
+        elif type_edit == 'relative':
+            new_price = F('price') + F('price') * (value_edit / 100)
+        else:
+            new_price = F('price')
+        return RoundPrice(Greatest(new_price, Value(0.0)))
+
+
+    def edit_price_products(lst_cats, type_edit: str, value_edit: float, is_edit_old_price = False, dry_run = False):
+        """ Массовое изменение цен товаров категорий.
+            Цены меняются одним UPDATE на пачку из REPRICE_BATCH_SIZE товаров,
+            уведомления подписчикам - через события изменения товаров (product/changes.py).
+            dry_run - ничего не менять, вернуть список изменений цен
+        """
+        new_price = ProductServices.price_expression(type_edit, value_edit)
+        product_ids = list(ProductServices.get_all_products_in_categories(lst_cats).filter(
+            price__isnull = False).values_list('id', flat = True).distinct().order_by('id'))
+        stats = {'products': len(product_ids), 'changed': 0}
+        diff = []
+        ids_iter = iter(product_ids)
+        for batch in iter(lambda: list(islice(ids_iter, settings.REPRICE_BATCH_SIZE)), []):
+            if dry_run:
+                changed = list(Product.objects.filter(id__in = batch).annotate(new_price = new_price).exclude(
+                    price = F('new_price')).values_list('id', 'title', 'price', 'new_price'))
+                stats['changed'] += len(changed)
+                diff += [{'id': id, 'title': title, 'price': price, 'new_price': price_new}
+                    for id, title, price, price_new in changed]
+                continue
 
+            fields = {'price': new_price, 'date_edit': datetime.datetime.now()}
             if is_edit_old_price:
-                product.old_price = product.price
-            
-            product.price = new_price
-            product.save()
+                fields['old_price'] = F('price')
+            stats['changed'] += Product.objects.filter(id__in = batch).exclude(
+                price = new_price).update_with_events(**fields)
+
+        if dry_run:
+            return diff
+        return stats
+
+
+
+class RoundPrice(Func):
+    """ ROUND(x, 2); в PostgreSQL round с точностью есть только для numeric """
+    function = 'ROUND'
+    template = '%(function)s(%(expressions)s, 2)'
+    output_field = FloatField()
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template = '%(function)s((%(expressions)s)::numeric, 2)', **extra_context)
+
 
 
 class ImportSheet:
 
-    def is_correct_link(link):
+    IMPORT_FIELDS = ['brand', 'desc', 'vendor_code', 'price', 'old_price', 'stock']
+
+    def get_service():
         CREDENTIALS_FILE = 'creds.json'
-        spreadsheet_id = ''
-        re_sheet_id = re.search(r'spreadsheets/d/(.*)/', link)
-        if re_sheet_id:
-            spreadsheet_id = re_sheet_id.group(1)
         credentials = ServiceAccountCredentials.from_json_keyfile_name(
             CREDENTIALS_FILE, 
             ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive'])
         httpAuth = credentials.authorize(httplib2.Http())
-        service = apiclient.discovery.build('sheets', 'v4', http=httpAuth)
+        return apiclient.discovery.build('sheets', 'v4', http=httpAuth)
+
+    def get_spreadsheet_id(link):
+        re_sheet_id = re.search(r'spreadsheets/d/(.*)/', link)
+        return re_sheet_id.group(1) if re_sheet_id else ''
+
+    def is_correct_link(link):
+        service = ImportSheet.get_service()
         try:
             values = service.spreadsheets().values().get(
-                spreadsheetId = spreadsheet_id,
+                spreadsheetId = ImportSheet.get_spreadsheet_id(link),
                 range = 'A1:Z20',
                 majorDimension = 'ROWS'
             ).execute()
@@ -283,60 +418,149 @@ class ImportSheet:
         except HttpError:
             return False
 
-    def import_from_gsheets(link, preview = False):
-        CREDENTIALS_FILE = 'creds.json'
-        spreadsheet_id = ''
-        cnt_rows = 10 if preview else 9999
-        re_sheet_id = re.search(r'spreadsheets/d/(.*)/', link)
-        if re_sheet_id:
-            spreadsheet_id = re_sheet_id.group(1)
-
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-            CREDENTIALS_FILE, 
-            ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive'])
-
-        httpAuth = credentials.authorize(httplib2.Http())
-        service = apiclient.discovery.build('sheets', 'v4', http=httpAuth)
-
-        values = service.spreadsheets().values().get(
-            spreadsheetId = spreadsheet_id,
-            range = f'A1:Z{cnt_rows}',
-            majorDimension = 'ROWS'
-        ).execute()
+    def iter_gsheets_rows(link, max_rows = None):
+        """ строки таблицы, запрашиваются диапазонами по IMPORT_PAGE_SIZE строк """
+        service = ImportSheet.get_service()
+        spreadsheet_id = ImportSheet.get_spreadsheet_id(link)
+        page_size = settings.IMPORT_PAGE_SIZE
+        start = 1
+        while max_rows is None or start <= max_rows:
+            end = start + page_size - 1
+            if max_rows is not None:
+                end = min(end, max_rows)
+            values = service.spreadsheets().values().get(
+                spreadsheetId = spreadsheet_id,
+                range = f'A{start}:H{end}',
+                majorDimension = 'ROWS'
+            ).execute()
+            rows = values.get('values', [])
+            yield from rows
+            if len(rows) < end - start + 1:
+                return
+            start = end + 1
+
+    def iter_file_rows(path):
+        """ строки из локального файла (csv с разделителем "," или json-список строк)
+        в том же порядке колонок, что и в таблице """
+        if path.endswith('.json'):
+            with open(path, encoding='utf-8') as f:
+                yield from json.load(f)
+        else:
+            with open(path, newline='', encoding='utf-8') as f:
+                yield from csv.reader(f)
 
-        gsheets_values = values.get('values')
-        gsheets_values = ImportSheet.preparation_for_import_gsheets(gsheets_values)
+    def import_from_gsheets(link, preview = False):
         if preview:
-            return gsheets_values
-        for row in gsheets_values:
-            if row[0] and row[1]:
-                price = float(row[5])
-                old_price = float(row[6])
-                stock = int(row[7])
-                category_exists = Categories.objects.filter(name=row[0]).exists()
-                category = Categories.objects.get(name = row[0]) if category_exists else Categories(name = row[0]).save()
-                default_data = {
-                    'brand':row[2],
-                    'desc' : row[3],
-                    'vendor_code' : row[4],
-                    'price' : price,
-                    'old_price' : old_price,
-                    'stock' : stock,
-                }
-                product_obj, product_new = Product.objects.get_or_create(title = row[1], defaults = default_data)
-                if product_new:
-                    product_obj.cid.add(category)
-                else:
-                    product_obj.cid.set([category])
+            return ImportSheet.preparation_for_import_gsheets(
+                list(ImportSheet.iter_gsheets_rows(link, max_rows = 10)))
+        return ImportSheet.import_rows(ImportSheet.iter_gsheets_rows(link))
 
-                product_obj.brand = row[2]
-                product_obj.desc = row[3]
-                product_obj.vendor_code = row[4]
-                product_obj.price = price
-                product_obj.old_price = old_price
-                product_obj.stock = stock
-                product_obj.save()
+    def import_from_file(path):
+        return ImportSheet.import_rows(ImportSheet.iter_file_rows(path))
 
+    def parse_row(row):
+        row = ImportSheet.preparation_for_import_gsheets([list(row)])[0]
+        if not row[0] or not row[1]:
+            return None
+        try:
+            price = round(float(row[5]), 2)
+            old_price = round(float(row[6]), 2)
+            stock = int(row[7])
+        except ValueError:
+            return None
+        return {
+            'category': row[0],
+            'title': row[1],
+            'brand': row[2],
+            'desc': row[3],
+            'vendor_code': row[4],
+            'price': price,
+            'old_price': old_price,
+            'stock': stock,
+        }
+
+    def import_rows(rows):
+        """ импорт прайса пачками по IMPORT_BATCH_SIZE строк """
+        stats = {'rows': 0, 'created': 0, 'updated': 0, 'skipped': 0}
+        batch = []
+        for row in rows:
+            stats['rows'] += 1
+            item = ImportSheet.parse_row(row)
+            if item is None:
+                stats['skipped'] += 1
+                continue
+            batch.append(item)
+            if len(batch) >= settings.IMPORT_BATCH_SIZE:
+                ImportSheet.apply_batch(batch, stats)
+                batch = []
+        if batch:
+            ImportSheet.apply_batch(batch, stats)
+        return stats
+
+    def apply_batch(items, stats, fields = None):
+        """ категории и товары пачки загружаются одним запросом каждые, дальше
+        считается разница с прайсом и применяется через bulk_create/bulk_update.
+        Категория товара заменяется на указанную в прайсе.
+        fields - обновляемые поля товара (по умолчанию IMPORT_FIELDS) """
+        fields = fields or ImportSheet.IMPORT_FIELDS
+        items = list({item['title']: item for item in items}.values())
+        with transaction.atomic():
+            category_ids = ImportSheet.get_category_ids({item['category'] for item in items})
+
+            products = {}
+            for product in Product.objects.filter(title__in=[item['title'] for item in items]).order_by('-id'):
+                products.setdefault(product.title, product)
+            now = datetime.datetime.now()
+            to_create = []
+            to_update = []
+            for item in items:
+                product = products.get(item['title'])
+                if product is None:
+                    to_create.append(Product(title=item['title'], **{field: item[field] for field in fields}))
+                elif any(getattr(product, field) != item[field] for field in fields):
+                    for field in fields:
+                        setattr(product, field, item[field])
+                    product.date_edit = now
+                    to_update.append(product)
+
+            Product.objects.bulk_create(to_create, batch_size=settings.IMPORT_BATCH_SIZE)
+            Product.objects.bulk_update_with_events(to_update, fields + ['date_edit'], batch_size=settings.IMPORT_BATCH_SIZE)
+            product_ids = {title: product.id for title, product in products.items()}
+            if to_create:
+                product_ids.update(Product.objects.filter(
+                    title__in=[product.title for product in to_create]).values_list('title', 'id'))
+
+            product_category = {product_ids[item['title']]: category_ids[item['category']] for item in items}
+            ImportSheet.set_categories(product_category)
+            search.get_backend().index_many(
+                [product_ids[product.title] for product in to_create] + [product.id for product in to_update])
+        stats['created'] += len(to_create)
+        stats['updated'] += len(to_update)
+
+    def get_category_ids(names):
+        category_ids = dict(Categories.objects.filter(name__in=names).values_list('name', 'id'))
+        missing = [name for name in names if name not in category_ids]
+        if missing:
+            Categories.objects.bulk_create([Categories(name=name) for name in missing], ignore_conflicts=True)
+            category_ids.update(Categories.objects.filter(name__in=missing).values_list('name', 'id'))
+        return category_ids
+
+    def set_categories(product_category):
+        """ product_category - {id товара: id категории} """
+        through = Product.cid.through
+        existing = through.objects.filter(product_id__in=product_category).values_list('id', 'product_id', 'categories_id')
+        to_delete = []
+        exists = set()
+        for pk, product_id, category_id in existing:
+            if product_category[product_id] == category_id:
+                exists.add(product_id)
+            else:
+                to_delete.append(pk)
+        through.objects.filter(pk__in=to_delete).delete()
+        through.objects.bulk_create([
+            through(product_id=product_id, categories_id=category_id)
+            for product_id, category_id in product_category.items() if product_id not in exists
+        ], batch_size=settings.IMPORT_BATCH_SIZE, ignore_conflicts=True)
 
     def preparation_for_import_gsheets(data_lst):
         """ дополнить все элементы пустыми значениями, чтобы все списки были равны по длине"""
@@ -419,64 +643,131 @@ class DeliveryFunc:
 
         
 
-def update_w():
-    link = 'https://api.novaposhta.ua/v2.0/json/'
-    data = (
-        '{"modelName": "AddressGeneral",'
-        '"calledMethod": "getWarehouses",'
-        '"methodProperties": {"Language": "ru"},'
-        f'"apiKey": "{os.environ.get("TOKEN_NP")}"}}'
-    )
-    headers = {'Content-Type':'application/json',}
-    req = requests.post(link, data=data, headers=headers)
-    responce = req.json()
-    cnt = 0
-    if responce.get('success'):
-        for item in responce['data']:
-            cnt+=1
-            print(cnt)
-            try:
-                city = DeliveryCitiesNP.objects.get(city_ref=item.get('CityRef'))
-            except:
-                print(item)
-                continue
-            item_ref =item.get('Ref')
-            data_warehouse = {
-                'city':city,
-                'sitekey':item.get('SiteKey'),
-                'description':item.get('Description'),
-                'description_ru':item.get('DescriptionRu'),
-                'short_address':item.get('ShortAddress'),
-                'short_address_ru':item.get('ShortAddressRu'),
-                'number_warehouse':item.get('Number'),
+class NovaPoshtaSync:
+    """ Синхронизация справочников городов и отделений Новой Почты.
+        Справочник выгружается из API постранично, существующие записи
+        загружаются одним запросом, изменения применяются пачками через
+        bulk_create/bulk_update, пропавшие в API записи удаляются в одной
+        транзакции. Если API вернул пустой справочник или меньше
+        NP_SYNC_MIN_KEEP_RATIO от записей в базе (ответ обрезан), удаление
+        пропускается: удаление города каскадно удаляет его отделения.
+    """
+
+    CITY_FIELDS = ['city', 'city_ua', 'region', 'region_ua', 'cityID']
+    WAREHOUSE_FIELDS = ['city_id', 'sitekey', 'description', 'description_ru',
+        'short_address', 'short_address_ru', 'number_warehouse']
+
+    def iter_pages(model_name, called_method, method_properties=None):
+        page = 1
+        limit = settings.NP_SYNC_PAGE_SIZE
+        while True:
+            responce = novaposhta.api_request(model_name, called_method, {
+                **(method_properties or {}),
+                'Page': page,
+                'Limit': limit,
+            })
+            if not responce.get('success'):
+                raise novaposhta.NovaPoshtaError(responce.get('errors'))
+            data = responce.get('data') or []
+            if data:
+                yield data
+            if len(data) < limit:
+                return
+            page += 1
+
+    def sync_rows(model, key_field, fields, pages, to_row, progress=None):
+        """ pages - итератор страниц API, to_row - преобразование записи API
+        в dict полей модели (None - запись пропускается). """
+        started = time.monotonic()
+        stats = {'rows': 0, 'created': 0, 'updated': 0, 'deleted': 0, 'skipped': 0}
+        batch_size = settings.NP_SYNC_BATCH_SIZE
+        existing = {}
+        duplicates = []
+        for pk, key, *values in model.objects.values_list('id', key_field, *fields).iterator():
+            if key in existing:
+                duplicates.append(pk)
+            else:
+                existing[key] = (pk, tuple(values))
+
+        seen = set()
+        to_create = []
+        to_update = []
+        for page in pages:
+            for item in page:
+                stats['rows'] += 1
+                row = to_row(item)
+                if row is None or row[key_field] in seen:
+                    stats['skipped'] += 1
+                    continue
+                key = row[key_field]
+                seen.add(key)
+                old = existing.get(key)
+                if old is None:
+                    to_create.append(model(**row))
+                elif old[1] != tuple(row[field] for field in fields):
+                    to_update.append(model(id=old[0], **row))
+            if len(to_create) >= batch_size:
+                model.objects.bulk_create(to_create, batch_size=batch_size)
+                stats['created'] += len(to_create)
+                to_create = []
+            if len(to_update) >= batch_size:
+                model.objects.bulk_update(to_update, fields, batch_size=batch_size)
+                stats['updated'] += len(to_update)
+                to_update = []
+            stats['seconds'] = round(time.monotonic() - started, 2)
+            stats['rows_per_sec'] = round(stats['rows'] / max(stats['seconds'], 0.01))
+            if progress:
+                progress(stats)
+
+        model.objects.bulk_create(to_create, batch_size=batch_size)
+        model.objects.bulk_update(to_update, fields, batch_size=batch_size)
+        stats['created'] += len(to_create)
+        stats['updated'] += len(to_update)
+
+        vanished = [pk for key, (pk, _) in existing.items() if key not in seen]
+        if not seen or len(seen) < len(existing) * settings.NP_SYNC_MIN_KEEP_RATIO:
+            logger.warning('%s: API returned %s of %s records, deletion skipped',
+                model.__name__, len(seen), len(existing))
+            stats['deletion_skipped'] = len(vanished)
+            vanished = []
+        vanished = duplicates + vanished
+        with transaction.atomic():
+            for start in range(0, len(vanished), batch_size):
+                model.objects.filter(pk__in=vanished[start:start + batch_size]).delete()
+        stats['deleted'] = len(vanished)
+        stats['seconds'] = round(time.monotonic() - started, 2)
+        stats['rows_per_sec'] = round(stats['rows'] / max(stats['seconds'], 0.01))
+        return stats
+
+    def sync_cities(progress=None):
+        def to_row(item):
+            return {
+                'city_ref': item['Ref'],
+                'city': item['DescriptionRu'],
+                'city_ua': item['Description'],
+                'region': item['AreaDescriptionRu'],
+                'region_ua': item['AreaDescription'],
+                'cityID': int(item['CityID'] or 0),
             }
-            DeliveryWarehousesNP.objects.update_or_create(
-                ref_warehouse=item_ref,
-                defaults = data_warehouse
-            )
-
-
-def update_c():
-    link = 'https://api.novaposhta.ua/v2.0/json/'
-    headers = {'Content-Type':'application/json',}
-    data = (
-        '{"modelName": "Address",'
-        '"calledMethod": "getCities",'
-        f'"apiKey": "{os.environ.get("TOKEN_NP")}"}}'
-    )
-    req = requests.post(link, data=data, headers=headers)
-    responce = req.json()
-    cnt = 0
-    if responce.get('success'):
-        for item in responce['data']:
-            cnt+=1
-            print(cnt)
-            city_ua = item['Description']
-            data_city = {
-                'city':item['DescriptionRu'],
-                'city_ref':item['Ref'],
-                'cityID':item['CityID'],
-                'region_ua':item['AreaDescription'],
-                'region':item['AreaDescriptionRu'],
+        pages = NovaPoshtaSync.iter_pages('Address', 'getCities')
+        return NovaPoshtaSync.sync_rows(DeliveryCitiesNP, 'city_ref', NovaPoshtaSync.CITY_FIELDS, pages, to_row, progress)
+
+    def sync_warehouses(progress=None):
+        cities = dict(DeliveryCitiesNP.objects.values_list('city_ref', 'id'))
+
+        def to_row(item):
+            city_id = cities.get(item.get('CityRef'))
+            if not city_id:
+                return None
+            return {
+                'ref_warehouse': item['Ref'],
+                'city_id': city_id,
+                'sitekey': int(item.get('SiteKey') or 0),
+                'description': item.get('Description') or '',
+                'description_ru': item.get('DescriptionRu') or '',
+                'short_address': item.get('ShortAddress') or '',
+                'short_address_ru': item.get('ShortAddressRu') or '',
+                'number_warehouse': int(item.get('Number') or 0),
             }
-            DeliveryCitiesNP.objects.update_or_create(city_ua=city_ua, defaults=data_city)
\ No newline at end of file
+        pages = NovaPoshtaSync.iter_pages('AddressGeneral', 'getWarehouses', {'Language': 'ru'})
+        return NovaPoshtaSync.sync_rows(DeliveryWarehousesNP, 'ref_warehouse', NovaPoshtaSync.WAREHOUSE_FIELDS, pages, to_row, progress)
@@ -1,22 +1,92 @@
 from shop.celery import app
-from product import services, parser_rozetka
+import logging
+from product import changes, services, recommendations, search
+from product import parser_rozetka as rozetka
+from product.models import RatingProduct
+
+
+logger = logging.getLogger(__name__)
 
 
 @app.task
 def edit_price_in_category(lst_cats, type_edit, value_edit, is_edit_old_price):
-    services.ProductServices.edit_price_products(
+    stats = services.ProductServices.edit_price_products(
             lst_cats=lst_cats,
             type_edit = type_edit, 
             value_edit = value_edit, 
             is_edit_old_price = is_edit_old_price
     )
+    logger.info('Prices edited in categories %s: %s', lst_cats, stats)
+    return stats
+
+
+@app.task(bind=True)
+def export_products(self, type_file):
+    return services.ProductServices.export_to_file(
+        type_file,
+        progress=lambda done, total: self.update_state(state='PROGRESS', meta={'done':done, 'total':total}))
 
 
 @app.task
 def import_from_gsheets(link):
-    services.ImportSheet.import_from_gsheets(link)
+    stats = services.ImportSheet.import_from_gsheets(link)
+    logger.info('Price imported from %s: %s', link, stats)
+    return stats
+
+
+@app.task
+def import_from_file(path):
+    return services.ImportSheet.import_from_file(path)
 
 
 @app.task
 def parser_rozetka(id_cat):
-    parser_rozetka.get_all_ids_goods(id_cat)
\ No newline at end of file
+    stats = rozetka.crawl_category(id_cat)
+    logger.info('Rozetka category %s parsed: %s', id_cat, stats)
+    return stats
+
+
+@app.task(bind=True)
+def sync_novaposhta_cities(self):
+    stats = services.NovaPoshtaSync.sync_cities(
+        progress=lambda stats: self.update_state(state='PROGRESS', meta=stats))
+    logger.info('Nova Poshta cities synced: %s', stats)
+    return stats
+
+
+@app.task(bind=True)
+def sync_novaposhta_warehouses(self):
+    stats = services.NovaPoshtaSync.sync_warehouses(
+        progress=lambda stats: self.update_state(state='PROGRESS', meta=stats))
+    logger.info('Nova Poshta warehouses synced: %s', stats)
+    return stats
+
+
+@app.task
+def rebuild_search_index():
+    search.get_backend().rebuild()
+
+
+@app.task
+def build_recommendations():
+    stats = recommendations.build_all()
+    logger.info('Recommendations built: %s', stats)
+    return stats
+
+
+@app.task
+def update_recommendations_for_order(id_order):
+    return recommendations.add_orders([id_order])
+
+
+@app.task
+def reconcile_ratings():
+    fixed = RatingProduct.reconcile()
+    if fixed:
+        logger.warning('Rating counters fixed for %s products', fixed)
+    return fixed
+
+
+@app.task
+def relay_product_events():
+    return changes.relay()
@@ -1,3 +1,1265 @@
-from django.test import TestCase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import json
+import threading
+import time
 
-# Create your tests here.
+import csv
+import datetime
+import os
+import random
+import tempfile
+import zipfile
+
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import Sum
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from django.contrib.auth.models import Group, Permission
+from unittest import mock
+
+from accounts.models import CustomUser
+from shop.context_processors import all_currency
+from shop.process_cache import VersionedCache
+from product import cards, changes, copurchase, currency, payments, novaposhta, parser_rozetka, price_matrix, recommendations, search, services, tasks
+from product.models import BalanceEntry, BasketItem, Categories, Currency, Delivery, DeliveryCitiesNP, DeliveryWarehousesNP, FileTelegram, Order, OrderItem, PriceMatrix, PriceMatrixItem, Product, ProductEvent, ProductRecommendation, Promocode, RatingProduct, SubActivateProduct, SubEditPrice
+from product.pagination import InvalidCursor, KeysetPaginator
+from product.views import select_curr
+
+
+class FakeServer:
+    """ локальный HTTP-сервер вместо внешнего API.
+    handler(method, path, body) -> (код ответа, тело: dict или bytes) """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                fake.requests.append((self.command, self.path, body))
+                status, payload = fake.handler(self.command, self.path, body)
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), 'test_data')
+
+
+def make_products(count, **kwargs):
+    return [Product.objects.create(title=f'Товар {i}', price=10 + i, **kwargs) for i in range(count)]
+
+
+class CheckoutQueriesTest(TestCase):
+    """ оформление заказа: число запросов не зависит от размера корзины """
+
+    def setUp(self):
+        self.user = CustomUser.objects.create(email='buyer@example.com')
+        self.currency = Currency.objects.get_or_create(code='UAH', defaults={'name': 'ГРН', 'rate': 1, 'disp': 'грн'})[0]
+        self.delivery = Delivery.objects.create(name='Самовывоз')
+        self.products = make_products(40)
+
+    def basket(self, size):
+        return {str(product.id): {'id': product.id, 'qty': 2} for product in self.products[:size]}
+
+    def fill_order(self, size):
+        order = Order.objects.create(user=self.user, currency=self.currency, delivery_method=self.delivery)
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                services.OrderServise.fill_order_from_basket(order, self.basket(size))
+        return order, len(queries)
+
+    def test_query_count_is_flat(self):
+        counts = {size: self.fill_order(size)[1] for size in (1, 10, 40)}
+        self.assertEqual(len(set(counts.values())), 1, counts)
+
+    def test_totals(self):
+        order, _queries = self.fill_order(3)
+        order.refresh_from_db()
+        self.assertEqual(order.orderitem_set.count(), 3)
+        self.assertEqual(order.full_amount, 2 * (10 + 11 + 12))
+        self.assertEqual(order.total_amount, order.full_amount)
+
+
+class OrderListTest(TestCase):
+    """ список заказов: суммы позиций подзапросами, страницы по курсору, кэш курьеров """
+
+    def setUp(self):
+        cache.delete(Order.COURIERS_CACHE_KEY)
+        self.user = CustomUser.objects.create(email='buyer@example.com')
+        self.currency = Currency.objects.get_or_create(code='UAH', defaults={'name': 'ГРН', 'rate': 1, 'disp': 'грн'})[0]
+        self.delivery = Delivery.objects.create(name='Самовывоз')
+        self.products = make_products(3)
+        self.orders = []
+        for i in range(7):
+            order = Order.objects.create(user=self.user, currency=self.currency, delivery_method=self.delivery,
+                status='new' if i % 2 else 'finished', total_amount=i * 10)
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=product, id_good=product.id, cost=product.price, qty=i)
+                for product in self.products[:i % 4]
+            ])
+            self.orders.append(order)
+        # одинаковая дата у части заказов - порядок внутри нее задает id
+        Order.objects.filter(pk__in=[order.pk for order in self.orders[2:5]]).update(
+            date_create=datetime.datetime(2021, 1, 1))
+
+    def test_aggregates(self):
+        orders = {order.pk: order for order in services.OrderServise.list_orders({})}
+        for order in self.orders:
+            items = OrderItem.objects.filter(order=order)
+            self.assertEqual(orders[order.pk].items_count, items.count())
+            self.assertEqual(orders[order.pk].items_total, sum(item.qty * item.cost for item in items))
+        self.assertEqual((orders[self.orders[0].pk].items_count, orders[self.orders[0].pk].items_total), (0, 0.0))
+        # 3 позиции по 3 шт.: 3 * (10 + 11 + 12)
+        self.assertEqual(orders[self.orders[3].pk].items_total, 99)
+
+    def test_filter(self):
+        orders = services.OrderServise.list_orders(services.OrderServise.filter_order({'status': 'new', 'min_amount': 20}))
+        self.assertEqual(sorted(order.pk for order in orders), [self.orders[3].pk, self.orders[5].pk])
+
+    def test_keyset_pages(self):
+        paginator = KeysetPaginator(services.OrderServise.list_orders({}), ('-date_create', '-id'), 3)
+        ids, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                page = paginator.page(cursor)
+                rows = [(order.pk, order.user.email, order.currency.code, order.delivery_method.name,
+                    order.items_count, order.items_total) for order in page]
+            ids += [row[0] for row in rows]
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        self.assertEqual(ids, list(Order.objects.order_by('-date_create', '-id').values_list('id', flat=True)))
+
+    def test_couriers_cache(self):
+        group = Group.objects.create(name='Courier')
+        courier = CustomUser.objects.create(email='courier@example.com')
+        courier.groups.add(group)
+        with self.assertNumQueries(1):
+            self.assertEqual(Order.couriers(), [{'pk': courier.pk, 'email': courier.email}])
+        with self.assertNumQueries(0):
+            Order.couriers()
+        other = CustomUser.objects.create(email='another@example.com')
+        other.groups.add(group)
+        self.assertEqual([row['email'] for row in Order.couriers()], ['another@example.com', 'courier@example.com'])
+        courier.groups.remove(group)
+        self.assertEqual([row['email'] for row in Order.couriers()], ['another@example.com'])
+        group.user_set.clear()
+        self.assertEqual(Order.couriers(), [])
+
+
+class NovaPoshtaQuoteTest(SimpleTestCase):
+    """ кэш расчетов доставки против локального сервера вместо API Новой Почты """
+
+    def price_handler(self, method, path, body):
+        time.sleep(self.delay)
+        if self.malformed:
+            return 200, {'success': True, 'data': []}
+        return 200, {'success': True, 'data': [{'Cost': json.loads(body)['methodProperties']['Cost']}]}
+
+    def setUp(self):
+        self.delay = 0
+        self.malformed = False
+        self.np = FakeServer(self.price_handler).__enter__()
+        override = override_settings(NP_API_URL=self.np.url)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(self.np.__exit__)
+        novaposhta.quote_cache.clear()
+
+    def test_cached_by_bucket(self):
+        self.assertEqual(novaposhta.get_delivery_cost('city-1', 120), '200')
+        self.assertEqual(novaposhta.get_delivery_cost('city-1', 180), '200')
+        self.assertEqual(len(self.np.requests), 1)
+
+    def test_concurrent_requests_coalesced(self):
+        self.delay = 0.2
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(novaposhta.get_delivery_cost('city-2', 50)))
+            for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['100'] * 10)
+        self.assertEqual(len(self.np.requests), 1)
+
+    def test_stale_served_while_refreshing(self):
+        cache = novaposhta.QuoteCache(maxsize=10, ttl=0.05, wait_timeout=1)
+        fetch = lambda: novaposhta.request_delivery_cost('city-3', 100, novaposhta.DEFAULT_PARCEL)
+        self.assertEqual(cache.get('key', fetch), '100')
+        time.sleep(0.1)
+        self.delay = 0.5
+        started = time.monotonic()
+        self.assertEqual(cache.get('key', fetch), '100')
+        self.assertLess(time.monotonic() - started, 0.3)
+        # фоновое обновление должно закончиться до остановки сервера
+        cache.inflight['key'].wait(2)
+
+    def test_malformed_response_releases_key(self):
+        self.malformed = True
+        with self.assertLogs('product.novaposhta', 'WARNING'):
+            self.assertFalse(novaposhta.get_delivery_cost('city-4', 100))
+        self.assertEqual(novaposhta.quote_cache.inflight, {})
+        self.malformed = False
+        started = time.monotonic()
+        self.assertEqual(novaposhta.get_delivery_cost('city-4', 100), '100')
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(len(self.np.requests), 2)
+
+
+def city(ref, name):
+    return {'Ref': ref, 'Description': name, 'DescriptionRu': name, 'AreaDescription': 'Область',
+        'AreaDescriptionRu': 'Область', 'CityID': '1'}
+
+
+@override_settings(NP_SYNC_PAGE_SIZE=2)
+class NovaPoshtaSyncTest(TestCase):
+    """ синхронизация справочников с локальным сервером вместо API Новой Почты """
+
+    def handler(self, method, path, body):
+        if self.failing:
+            return 200, {'success': False, 'errors': ['API key expired']}
+        request = json.loads(body)
+        properties = request['methodProperties']
+        data = self.cities if request['calledMethod'] == 'getCities' else self.warehouses
+        start = (properties['Page'] - 1) * properties['Limit']
+        return 200, {'success': True, 'data': data[start:start + properties['Limit']]}
+
+    def setUp(self):
+        self.failing = False
+        self.cities = [city(f'ref-{i}', f'Город {i}') for i in range(5)]
+        self.warehouses = [{'Ref': 'wh-1', 'CityRef': 'ref-1', 'Number': '7', 'Description': 'Отделение 7'},
+            {'Ref': 'wh-2', 'CityRef': 'unknown', 'Number': '8'}]
+        self.np = FakeServer(self.handler).__enter__()
+        self.addCleanup(self.np.__exit__)
+        override = override_settings(NP_API_URL=self.np.url)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_sync(self):
+        stats = services.NovaPoshtaSync.sync_cities()
+        self.assertEqual((stats['created'], stats['deleted']), (5, 0))
+        self.assertEqual(len(self.np.requests), 3)
+        stats = services.NovaPoshtaSync.sync_warehouses()
+        self.assertEqual((stats['created'], stats['skipped']), (1, 1))
+        self.assertEqual(DeliveryWarehousesNP.objects.get().number_warehouse, 7)
+
+        self.cities[0] = city('ref-0', 'Новое название')
+        del self.cities[4]
+        stats = services.NovaPoshtaSync.sync_cities()
+        self.assertEqual((stats['created'], stats['updated'], stats['deleted']), (0, 1, 1))
+        self.assertEqual(DeliveryCitiesNP.objects.get(city_ref='ref-0').city, 'Новое название')
+        self.assertFalse(DeliveryCitiesNP.objects.filter(city_ref='ref-4').exists())
+
+    def test_empty_or_truncated_response_keeps_rows(self):
+        services.NovaPoshtaSync.sync_cities()
+        services.NovaPoshtaSync.sync_warehouses()
+        for cities in ([], self.cities[:2]):
+            self.cities = cities
+            with self.assertLogs('product.services', 'WARNING'):
+                stats = services.NovaPoshtaSync.sync_cities()
+            self.assertEqual(stats['deleted'], 0)
+            self.assertEqual(stats['deletion_skipped'], 5 - len(cities))
+            self.assertEqual(DeliveryCitiesNP.objects.count(), 5)
+        self.assertEqual(DeliveryWarehousesNP.objects.count(), 1)
+
+    def test_failed_response(self):
+        services.NovaPoshtaSync.sync_cities()
+        self.failing = True
+        with self.assertRaises(novaposhta.NovaPoshtaError):
+            services.NovaPoshtaSync.sync_cities()
+        self.assertEqual(DeliveryCitiesNP.objects.count(), 5)
+
+
+
+class PriceMatrixTest(TestCase):
+    """ матрица стоимости доставки: таблица интервалов и сброс кэша процессов """
+
+    def setUp(self):
+        self.matrix = PriceMatrix.objects.create(name='Курьер')
+        for low, high, type_item, value in ((0, 500, 'fixed', 50), (500, 1000, 'relative', 5), (1000, 5000, 'fixed', 0)):
+            PriceMatrixItem.objects.create(matrix=self.matrix, min_value=low, max_value=high, type_item=type_item, value=value)
+        self.delivery = Delivery.objects.create(name='Курьер', matrix=self.matrix)
+
+    def test_check_intervals(self):
+        self.assertEqual(price_matrix.check_intervals([(0, 100), (100, 200)]), [])
+        self.assertEqual(price_matrix.check_intervals([(0, 100), (150, 200), (190, 300), (50, 50)]), [
+            'Пустой интервал 50 - 50',
+            'Разрыв между 100 и 150',
+            'Интервал 190 - 300 пересекается с 150 - 200',
+        ])
+        self.assertEqual(price_matrix.check_intervals([(0, 100), (150, 200)], with_gaps=False), [])
+
+    def test_compiled_matrix(self):
+        table = price_matrix.CompiledMatrix([(100, 200, 'relative', 10), (0, 100, 'fixed', 30),
+            (150, 300, 'fixed', 99), (300, 300, 'fixed', 1)])
+        self.assertEqual(table.lows, (0, 100))
+        self.assertEqual([table.cost(amount) for amount in (-1, 0, 99.99, 100, 155, 200, 1000)],
+            [0, 30, 30, 10, 15.5, 0, 0])
+        self.assertEqual(price_matrix.CompiledMatrix([]).cost(10), 0)
+
+    def test_cost_without_queries(self):
+        self.assertEqual(self.delivery.calculate_cost_of_delivery(100), 50)
+        with self.assertNumQueries(0):
+            costs = [self.delivery.calculate_cost_of_delivery(amount) for amount in (499, 500, 999, 1000, 5000)]
+        self.assertEqual(costs, [50, 25, 49.95, 0, 0])
+
+    def test_item_change_invalidates_other_processes(self):
+        other = VersionedCache('price_matrix', price_matrix.compile_matrix)
+        self.assertEqual(other.get(self.matrix.pk).cost(100), 50)
+        item = PriceMatrixItem.objects.get(matrix=self.matrix, min_value=0)
+        item.value = 70
+        item.save()
+        self.assertEqual(other.get(self.matrix.pk).cost(100), 70)
+        self.assertEqual(self.delivery.calculate_cost_of_delivery(100), 70)
+
+    def test_ttl_without_shared_cache(self):
+        shared = VersionedCache('price_matrix', price_matrix.compile_matrix)
+        local = VersionedCache('price_matrix', price_matrix.compile_matrix)
+        with mock.patch('shop.process_cache.shared_cache', lambda: True):
+            shared.get(self.matrix.pk)
+        with override_settings(PROCESS_CACHE_TTL=0):
+            local.get(self.matrix.pk)
+        # изменение, о котором другие процессы не узнали через версию
+        PriceMatrixItem.objects.filter(matrix=self.matrix, min_value=0).update(value=80)
+        with mock.patch('shop.process_cache.shared_cache', lambda: True):
+            self.assertEqual(shared.get(self.matrix.pk).cost(100), 50)
+        self.assertEqual(local.get(self.matrix.pk).cost(100), 80)
+
+
+class CurrencyTest(TestCase):
+    """ справочник валют в памяти процесса """
+
+    def setUp(self):
+        currency.registry.invalidate()
+        Currency.objects.get_or_create(code='UAH', defaults=currency.DEFAULT_CURRENCY)
+        self.usd = Currency.objects.create(code='USD', name='Доллар', rate=0.027, disp='$')
+
+    def request(self, code=None, **post):
+        request = RequestFactory().post('/shop/currency', post, HTTP_REFERER='/catalog') if post else RequestFactory().get('/')
+        request.session = SessionStore()
+        if code:
+            request.session['curr_id'] = code
+            request.session.modified = False
+        return request
+
+    def test_context_processor_without_queries(self):
+        all_currency(self.request())
+        with self.assertNumQueries(0):
+            context = all_currency(self.request('USD'))
+        self.assertEqual((context['select_currency'], context['rate_select_currency'], context['disp_select_currency']),
+            ('USD', 0.027, '$'))
+        self.assertEqual({curr.code for curr in context['all_currency']}, {'UAH', 'USD'})
+        self.assertEqual(all_currency(self.request('XXX'))['select_currency'], 'UAH')
+
+    def test_currency_change_reloads(self):
+        all_currency(self.request())
+        self.usd.rate = 0.025
+        self.usd.save()
+        self.assertEqual(all_currency(self.request('USD'))['rate_select_currency'], 0.025)
+
+    def test_select_writes_session_only_on_change(self):
+        request = self.request('USD', all_currency='USD')
+        response = select_curr(request)
+        self.assertEqual(response.url, '/catalog')
+        self.assertFalse(request.session.modified)
+        request = self.request('USD', all_currency='UAH')
+        select_curr(request)
+        self.assertTrue(request.session.modified)
+        self.assertEqual(request.session['curr_id'], 'UAH')
+        request = self.request(None, all_currency='unknown')
+        select_curr(request)
+        self.assertFalse(request.session.modified)
+
+
+class BasketQueriesTest(TestCase):
+    """ корзина пользователя: чтение одним запросом, изменения - одним запросом на строку """
+
+    def setUp(self):
+        self.user = CustomUser.objects.create(email='basket@example.com')
+        self.products = make_products(20)
+        for product in self.products[:10]:
+            BasketItem.objects.create(user=self.user, product=product, qty=1, price=product.price)
+
+    def test_get_basket(self):
+        with self.assertNumQueries(1):
+            basket = services.Basket.get_basket(self.user.id)
+        self.assertEqual(len(basket), 10)
+        with self.assertNumQueries(1):
+            self.assertEqual(services.Basket.get_total(self.user.id), sum(p.price for p in self.products[:10]))
+
+    def test_add_existing(self):
+        basket = services.Basket.get_basket(self.user.id)
+        product = self.products[0]
+        with self.assertNumQueries(1):
+            services.Basket.add2basket(basket, product.id, 2, user_id=self.user.id)
+        self.assertEqual(BasketItem.objects.get(user=self.user, product=product).qty, 3)
+
+    def test_add_new(self):
+        basket = services.Basket.get_basket(self.user.id)
+        product = self.products[15]
+        # товар + UPDATE без строк + INSERT в savepoint (SAVEPOINT/RELEASE)
+        with self.assertNumQueries(5):
+            services.Basket.add2basket(basket, product.id, 2, user_id=self.user.id)
+        self.assertEqual(BasketItem.objects.get(user=self.user, product=product).qty, 2)
+
+    def test_edit(self):
+        basket = services.Basket.get_basket(self.user.id)
+        product = self.products[1]
+        with self.assertNumQueries(1):
+            services.Basket.add2basket(basket, product.id, 7, user_id=self.user.id, _type='edit')
+        self.assertEqual(BasketItem.objects.get(user=self.user, product=product).qty, 7)
+
+    def test_delete(self):
+        basket = services.Basket.get_basket(self.user.id)
+        product = self.products[2]
+        with self.assertNumQueries(1):
+            services.Basket.del2basket(basket, product.id, user_id=self.user.id)
+        self.assertFalse(BasketItem.objects.filter(user=self.user, product=product).exists())
+
+
+class SearchTest(TestCase):
+    """ поиск по индексу текущей СУБД: ранжирование и обновление индекса из сигналов """
+
+    def setUp(self):
+        self.in_title = Product.objects.create(title='Чехол для телефона', desc='силикон')
+        self.in_desc = Product.objects.create(title='Защитное стекло', desc='подходит под чехол')
+        Product.objects.create(title='Кабель', desc='USB')
+
+    def found(self, text):
+        return list(search.search_products(Product.objects.all(), text).values_list('id', flat=True))
+
+    def test_title_ranked_first(self):
+        self.assertEqual(self.found('чехол'), [self.in_title.id, self.in_desc.id])
+
+    def test_prefix_and_all_words(self):
+        self.assertEqual(self.found('тел чехол'), [self.in_title.id])
+
+    def test_index_follows_save_and_delete(self):
+        self.in_desc.title = 'Чехол-книжка'
+        self.in_desc.save()
+        self.assertEqual(set(self.found('книжка')), {self.in_desc.id})
+        self.in_desc.delete()
+        self.assertEqual(self.found('книжка'), [])
+
+    def test_combined_conditions(self):
+        found = search.search_products(search.search_products(Product.objects.all(), 'чехол', fields=['desc']),
+            'стекло', fields=['title'])
+        self.assertEqual(list(found.values_list('id', flat=True)), [self.in_desc.id])
+
+
+class KeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        make_products(25)
+        # одинаковая дата у части товаров - порядок внутри нее задает id
+        Product.objects.filter(id__in=Product.objects.order_by('id').values('id')[5:15]).update(
+            date_add=datetime.datetime(2021, 1, 1))
+
+    def walk(self, ordering):
+        paginator = KeysetPaginator(Product.objects.all(), ordering, 10)
+        ids, cursor = [], None
+        while True:
+            page = paginator.page(cursor)
+            ids += [product.id for product in page]
+            if not page.has_next():
+                return ids
+            cursor = page.next_cursor
+
+    def test_walk_all_pages(self):
+        for ordering in (('-date_add', '-id'), ('id',)):
+            self.assertEqual(self.walk(ordering),
+                list(Product.objects.order_by(*ordering).values_list('id', flat=True)))
+
+    def test_invalid_cursor(self):
+        paginator = KeysetPaginator(Product.objects.all(), ('-date_add', '-id'), 10)
+        for cursor in ('not-a-cursor', 'WzFd', 'WyJ4IiwgMV0='):
+            with self.assertRaises(InvalidCursor):
+                paginator.page(cursor)
+
+
+class ImportFileTest(TestCase):
+    """ импорт прайса из локальных файлов в формате таблицы """
+
+    def import_file(self, name):
+        return services.ImportSheet.import_from_file(os.path.join(TEST_DATA, name))
+
+    def test_csv(self):
+        stats = self.import_file('price.csv')
+        self.assertEqual(stats, {'rows': 7, 'created': 4, 'updated': 0, 'skipped': 3})
+        product = Product.objects.get(title='Телефон A1')
+        self.assertEqual((product.price, product.old_price, product.stock), (4999.99, 5499, 10))
+        self.assertEqual(list(product.cid.values_list('name', flat=True)), ['Телефоны'])
+        self.assertEqual(Categories.objects.filter(name__in=['Телефоны', 'Аксессуары']).count(), 2)
+
+    def test_reimport_is_noop(self):
+        self.import_file('price.csv')
+        stats = self.import_file('price.csv')
+        self.assertEqual((stats['created'], stats['updated']), (0, 0))
+
+    def test_json_updates_diff(self):
+        self.import_file('price.csv')
+        stats = self.import_file('price.json')
+        self.assertEqual((stats['created'], stats['updated']), (1, 1))
+        self.assertEqual(Product.objects.get(title='Телефон A1').price, 4599)
+        self.assertEqual(Product.objects.get(title='Телефон A2').price, 6999)
+
+    def test_queries_per_batch(self):
+        # число запросов зависит от пачек, а не от строк (SQLite дополнительно
+        # делит INSERT пачки по лимиту параметров)
+        rows = [['Категория', f'Товар {i}', '', '', '', '10', '0', '1'] for i in range(300)]
+        with CaptureQueriesContext(connection) as created:
+            services.ImportSheet.import_rows(rows)
+        self.assertLess(len(created), 30)
+        for row in rows:
+            row[5] = '20'
+        with CaptureQueriesContext(connection) as updated:
+            stats = services.ImportSheet.import_rows(rows)
+        self.assertEqual(stats['updated'], 300)
+        self.assertLess(len(updated), 30)
+
+
+
+class ExportTest(TestCase):
+    """ выгрузка прайса: товары пачками, категории - запросом на пачку """
+
+    def setUp(self):
+        self.phones, self.cases = Categories.objects.create(name='Телефоны'), Categories.objects.create(name='Чехлы')
+        self.products = make_products(5, brand='Acme', stock=3)
+        self.products[0].cid.add(self.phones, self.cases)
+        self.products[3].cid.add(self.cases)
+        self.storage_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.storage_dir.cleanup)
+        storage = FileSystemStorage(location=self.storage_dir.name, base_url='/media/')
+        patcher = mock.patch('product.services.MediaStorage', lambda: storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def exported(self, url):
+        return os.path.join(self.storage_dir.name, url[len('/media/'):])
+
+    def test_rows(self):
+        with self.assertNumQueries(5):
+            rows = list(services.ProductServices.iter_export_rows(2))
+        self.assertEqual(rows[0], ['Товар 0', 3, 'Acme', '', None, 10, 0, 'Телефоны;Чехлы'])
+        self.assertEqual([row[-1] for row in rows], ['Телефоны;Чехлы', '', '', 'Чехлы', ''])
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_csv(self):
+        progress = []
+        url = services.ProductServices.export_to_file('csv', progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(progress, [(2, 5), (4, 5), (5, 5)])
+        with open(self.exported(url), encoding='utf-8', newline='') as f:
+            rows = list(csv.reader(f, delimiter='|'))
+        self.assertEqual(rows[0], services.ProductServices.EXPORT_HEADER)
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[4], ['Товар 3', '3', 'Acme', '', '', '13.0', '0.0', 'Чехлы'])
+
+    def test_xlsx(self):
+        url = services.ProductServices.export_to_file('xlsx')
+        self.assertTrue(url.endswith('.xlsx'))
+        with zipfile.ZipFile(self.exported(url)) as workbook:
+            sheet = workbook.read('xl/worksheets/sheet1.xml').decode()
+        self.assertEqual(sheet.count('<row '), 6)
+        self.assertIn('Телефоны;Чехлы', sheet)
+
+    def test_unknown_type(self):
+        self.assertIsNone(services.ProductServices.export_to_file('pdf'))
+
+
+
+@override_settings(REPRICE_BATCH_SIZE=2)
+class RepriceTest(TestCase):
+    """ массовое изменение цен категории одним UPDATE на пачку """
+
+    def setUp(self):
+        self.category = Categories.objects.create(name='Уценка')
+        self.prices = [10, 20.5, 5, 0]
+        self.products = [Product.objects.create(title=f'Товар {i}', price=price, old_price=1)
+            for i, price in enumerate(self.prices)]
+        self.category.category.add(*self.products)
+        self.other = Product.objects.create(title='Другой', price=100)
+
+    def current(self):
+        return list(Product.objects.filter(pk__in=[product.pk for product in self.products]).order_by('id').values_list(
+            'price', 'old_price'))
+
+    def test_relative(self):
+        stats = services.ProductServices.edit_price_products([self.category.pk], 'relative', 10)
+        self.assertEqual(stats, {'products': 4, 'changed': 3})
+        self.assertEqual(self.current(), [(11, 1), (22.55, 1), (5.5, 1), (0, 1)])
+        self.assertEqual(Product.objects.get(pk=self.other.pk).price, 100)
+
+    def test_fixed_not_below_zero_with_old_price(self):
+        services.ProductServices.edit_price_products([self.category.pk], 'fix', -7, is_edit_old_price=True)
+        self.assertEqual(self.current(), [(3, 10), (13.5, 20.5), (0, 5), (0, 1)])
+
+    def test_rounding(self):
+        services.ProductServices.edit_price_products([self.category.pk], 'fix', 0.333)
+        self.assertEqual([price for price, old_price in self.current()], [10.33, 20.83, 5.33, 0.33])
+
+    def test_dry_run(self):
+        diff = services.ProductServices.edit_price_products([self.category.pk], 'fix', -7, dry_run=True)
+        self.assertEqual([(row['title'], row['price'], row['new_price']) for row in diff],
+            [('Товар 0', 10, 3), ('Товар 1', 20.5, 13.5), ('Товар 2', 5, 0)])
+        self.assertEqual(self.current(), [(price, 1) for price in self.prices])
+        self.assertFalse(ProductEvent.objects.exists())
+
+    def test_events(self):
+        Product.objects.filter(pk=self.products[1].pk).update(is_active=False)
+        services.ProductServices.edit_price_products([self.category.pk], 'fix', 1)
+        self.assertEqual(sorted(ProductEvent.objects.values_list('product_id', 'type_event', 'price')),
+            [(self.products[0].pk, 'edit_price', 11), (self.products[2].pk, 'edit_price', 6),
+             (self.products[3].pk, 'edit_price', 1)])
+
+
+
+class RatingCountersTest(TestCase):
+    """ счетчики оценок товара меняются одним UPDATE, reconcile исправляет расхождения """
+
+    def setUp(self):
+        self.first, self.second = make_products(2)
+        self.users = [CustomUser.objects.create(email=f'rater{i}@example.com') for i in range(3)]
+
+    def counters(self, product):
+        return Product.objects.values_list('rating_sum', 'rating_count', 'rating').get(pk=product.pk)
+
+    def test_insert_update_delete(self):
+        RatingProduct.objects.create(user=self.users[0], product=self.first, value_rating=5)
+        rating = RatingProduct.objects.create(user=self.users[1], product=self.first, value_rating=2)
+        self.assertEqual(self.counters(self.first), (7, 2, 3.5))
+
+        rating = RatingProduct.objects.get(pk=rating.pk)
+        rating.value_rating = 4
+        # сама оценка и один UPDATE счетчиков товара (плюс SAVEPOINT/RELEASE)
+        with self.assertNumQueries(4):
+            rating.save()
+        self.assertEqual(self.counters(self.first), (9, 2, 4.5))
+        rating.save()
+        self.assertEqual(self.counters(self.first), (9, 2, 4.5))
+
+        rating.product = self.second
+        rating.save()
+        self.assertEqual(self.counters(self.first), (5, 1, 5))
+        self.assertEqual(self.counters(self.second), (4, 1, 4))
+
+        rating.delete()
+        self.assertEqual(self.counters(self.second), (0, 0, None))
+
+    def test_reconcile(self):
+        RatingProduct.objects.create(user=self.users[0], product=self.first, value_rating=5)
+        RatingProduct.objects.create(user=self.users[1], product=self.first, value_rating=3)
+        Product.objects.filter(pk=self.first.pk).update(rating_sum=100, rating_count=1, rating=100)
+        Product.objects.filter(pk=self.second.pk).update(rating_sum=3, rating_count=1, rating=3)
+        self.assertEqual(RatingProduct.reconcile(), 2)
+        self.assertEqual(self.counters(self.first), (8, 2, 4))
+        self.assertEqual(self.counters(self.second), (0, 0, None))
+        self.assertEqual(RatingProduct.reconcile(), 0)
+
+
+class PaymentLedgerTest(TestCase):
+    """ оплата и возврат: не больше одной записи журнала каждого типа на заказ """
+
+    def setUp(self):
+        self.user = CustomUser.objects.create(email='ledger@example.com', balance=500)
+        currency = Currency.objects.create(code='LDG', name='LDG', rate=1, disp='LDG')
+        self.order = Order.objects.create(user=self.user, currency=currency, total_amount=200)
+
+    def state(self):
+        order = Order.objects.get(pk=self.order.pk)
+        return (CustomUser.objects.get(pk=self.user.pk).balance, order.status, order.is_paid,
+            sorted(BalanceEntry.objects.filter(order=order).values_list('type_entry', 'amount')))
+
+    def order_for_request(self):
+        return Order.objects.select_related('user').get(pk=self.order.pk)
+
+    def test_pay_and_cancel(self):
+        self.assertTrue(self.order_for_request().payment())
+        self.assertTrue(self.order_for_request().payment())
+        self.assertEqual(self.state(), (300, 'paid', True, [('payment', -200)]))
+        self.assertTrue(self.order_for_request().cancel_order())
+        self.assertEqual(self.state(), (500, 'cancel', False, [('payment', -200), ('refund', 200)]))
+
+    def test_reopened_order_is_not_charged_again(self):
+        self.order_for_request().payment()
+        self.order_for_request().cancel_order()
+        Order.change_status(self.order.pk, 'new')
+        order = self.order_for_request()
+        self.assertFalse(order.payment())
+        self.assertEqual((order.status, order.is_paid), ('new', False))
+        self.assertEqual(self.state(), (500, 'new', False, [('payment', -200), ('refund', 200)]))
+        # отмена неоплаченного заказа возврата не делает
+        self.assertTrue(self.order_for_request().cancel_order())
+        self.assertEqual(self.state(), (500, 'cancel', False, [('payment', -200), ('refund', 200)]))
+
+    def test_second_refund_is_refused(self):
+        self.order_for_request().payment()
+        self.order_for_request().cancel_order()
+        Order.objects.filter(pk=self.order.pk).update(status='paid', is_paid=True)
+        order = self.order_for_request()
+        self.assertFalse(order.cancel_order())
+        self.assertEqual((order.status, order.is_paid), ('paid', True))
+        self.assertEqual(self.state(), (500, 'paid', True, [('payment', -200), ('refund', 200)]))
+
+
+class RozetkaCrawlerTest(TestCase):
+    """ загрузка категории с локального сервера, отдающего записанные ответы API Rozetka """
+    key_params = {'/v3/goods/get': 'page', '/v3/goods/getDetails': 'product_ids', '/v4/categories/get': 'id'}
+
+    def handler(self, method, path, body):
+        url = urlsplit(path)
+        params = parse_qs(url.query)
+        if url.path == '/v3/goods/get' and params['category_id'] != ['77']:
+            return 404, {'error': 'not found'}
+        key = params[self.key_params[url.path]][0]
+        if key in self.failing:
+            self.failing.discard(key)
+            return 500, {'error': 'temporary'}
+        return 200, self.recorded[url.path][key]
+
+    def setUp(self):
+        with open(os.path.join(TEST_DATA, 'rozetka.json'), encoding='utf-8') as f:
+            self.recorded = json.load(f)
+        self.failing = set()
+        self.api = FakeServer(self.handler).__enter__()
+        self.addCleanup(self.api.__exit__)
+        override = override_settings(ROZETKA_API_URL=self.api.url)
+        override.enable()
+        self.addCleanup(override.disable)
+        cache.delete('rozetka:77:pages')
+
+    def crawl(self):
+        return parser_rozetka.RozetkaCrawler(77, concurrency=4, rate=1000).run()
+
+    def paths(self):
+        return [urlsplit(path).path for method, path, body in self.api.requests]
+
+    def test_crawl(self):
+        stats = self.crawl()
+        self.assertEqual((stats['pages'], stats['created'], stats['failed_pages']), (2, 3, 0))
+        self.assertEqual(self.paths().count('/v4/categories/get'), 2)
+        phone = Product.objects.get(title='Смартфон R1')
+        self.assertEqual((phone.brand, phone.desc, phone.price), ('Acme', '6 дюймов', 5999))
+        self.assertEqual(list(phone.cid.values_list('name', flat=True)), ['Смартфоны'])
+        self.assertEqual(Product.objects.get(title='Чехол R1').old_price, 0)
+        self.assertIsNone(cache.get('rozetka:77:pages'))
+
+    def test_resume_after_failed_page(self):
+        self.failing = {'103'}
+        with self.assertLogs('product.parser_rozetka', 'WARNING'):
+            stats = self.crawl()
+        self.assertEqual((stats['pages'], stats['failed_pages']), (1, 1))
+        self.assertEqual(cache.get('rozetka:77:pages'), [1])
+        self.api.requests.clear()
+        stats = self.crawl()
+        self.assertEqual((stats['pages'], stats['skipped_pages'], stats['created']), (1, 1, 1))
+        self.assertEqual(self.paths().count('/v3/goods/getDetails'), 1)
+        self.assertEqual(Product.objects.count(), 3)
+
+    def test_celery_task(self):
+        with override_settings(ROZETKA_RATE=1000):
+            stats = tasks.parser_rozetka.apply(args=[77]).get()
+        self.assertEqual((stats['pages'], stats['created']), (2, 3))
+        self.assertEqual(tasks.parser_rozetka.name, 'product.tasks.parser_rozetka')
+
+    def test_unknown_category(self):
+        with self.assertLogs('product.parser_rozetka', 'WARNING'):
+            stats = parser_rozetka.RozetkaCrawler(78, rate=1000).run()
+        self.assertIn('error', stats)
+
+
+class PromocodeGenerationTest(TestCase):
+    """ пачечная генерация промокодов и выгрузка в csv """
+
+    def test_batches(self):
+        with override_settings(PROMO_BATCH_SIZE=40), self.assertNumQueries(9):
+            codes = Promocode.generate_new_promocode(cnt=100, value=-5)
+        self.assertEqual(len(set(codes)), 100)
+        self.assertEqual(Promocode.objects.filter(code__in=codes, amount_of_discount=-5).count(), 100)
+
+    def test_existing_codes_are_skipped(self):
+        Promocode.objects.create(code='TAKEN')
+        candidates = iter(['TAKEN', 'NEW1', 'NEW2', 'NEW3'])
+        with mock.patch('product.models.get_random_string', lambda length: next(candidates)):
+            codes = Promocode.generate_new_promocode(cnt=3)
+        self.assertEqual(sorted(codes), ['NEW1', 'NEW2', 'NEW3'])
+        self.assertEqual(Promocode.objects.count(), 4)
+
+    def test_conflicting_insert_is_not_yielded(self):
+        """ код, вставленный параллельно между проверкой и вставкой, не отдается """
+        candidates = iter(['RACE', 'NEW1', 'NEW2'])
+        bulk_create = Promocode.objects.bulk_create
+        def racing_bulk_create(objs, **kwargs):
+            if not Promocode.objects.exists():
+                Promocode.objects.create(code='RACE', type_promo='reusable')
+            return bulk_create(objs, **kwargs)
+        with mock.patch('product.models.get_random_string', lambda length: next(candidates)), \
+                override_settings(PROMO_BATCH_SIZE=2), \
+                mock.patch.object(Promocode.objects, 'bulk_create', racing_bulk_create):
+            codes = Promocode.generate_new_promocode(cnt=2)
+        self.assertEqual(sorted(codes), ['NEW1', 'NEW2'])
+
+    def test_csv_requires_permission(self):
+        user = CustomUser.objects.create(email='manager@example.com')
+        self.client.force_login(user)
+        response = self.client.post('/shop/create_promocode/generate/', {'cnt': 3, 'type_code': 'relative',
+            'amount_of_discount': -10, 'type_promo': 'onceuse'})
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Promocode.objects.exists())
+
+        user.user_permissions.add(Permission.objects.get(codename='add_promocode'))
+        self.client.force_login(CustomUser.objects.get(pk=user.pk))
+        response = self.client.post('/shop/create_promocode/generate/', {'cnt': 3, 'type_code': 'relative',
+            'amount_of_discount': -10, 'type_promo': 'onceuse'})
+        rows = b''.join(response.streaming_content).decode().split()
+        self.assertEqual(rows[0], 'code')
+        self.assertEqual(sorted(rows[1:]), sorted(Promocode.objects.values_list('code', flat=True)))
+
+
+
+class RecommendationsTest(TestCase):
+    """ списки рекомендаций по категориям """
+
+    def setUp(self):
+        self.category = Categories.objects.create(name='Рекомендации')
+        self.products = make_products(30, is_recommend=True)
+        self.category.category.add(*self.products)
+
+    @override_settings(RECOMMEND_SIMILAR_LIMIT=5)
+    def test_category_lists(self):
+        lists = recommendations.build_category_lists()
+        prices = {product.pk: product.price for product in self.products}
+        for product in self.products:
+            rec, sim = lists[product.pk]
+            self.assertEqual(len(rec), 5)
+            self.assertNotIn(product.pk, rec + sim)
+            self.assertLessEqual(len(sim), 5)
+            self.assertTrue(all(0.7 * product.price < prices[id] < 1.3 * product.price for id in sim))
+        middle = self.products[15]
+        self.assertEqual(sorted(lists[middle.pk][1]), [product.pk for product in self.products[12:15] + self.products[16:18]])
+
+    def test_page_without_row_is_not_saved(self):
+        product = self.products[10]
+        with self.assertNumQueries(6):
+            recommend, buy_together = recommendations.get_for_page(product)
+        self.assertEqual(len(recommend), 5)
+        self.assertEqual(buy_together, [])
+        self.assertFalse(ProductRecommendation.objects.exists())
+
+
+
+class CopurchaseTest(TestCase):
+    """ матрица совместных покупок против прежнего Sum-запроса по товару """
+
+    def setUp(self):
+        self.user = CustomUser.objects.create(email='copurchase@example.com')
+        self.currency = Currency.objects.get_or_create(code='UAH', defaults={'name': 'ГРН', 'rate': 1, 'disp': 'грн'})[0]
+        self.products = make_products(6)
+        for i in range(30):
+            items = [(self.products[(i * 7 + j * 3) % 6], 1 + (i + j) % 3) for j in range(1 + i % 4)]
+            self.order(items, status='finished' if i % 5 else 'new')
+
+    def order(self, items, status='paid'):
+        order = Order.objects.create(user=self.user, currency=self.currency, status=status)
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=product, qty=qty) for product, qty in items])
+        return order
+
+    def old_query(self, product):
+        return {row['product']: row['all_qty'] for row in OrderItem.objects.filter(
+            order__in=OrderItem.objects.filter(product=product, order__status__in=copurchase.PAID_STATUSES).values('order_id'),
+        ).exclude(product=product).values('product').annotate(all_qty=Sum('qty'))}
+
+    def test_build_matches_old_query(self):
+        together = copurchase.build()
+        for product in self.products:
+            expected = self.old_query(product)
+            self.assertEqual(dict(map(tuple, together.get(product.pk, []))), expected)
+            quantities = [qty for id, qty in together.get(product.pk, [])]
+            self.assertEqual(quantities, sorted(quantities, reverse=True))
+
+    def test_rebuild_corrects_incremental_drift(self):
+        first, second, third = self.products[:3]
+        with override_settings(RECOMMEND_TOGETHER_LIMIT=1):
+            recommendations.build_all()
+            for i in range(3):
+                order = self.order([(first, 1), (third, 5)])
+                recommendations.add_orders([order.pk])
+            stored = ProductRecommendation.objects.get(pk=first.pk).bought_together
+            self.assertEqual(len(stored), 1)
+            recommendations.build_all()
+            rebuilt = ProductRecommendation.objects.get(pk=first.pk).bought_together
+        best = min(self.old_query(first).items(), key=lambda item: (-item[1], item[0]))
+        self.assertEqual(rebuilt, [list(best)])
+
+
+
+class ProductEventsTest(TestCase):
+    """ события изменения товара: уведомления через outbox, сброс файла сразу """
+
+    def setUp(self):
+        self.product = Product.objects.create(title='Файл', price=10, stock=1, file_digit='old.pdf')
+        FileTelegram.objects.create(product=self.product, id_file='telegram-file-id')
+        self.product = Product.objects.get(pk=self.product.pk)
+
+    def test_file_changed_is_applied_in_save(self):
+        self.product.file_digit = 'new.pdf'
+        self.product.price = 12
+        self.product.save()
+        self.assertFalse(FileTelegram.objects.exists())
+        self.assertEqual(list(ProductEvent.objects.values_list('type_event', flat=True)), ['edit_price'])
+
+    def test_bulk_update(self):
+        self.product.file_digit = 'new.pdf'
+        Product.objects.bulk_update_with_events([self.product], ['file_digit'])
+        self.assertFalse(FileTelegram.objects.exists())
+        self.assertFalse(ProductEvent.objects.exists())
+
+    def test_rolled_back_save_keeps_file(self):
+        self.product.file_digit = 'new.pdf'
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.product.save()
+            raise ValueError
+        self.assertTrue(FileTelegram.objects.exists())
+
+    def events(self):
+        return sorted(ProductEvent.objects.values_list('type_event', flat=True))
+
+    def test_save_without_changes(self):
+        self.product.title = 'Новое название'
+        self.product.save()
+        self.product.save()
+        self.assertEqual(self.events(), [])
+        self.assertTrue(FileTelegram.objects.exists())
+
+    def test_events_follow_last_saved_values(self):
+        self.product.price = 12
+        self.product.save()
+        self.product.stock = 0
+        self.product.save()
+        self.product.stock = 3
+        self.product.save()
+        self.assertEqual(self.events(), ['active_product', 'edit_price'])
+
+    def test_only_loads_missing_tracked_fields(self):
+        product = Product.objects.only('price').get(pk=self.product.pk)
+        product.price = 15
+        with self.assertNumQueries(8):
+            # дочитывание отслеживаемых полей одним запросом, UPDATE только цены,
+            # обновление поиска, title для события и INSERT события в savepoint
+            product.save()
+        self.assertEqual(self.events(), ['edit_price'])
+        self.assertTrue(FileTelegram.objects.exists())
+        product.price = 16
+        with self.assertNumQueries(6):
+            product.save()
+        self.assertEqual(self.events(), ['edit_price', 'edit_price'])
+
+    def test_only_inactive_product(self):
+        Product.objects.filter(pk=self.product.pk).update(is_active=False)
+        product = Product.objects.only('price').get(pk=self.product.pk)
+        product.price = 15
+        product.save()
+        self.assertEqual(self.events(), [])
+
+    def test_defer_assigned_field_is_compared(self):
+        product = Product.objects.defer('stock', 'is_active').get(pk=self.product.pk)
+        product.is_active = False
+        product.price = 15
+        product.save()
+        self.assertEqual(self.events(), [])
+
+    def test_bulk_update_with_only(self):
+        other = Product.objects.create(title='Второй', price=5, stock=0)
+        products = list(Product.objects.only('price', 'stock').order_by('id'))
+        for product in products:
+            product.price += 1
+            product.stock = 2
+        with self.assertNumQueries(1):
+            Product.add_unloaded_values({product.pk: product.loaded_values() for product in products})
+        Product.objects.bulk_update_with_events(products, ['price', 'stock'])
+        self.assertEqual(sorted(ProductEvent.objects.values_list('product_id', 'type_event')),
+            [(self.product.pk, 'edit_price'), (other.pk, 'active_product'), (other.pk, 'edit_price')])
+        self.assertTrue(FileTelegram.objects.exists())
+
+
+@override_settings(OUTBOX_DEDUPE_WINDOW=30)
+@mock.patch('product.changes.acc_tasks')
+class OutboxRelayTest(TestCase):
+    """ relay: склейка событий одного товара, окно ожидания, метрики очереди """
+
+    def setUp(self):
+        cache.delete(changes.STATS_KEY)
+        user = CustomUser.objects.create(email='subscriber@example.com', id_tg=555)
+        self.product = Product.objects.create(title='Товар', price=10, stock=0)
+        SubEditPrice.objects.create(user=user, product=self.product)
+        SubActivateProduct.objects.create(user=user, product=self.product)
+        self.product = Product.objects.get(pk=self.product.pk)
+
+    def age(self, seconds):
+        ProductEvent.objects.update(date_create=timezone.now() - datetime.timedelta(seconds=seconds))
+
+    def test_dedupe(self, acc_tasks):
+        for price in (11, 12, 13):
+            self.product.price = price
+            self.product.save()
+        self.age(60)
+        stats = changes.relay()
+        acc_tasks.send_edit_price_batch.delay.assert_called_once_with([[[555], 'Товар', 13]])
+        self.assertEqual((stats['sent'], stats['deduped']), (1, 2))
+        self.assertGreaterEqual(stats['max_lag'], 60)
+        self.assertFalse(ProductEvent.objects.exists())
+
+    def test_types_are_sent_separately(self, acc_tasks):
+        self.product.stock = 2
+        self.product.price = 11
+        self.product.save()
+        self.age(60)
+        stats = changes.relay()
+        acc_tasks.send_edit_price_batch.delay.assert_called_once_with([[[555], 'Товар', 11]])
+        sub = SubActivateProduct.objects.get()
+        acc_tasks.send_activate_product.delay.assert_called_once_with([555], 'Товар', 11, [sub.pk])
+        self.assertEqual((stats['sent'], stats['deduped']), (2, 0))
+
+    def test_window(self, acc_tasks):
+        self.product.price = 11
+        self.product.save()
+        stats = changes.relay()
+        self.assertEqual(stats['sent'], 0)
+        acc_tasks.send_edit_price_batch.delay.assert_not_called()
+        self.assertEqual(ProductEvent.objects.count(), 1)
+        # более новые события того же товара уходят вместе с готовым
+        self.age(60)
+        self.product.price = 12
+        self.product.save()
+        changes.relay()
+        acc_tasks.send_edit_price_batch.delay.assert_called_once_with([[[555], 'Товар', 12]])
+        self.assertFalse(ProductEvent.objects.exists())
+
+    def test_batches(self, acc_tasks):
+        other = Product.objects.create(title='Другой', price=5, stock=1)
+        other = Product.objects.get(pk=other.pk)
+        for product in (self.product, other):
+            product.price += 1
+            product.save()
+        self.age(60)
+        stats = changes.relay(batch_size=1)
+        self.assertEqual(stats['sent'], 2)
+        self.assertEqual(acc_tasks.send_edit_price_batch.delay.call_count, 1)
+        self.assertFalse(ProductEvent.objects.exists())
+
+    def test_metrics(self, acc_tasks):
+        self.assertEqual(changes.metrics(), {'pending': 0, 'oldest_age': 0, 'last_relay': None})
+        self.product.price = 11
+        self.product.save()
+        self.product.price = 12
+        self.product.save()
+        self.age(45)
+        metrics = changes.metrics()
+        self.assertEqual(metrics['pending'], 2)
+        self.assertGreaterEqual(metrics['oldest_age'], 45)
+        stats = changes.relay()
+        metrics = changes.metrics()
+        self.assertEqual((metrics['pending'], metrics['oldest_age']), (0, 0))
+        self.assertEqual(metrics['last_relay'], stats)
+
+
+class PromocodeCacheTest(TransactionTestCase):
+    """ кэш промокода сбрасывается только после фиксации транзакции """
+
+    def setUp(self):
+        cache.delete(Promocode.cache_key('ONCE'))
+        self.promo = Promocode.objects.create(code='ONCE', type_promo='onceuse')
+
+    def test_consume(self):
+        self.assertEqual(Promocode.get_valid('ONCE'), self.promo)
+        with transaction.atomic():
+            self.assertTrue(self.promo.consume())
+            self.assertEqual(cache.get(Promocode.cache_key('ONCE')), self.promo)
+        self.assertIsNone(Promocode.get_valid('ONCE'))
+        self.assertFalse(Promocode.objects.get(code='ONCE').consume())
+
+    def test_rolled_back_consume(self):
+        self.assertEqual(Promocode.get_valid('ONCE'), self.promo)
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.promo.consume()
+            raise ValueError
+        self.assertEqual(Promocode.get_valid('ONCE'), self.promo)
+        self.assertTrue(Promocode.objects.get(code='ONCE').status)
+
+
+class ProductCardsTest(TransactionTestCase):
+    """ карточки в кэше сбрасываются после массовых изменений товаров """
+
+    def setUp(self):
+        self.products = make_products(3)
+        self.ids = [product.pk for product in self.products]
+        cards.invalidate_many(self.ids)
+        cards.get_cards(self.ids)
+
+    def cached(self):
+        return [key for key in map(cards.cache_key, self.ids) if cache.get(key) is not None]
+
+    def test_update_with_events(self):
+        Product.objects.filter(pk__in=self.ids[:2]).update_with_events(title='Новое название')
+        self.assertEqual(self.cached(), [cards.cache_key(self.ids[2])])
+        self.assertEqual(cards.get_cards(self.ids[:1])[self.ids[0]]['title'], 'Новое название')
+        Product.objects.filter(pk=self.ids[2]).update_with_events(price=1)
+        self.assertEqual(cards.get_cards(self.ids)[self.ids[2]]['price'], 1)
+
+    def test_bulk_update_with_events(self):
+        products = list(Product.objects.filter(pk__in=self.ids[1:]))
+        for product in products:
+            product.price = 5
+        Product.objects.bulk_update_with_events(products, ['price'])
+        self.assertEqual(self.cached(), [cards.cache_key(self.ids[0])])
+        self.assertEqual({card['price'] for card in cards.get_cards(self.ids[1:]).values()}, {5})
+
+    def test_change_counters(self):
+        with transaction.atomic():
+            RatingProduct.change_counters(self.ids[0], 5, 1)
+            self.assertEqual(len(self.cached()), 3)
+        self.assertEqual(len(self.cached()), 2)
+
+
+class ConcurrentPaymentTest(TransactionTestCase):
+    """ параллельная оплата заказов с одного баланса """
+    threads = 8
+    orders = 20
+    amount = 100
+
+    def setUp(self):
+        self.user = CustomUser.objects.create(email='payer@example.com', balance=self.amount * self.orders / 2)
+        currency = Currency.objects.create(code='PAY', name='PAY', rate=1, disp='PAY')
+        self.order_ids = [Order.objects.create(user=self.user, currency=currency, total_amount=self.amount).pk
+            for i in range(self.orders)]
+        self.errors = []
+
+    def pay_all(self, seed):
+        try:
+            ids = list(self.order_ids)
+            random.Random(seed).shuffle(ids)
+            for order_id in ids:
+                while True:
+                    try:
+                        payments.pay(Order.objects.select_related('user').get(pk=order_id))
+                        break
+                    except OperationalError:
+                        # SQLite не пускает параллельных писателей - повторяем транзакцию
+                        time.sleep(0.001)
+        except Exception as error:
+            self.errors.append(error)
+        finally:
+            connections.close_all()
+
+    def test_balance_is_never_overspent(self):
+        initial = self.user.balance
+        with mock.patch('product.payments.on_paid') as on_paid:
+            workers = [threading.Thread(target=self.pay_all, args=(seed,)) for seed in range(self.threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        self.assertEqual(self.errors, [])
+        paid = Order.objects.filter(pk__in=self.order_ids, is_paid=True)
+        self.assertEqual(paid.count(), self.orders // 2)
+        self.assertEqual(sorted(call.args[0] for call in on_paid.call_args_list), sorted(paid.values_list('pk', flat=True)))
+        balance = CustomUser.objects.get(pk=self.user.pk).balance
+        self.assertEqual(balance, 0)
+        entries = BalanceEntry.objects.filter(user=self.user)
+        self.assertEqual(entries.count(), self.orders // 2)
+        self.assertEqual(initial + entries.aggregate(total=Sum('amount'))['total'], balance)
+        self.assertEqual(sorted(entries.values_list('order_id', flat=True)), sorted(paid.values_list('pk', flat=True)))
+
+
+class InvoicePageTest(TransactionTestCase):
+    """ страница заказа: число запросов, кэш завершенного заказа сбрасывается после коммита """
+
+    def setUp(self):
+        cache.clear()
+        user = CustomUser.objects.create(email='invoice@example.com')
+        currency = Currency.objects.create(code='INV', name='INV', rate=1, disp='INV')
+        city = DeliveryCitiesNP.objects.create(city='Киев')
+        DeliveryWarehousesNP.objects.create(city=city, description_ru='Отделение №1', ref_warehouse='wh-1')
+        self.products = make_products(5)
+        self.order = Order.objects.create(user=user, currency=currency, status='finished', delivery_department='wh-1')
+
+    def add_items(self, count):
+        OrderItem.objects.bulk_create([OrderItem(order=self.order, product=product, id_good=product.id,
+            title_good=product.title, cost=product.price) for product in self.products[:count]])
+
+    def get(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('invoice_page', args=[self.order.pk]))
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_query_count(self):
+        self.get()
+        key = Order.invoice_cache_key(self.order.pk)
+        self.assertIsNotNone(cache.get(key))
+        for count in (1, 4):
+            self.add_items(count)
+            cache.delete(key)
+            # заказ, позиции с товаром одним JOIN, отделение с городом одним JOIN
+            self.assertEqual(self.get()[1], 3)
+            # из кэша - только сам заказ
+            self.assertEqual(self.get()[1], 1)
+
+    def test_cache_is_dropped_after_commit(self):
+        self.add_items(2)
+        self.get()
+        key = Order.invoice_cache_key(self.order.pk)
+        item = OrderItem.objects.filter(order=self.order).first()
+        with transaction.atomic():
+            item.qty = 7
+            item.save()
+            self.assertIsNotNone(cache.get(key))
+        self.assertIsNone(cache.get(key))
+        self.assertEqual([good['qty'] for good in self.get()[0].context['goods']], [7, 1])
+
+    def test_rolled_back_change_keeps_cache(self):
+        self.add_items(1)
+        self.get()
+        key = Order.invoice_cache_key(self.order.pk)
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.order.delivery_department = ''
+            self.order.save()
+            OrderItem.objects.filter(order=self.order).first().delete()
+            raise ValueError
+        self.assertIsNotNone(cache.get(key))
+        self.order.save()
+        self.assertIsNone(cache.get(key))
@@ -14,8 +14,10 @@ urlpatterns = [
     path('shop/calc_delivery/', calc_delivery, name='calc_delivery'),
     path('shop/checkout/', checkout_page, name='checkout_page'),
     path('shop/create_promocode/', create_promocode, name='create_promocode_page'),
+    path('shop/create_promocode/generate/', generate_promocodes, name='generate_promocodes'),
     path('shop/edit_price_in_category/', edit_price_in_category, name='edit_price_in_category'),
     path('shop/export/', export_products, name='export_products'),
+    path('shop/export/status/', export_status, name='export_status'),
     path('shop/invoices/', all_invoices, name='invoices_page'),
     path('shop/invoice/<int:pk>/', get_invoice, name='invoice_page'),
     path('shop/invoice/<int:pk>/edit/', edit_invoice, name='invoice_edit_page'),
@@ -30,4 +32,5 @@ urlpatterns = [
     path('shop/parser_rozetka/', parser_rozetka_view, name='parser_rozetka'),
     path('shop/update_cities_np/', update_cities_np, name = 'update_cities_np'),
     path('shop/update_warehouses_np/', update_warehouses_np, name = 'update_warehouses_np'),
+    path('shop/product_events/metrics/', product_events_metrics, name = 'product_events_metrics'),
 ]
\ No newline at end of file
@@ -1,4 +1,5 @@
 from django.shortcuts import render, HttpResponseRedirect, get_object_or_404, redirect, HttpResponse
+from django.http import StreamingHttpResponse
 from product.models import *
 from django.urls import reverse
 from django.forms.models import model_to_dict
@@ -6,17 +7,22 @@ from product import forms
 from accounts import models
 from product import services
 import json
+import csv
+from django.conf import settings
+import itertools
 import requests
 import datetime
 from dotenv import load_dotenv
-from product import convert_html
+from product import changes, convert_html, currency, payments, recommendations
 load_dotenv()
 import os
 from django.db.models import Sum
+from django.db import transaction
 import re
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger  
-from django.contrib.auth.models import Group
+from product.pagination import KeysetPaginator, InvalidCursor
 from product import tasks
+from celery.result import AsyncResult
 from accounts import tasks as acc_tasks
 
 
@@ -36,9 +42,8 @@ def category_page(request, pk):
 
 def all_product_page(request):
     all_product = Product.objects.all().order_by('-date_add')
-    paginator = Paginator(all_product, 20)
-    page = 1
-    if request.method == 'POST':
+    if request.method == 'POST' and 'cursor' not in request.POST:
+        paginator = Paginator(all_product, 20)
         responce = {}
         page=request.POST.get('page', 1)
         try:  
@@ -52,24 +57,29 @@ def all_product_page(request):
         responce['success'] = convert_html.list_products(products)
         responce['pagination'] = convert_html.pagination(products)
         return HttpResponse(json.dumps(responce), content_type='applicaion/json')
-    else:
-        products = paginator.page(page) 
+
+    # постранично по курсору (date_add, id) - без OFFSET и COUNT(*)
+    paginator = KeysetPaginator(all_product, ('-date_add', '-id'), 20)
+    try:
+        products = paginator.page(request.POST.get('cursor'))
+    except InvalidCursor:
+        products = paginator.page()
+    if request.method == 'POST':
+        responce = {}
+        responce['success'] = convert_html.list_products(products)
+        responce['pagination'] = convert_html.cursor_pagination(products)
+        return HttpResponse(json.dumps(responce), content_type='applicaion/json')
     all_product_html = convert_html.list_products(products)
-    pagination = convert_html.pagination(products)
-    return render(request, 'product/all_product_page.html', context={'pagination':pagination, 'products':all_product_html, 'page':page})
+    pagination = convert_html.cursor_pagination(products)
+    return render(request, 'product/all_product_page.html', context={'pagination':pagination, 'products':all_product_html})
 
 
 def product_page(request, pk):
     context = {}
-    viewed_products = request.session.get('viewed_products', {})
     product = get_object_or_404(Product, pk=pk)
-    viewed_products.pop(str(product.id), None)
-    if len(viewed_products) >= 6: del viewed_products[next(iter(viewed_products))]
-    viewed_products_html = convert_html.viewed_products(viewed_products)
+    viewed_products = services.ProductServices.viewed_products(request.session, product.id)
     context['product'] = product
-    viewed_products[str(product.id)] = {'id':product.id, 'title':product.title, 'price':product.price, 'desc':product.desc}
-    request.session['viewed_products'] = viewed_products
-    context['viewed_products'] = viewed_products_html
+    context['viewed_products'] = convert_html.viewed_products(viewed_products)
     if request.user.is_authenticated:
         try:
             context['is_wishlist']=product.wishlist_set.get(user = request.user)
@@ -83,31 +93,12 @@ def product_page(request, pk):
             context['is_sub_active_product'] = product.subactivateproduct_set.get(user = request.user)
         except SubActivateProduct.DoesNotExist:
             context['is_sub_active_product'] = False
-    lst_ids_cats = list(product.cid.values_list('id', flat=True))
-    rec_f1 = Product.objects.exclude(pk=product.pk).filter(is_recommend=True, cid__in=lst_ids_cats).order_by('?')[:1]
-    rec_f2 = Product.objects.exclude(pk=product.pk).filter(
-        cid__in=lst_ids_cats, 
-        price__gt=product.price*0.7, 
-        price__lt=product.price*1.3).order_by('?')[:5]
-    recommend_products = rec_f1|rec_f2
-    recommend_products = recommend_products[:5]
+    recommend_products, buy_together = recommendations.get_for_page(product)
     context['rating_product'] = product.rating
     if request.user.is_authenticated:
         select_rating = product.select_rating(user=request.user)
         context['select_rating']=convert_html.select_rating_product(product.id, select_rating)
     context['recommend_pr'] = convert_html.recommend_products(recommend_products)
-    
-    ### кусок гкода для блока "с этим товаром так же покупают". я понимаю, что это гкод и мне стыдно за него
-    ### но оно работает))))
-    all_item = OrderItem.objects.filter(product = product) 
-    lst_all_order = []
-    for i in all_item:
-        lst_all_order.append(i.order)
-    
-    all_orderitem_with_product = OrderItem.objects.filter(order__in = lst_all_order).exclude(product=product)
-    buy_together = all_orderitem_with_product.values(
-        'product', 'product__title'
-        ).annotate(all_qty = Sum('qty')).order_by('-all_qty')[:5]
     context['buy_together'] = convert_html.buy_together(buy_together)
 
     return render(request, 'product/product_page.html', context)
@@ -115,13 +106,15 @@ def product_page(request, pk):
 def select_curr(request):
     if request.method == 'POST':
         link = request.META.get('HTTP_REFERER')
-        request.session['curr_id'] = request.POST.get('all_currency')
+        code = currency.get_currency(request.POST.get('all_currency')).code
+        if request.session.get('curr_id', currency.DEFAULT_CODE) != code:
+            request.session['curr_id'] = code
         return HttpResponseRedirect(link)
 
 def basket(request):
     if request.method == 'POST':
         
-        basket = services.Basket.get_basket(request.user.id) if request.user.is_authenticated else request.session.get('basket', {})
+        basket = services.Basket.get_request_basket(request)
         type_basket = request.POST.get('type')
         product_id = request.POST.get('id')
         check_promo = request.POST.get('promocode')
@@ -140,18 +133,20 @@ def basket(request):
                 data_response = {'success': f'Добавлено в корзину {product_cnt} товаров'}
             elif type_add2basket == 'edit':
                 total_cost = round(sum([i['qty'] * i['price'] for i in basket.values()]), 2)
-                total_cost_resp = f'{total_cost *  request.session["rate_curr"]} {request.session["disp_curr"]}'
+                select_curr = currency.selected(request)
+                total_cost_resp = f'{total_cost * select_curr.rate} {select_curr.disp}'
                 data_response = {'success':True, 'total_cost':total_cost_resp}
                 
         elif type_basket == 'del':
             basket = services.Basket.del2basket(basket, product_id, request.user.id)
             html_result = ""
             count_items = 1
+            rate_curr = currency.selected(request).rate
             for product_val in basket.values():
                 id_product = product_val['id']
                 html_result += f'<tr><th scope="row">{count_items}</th>'
                 html_result += f'<td><a href=\'{reverse("product_page", kwargs={"pk":id_product})}\'">{product_val["title"]}</a></td>'
-                html_result += f'<td>{product_val["price"] * request.session["rate_curr"]}</td>'
+                html_result += f'<td>{product_val["price"] * rate_curr}</td>'
                 html_result += f'<td><input onchange = "edit_qty({id_product}, this.value)" type="number" value="{product_val["qty"]}"></td>'
                 html_result += f'<td><button type=\'submit\' onclick="del_basket({id_product})">X</button></td>'
                 html_result += '</tr>'
@@ -160,24 +155,26 @@ def basket(request):
             html_result += ''
             data_response = {'success':'Удалено', 'responce':html_result}
         elif check_promo:
-            promo = Promocode.objects.filter(code = check_promo).first()
+            promo = Promocode.get_valid(check_promo)
             if promo:
-                sum_discount = promo.get_sum_discount(basket['full_sum_basket'])
+                full_sum_basket = sum([i['qty'] * i['price'] for i in basket.values()])
+                sum_discount = promo.get_sum_discount(full_sum_basket)
                 if sum_discount:
-                    total_sum = round((basket['full_sum_basket'] + sum_discount)*request.session['rate_curr'], 2)
+                    total_sum = round((full_sum_basket + sum_discount)*currency.selected(request).rate, 2)
                     data_response = {'success':total_sum}
                 else:
                     data_response={'error':'Промо не найден.'}
             else:
                 data_response={'error':'Промо не найден.'}
             
-        request.session['basket'] = basket
+        if not request.user.is_authenticated:
+            services.Basket.save_session_basket(request.session, basket)
 
         return HttpResponse(json.dumps(data_response), content_type = 'application/json')
 
 
 def checkout_page(request):
-    basket = services.Basket.get_basket(request.user.id) if request.user.is_authenticated else request.session.get('basket', {})
+    basket = services.Basket.get_request_basket(request)
     total_cost = sum([i['qty'] * i['price'] for i in basket.values()])
     delivery = Delivery.objects.all()
     if request.method == 'POST':
@@ -185,13 +182,10 @@ def checkout_page(request):
         responce = {}
         id_delivery = data.get('delivery')
         order_delivery = Delivery.objects.get(pk=id_delivery)
-        order_currency = Currency.objects.get(code = request.session.get('curr_id', 'UAH'))
-        promocode = data.get('promo_code')
-        is_promo = False
-        if promocode:
-            is_promo = Promocode.is_promo(data.get('promo_code'))
-            if is_promo:
-                data['promo'] = Promocode.objects.get(code = data['promo_code'])
+        order_currency = currency.selected(request)
+        promo = Promocode.get_valid(data.get('promo_code'))
+        if promo:
+            data['promo'] = promo.pk
         data['user'] = request.user if request.user.is_authenticated else ''
         data['currency'] = order_currency
         data['rate_currency'] = order_currency.rate
@@ -200,21 +194,14 @@ def checkout_page(request):
         print(create_order.errors)
 
         if create_order.is_valid() and basket:
-            new_order = create_order.save()
-            if data.get('promo'):
-                if data.get('promo').type_promo == 'onceuse':
-                    data.get('promo').status = False
-                    data.get('promo').save()
+            with transaction.atomic():
+                if promo and not promo.consume():
+                    responce = {'success':False, 'msg':{'promo':['Промокод уже использован.']}}
+                    return HttpResponse(json.dumps(responce), content_type='applicaion/json')
+                new_order = create_order.save()
+                services.OrderServise.fill_order_from_basket(new_order, basket)
             if request.user:
                 acc_tasks.send_create_order.delay(request.user.id, new_order.id, new_order.get_absolute_url())
-            for good in basket.values():
-                item = {
-                    'product':Product.objects.get(pk=good['id']),
-                    'order':new_order,
-                    'qty':good['qty'],
-                }
-                OrderItem.add_item(item)
-                new_order.recalc_order()
             responce = {'success':True, 'msg':f'Заказ оформлен.<br><a href="{reverse("invoice_page", kwargs={"pk":new_order.id})}">Перейти на страницу заказа</a>'}
         else:
             responce = {'success':False, 'msg':create_order.errors}
@@ -232,7 +219,7 @@ def all_invoices(request):
     context = {}
     filter_order = {}
     date_default = {}
-    context['all_couriers'] = Group.objects.get(name='Courier').user_set.all()
+    context['all_couriers'] = Order.couriers()
     if request.method == 'POST':
         data = request.POST
         if data.get('filter'):
@@ -242,7 +229,12 @@ def all_invoices(request):
         'date_start':filter_order.pop('date_start', ''),
         'date_end':filter_order.pop('date_end', ''),
     }
-    all_invoices = Order.objects.filter(**filter_order).order_by('-pk')
+    # постранично по курсору (date_create, id), фильтр по статусу и дате - индекс order_status_date_create
+    paginator = KeysetPaginator(services.OrderServise.list_orders(filter_order), ('-date_create', '-id'), settings.ORDERS_PER_PAGE)
+    try:
+        all_invoices = paginator.page(request.POST.get('cursor'))
+    except InvalidCursor:
+        all_invoices = paginator.page()
     all_status = forms.ChangeStatusOrder()
     context['all_invoices'] = all_invoices
     context['all_status'] = all_status
@@ -261,20 +253,11 @@ def change_invoice(request):
 def get_invoice(request, pk):
     template = 'product/invoice_page.html'
     context = {}
-    order = get_object_or_404(Order, pk=pk)
-    goods = order.orderitem_set.all()
-    digital_links = {}
-    if order.status == 'paid':
-        for good in goods:
-            product_in_inv = get_object_or_404(Product, pk = good.id_good)
-            type_good = product_in_inv.type_product
-            if type_good == 'file':
-                link_product_file = product_in_inv.file_digit.url
-                digital_links[good.title_good] = link_product_file
+    order = get_object_or_404(Order.objects.select_related('user', 'courier', 'promo', 'delivery_method'), pk=pk)
     if request.user.is_authenticated and order.user:
         if request.user.id == order.user.id:
             user_balance = order.user.balance
-            if user_balance >= order.total_amount and order.status != 'paid':
+            if user_balance >= order.total_amount and order.status in payments.PAYABLE_STATUSES:
                 context['pay'] = True
 
     if order.is_paid and request.user.has_perm('product.change_status'):
@@ -290,12 +273,12 @@ def get_invoice(request, pk):
                 context['cancel_order'] = not order.cancel_order()
                 context['pay'] = True
 
+    # после оплаты/отмены статус меняется, поэтому данные берутся после обработки POST
+    invoice = services.OrderServise.invoice_data(order)
     context['order'] = order
-    context['goods'] = goods
-    context['digital'] = digital_links
-    if order.delivery_department:
-        wh_info = DeliveryWarehousesNP.objects.get(ref_warehouse = order.delivery_department)
-        context['delivery_department'] = f'{wh_info.city.city}, <br>{wh_info.description_ru}'
+    context['goods'] = invoice['goods']
+    context['digital'] = invoice['digital']
+    context['delivery_department'] = invoice['delivery_department']
     return render(request, template, context=context)
 
 
@@ -350,7 +333,36 @@ def create_promocode(request):
         create_code = forms.CreatePromo(request.POST)
         if create_code.is_valid():
             create_code.save()
-    return render(request, template, context={'form':form})
+    return render(request, template, context={'form':form, 'generate_form':forms.GeneratePromo()})
+
+
+class Echo:
+    """ файл-заглушка для csv.writer: writerow возвращает строку вместо записи """
+    def write(self, value):
+        return value
+
+
+def generate_promocodes(request):
+    """ генерация пачки одноразовых кодов, коды отдаются csv-файлом по мере вставки """
+    if not request.user.has_perm('product.add_promocode'):
+        return HttpResponse(json.dumps({'error': 'Нет доступа'}), content_type='application/json', status=403)
+    form = forms.GeneratePromo(request.POST or None)
+    if not form.is_valid():
+        return HttpResponse(json.dumps({'error':form.errors}), content_type='application/json', status=400)
+    data = form.cleaned_data
+    codes = Promocode.iter_new_promocodes(
+        data['cnt'],
+        type_code = data['type_code'],
+        type_promo = data['type_promo'],
+        value = data['amount_of_discount'],
+        start = data['start_promo'],
+        end = data['end_promo'],
+    )
+    writer = csv.writer(Echo())
+    rows = itertools.chain([writer.writerow(['code'])], (writer.writerow([code]) for code in codes))
+    response = StreamingHttpResponse(rows, content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="promocodes.csv"'
+    return response
 
 
 def edit_price_in_category(request):
@@ -361,7 +373,16 @@ def edit_price_in_category(request):
     if request.method == 'POST':
         data = request.POST
         data_for_edit = services.ProductServices.data_preparation_edit_price(data)
-        #products = services.ProductServices.get_all_products_in_categories(data_for_edit['lst_cats_id'])
+        if data.get('dry_run'):
+            diff = services.ProductServices.edit_price_products(
+                lst_cats=data_for_edit['lst_cats_id'],
+                type_edit = data_for_edit['type_edit'],
+                value_edit = data_for_edit['value_edit'],
+                dry_run = True
+            )
+            context['diff_count'] = len(diff)
+            context['diff'] = diff[:100]
+            return render(request, template, context)
         tasks.edit_price_in_category.delay(
             lst_cats=data_for_edit['lst_cats_id'],
             type_edit = data_for_edit['type_edit'], 
@@ -378,13 +399,28 @@ def export_products(request):
     if request.method == 'POST':
         data_response = {}
         type_file = request.POST.get('type', 'csv')
-        export_file = services.ProductServices.export_to_file(type_file)
-        if export_file:
-            data_response['success'] = export_file            
+        task = tasks.export_products.delay(type_file)
+        data_response['task'] = task.id
         return HttpResponse(json.dumps(data_response), content_type = 'application/json')
 
     return render(request, template, context)
 
+
+def export_status(request):
+    """ состояние задачи экспорта: прогресс или ссылка на готовый файл """
+    data_response = {}
+    result = AsyncResult(request.GET.get('task', ''))
+    if result.state == 'PROGRESS':
+        data_response['progress'] = result.info
+    elif result.state == 'SUCCESS':
+        if result.result:
+            data_response['success'] = result.result
+        else:
+            data_response['error'] = True
+    elif result.state == 'FAILURE':
+        data_response['error'] = True
+    return HttpResponse(json.dumps(data_response), content_type = 'application/json')
+
 def import_products(request):
     template = 'product/import.html'
     context = {}
@@ -532,14 +568,13 @@ def rating_product(request):
                     pr_delete = product.rating_product.get(user=request.user)
                     pr_delete.delete()
                     data_response['success'] = 'Оценка снята.'
-                    pr_delete.recalc_rating()
                 except RatingProduct.DoesNotExist:
                     data_response['error'] = 'Вы еще не голосовали.'
             else:
                 product.rating_product.update_or_create(user=request.user, 
                     defaults={'value_rating':data.get('mark')})
                 data_response['success'] = 'Спасибо за оценку.'
-            data_response['new_avg'] = Product.objects.get(pk=data.get('id')).rating
+            data_response['new_avg'] = Product.objects.values_list('rating', flat=True).get(pk=data.get('id'))
         except Product.DoesNotExist:
             data_response['error'] = 'Некорректные параметры'
     return HttpResponse(json.dumps(data_response), content_type='application/json')
@@ -547,7 +582,7 @@ def rating_product(request):
 
 def calc_delivery(request):
     data_response = {}
-    basket = services.Basket.get_basket(request.user.id) if request.user.is_authenticated else request.session.get('basket', {})
+    basket = services.Basket.get_request_basket(request)
     
     if request.method == 'POST':
         data = request.POST
@@ -572,72 +607,22 @@ def calc_delivery(request):
 
         #стоимость переводим в курс
         if data_response.get('cost'):
-            cost_in_curr = round(data_response.get("cost") * request.session["rate_curr"], 2)
-            data_response['cost'] = f'{cost_in_curr} {request.session["disp_curr"]}'
+            select_curr = currency.selected(request)
+            cost_in_curr = round(data_response.get("cost") * select_curr.rate, 2)
+            data_response['cost'] = f'{cost_in_curr} {select_curr.disp}'
 
     return HttpResponse(json.dumps(data_response), content_type='application/json')
 
 
 
 def update_cities_np(request):
-    link = 'https://api.novaposhta.ua/v2.0/json/'
-    headers = {'Content-Type':'application/json',}
-    data = (
-        '{"modelName": "Address",'
-        '"calledMethod": "getCities",'
-        f'"apiKey": "{os.environ.get("TOKEN_NP")}"}}'
-    )
-    req = requests.post(link, data=data, headers=headers)
-    responce = req.json()
-    if responce.get('success'):
-        for item in responce['data']:
-            city_ua = item['Description']
-            data_city = {
-                'city':item['DescriptionRu'],
-                'city_ref':item['Ref'],
-                'cityID':item['CityID'],
-                'region_ua':item['AreaDescription'],
-                'region':item['AreaDescriptionRu'],
-            }
-            DeliveryCitiesNP.objects.update_or_create(city_ua=city_ua, defaults=data_city)
-    return HttpResponse(json.dumps(responce), content_type='application/json')
-
+    task = tasks.sync_novaposhta_cities.delay()
+    return HttpResponse(json.dumps({'success':task.id}), content_type='application/json')
 
 
 def update_warehouses_np(request):
-    link = 'https://api.novaposhta.ua/v2.0/json/'
-    data = (
-        '{"modelName": "AddressGeneral",'
-        '"calledMethod": "getWarehouses",'
-        '"methodProperties": {"Language": "ru"},'
-        f'"apiKey": "{os.environ.get("TOKEN_NP")}"}}'
-    )
-    headers = {'Content-Type':'application/json',}
-    req = requests.post(link, data=data, headers=headers)
-    responce = req.json()
-    if responce.get('success'):
-        for item in responce['data']:
-            try:
-                city = DeliveryCitiesNP.objects.get(city_ref=item.get('CityRef'))
-            except:
-                print(item)
-                continue
-            item_ref =item.get('Ref')
-            data_warehouse = {
-                'city':city,
-                'sitekey':item.get('SiteKey'),
-                'description':item.get('Description'),
-                'description_ru':item.get('DescriptionRu'),
-                'short_address':item.get('ShortAddress'),
-                'short_address_ru':item.get('ShortAddressRu'),
-                'number_warehouse':item.get('Number'),
-            }
-            DeliveryWarehousesNP.objects.update_or_create(
-                ref_warehouse=item_ref,
-                defaults = data_warehouse
-            )
-            
-    return HttpResponse(json.dumps(responce), content_type='application/json')
+    task = tasks.sync_novaposhta_warehouses.delay()
+    return HttpResponse(json.dumps({'success':task.id}), content_type='application/json')
 
 
 def parser_rozetka_view(request):
@@ -670,8 +655,9 @@ def select_courier(request):
                 order.courier = None
                 order.save()
             else:
-                courier = Group.objects.get(name='Courier').user_set.get(pk=data['courier'])
-                order.courier = courier
+                if not any(str(courier['pk']) == data['courier'] for courier in Order.couriers()):
+                    raise models.CustomUser.DoesNotExist
+                order.courier_id = int(data['courier'])
                 order.save()
             responce = {'success':'Сохранено'}
         except models.CustomUser.DoesNotExist:
@@ -688,3 +674,9 @@ def courier_page(request):
     context['all_status'] = forms.ChangeStatusOrder()
 
     return render(request, 'product/courier_page.html', context)
+
+
+def product_events_metrics(request):
+    if not request.user.has_perm('product.view_productevent'):
+        return HttpResponse(json.dumps({'error': 'Нет доступа'}), content_type='application/json', status=403)
+    return HttpResponse(json.dumps(changes.metrics()), content_type='application/json')
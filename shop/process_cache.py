@@ -0,0 +1,60 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def shared_cache():
+    """ виден ли кэш Django всем процессам (Redis и т.п., а не память процесса) """
+    return settings.CACHES['default']['BACKEND'] not in LOCAL_CACHE_BACKENDS
+
+
+class VersionedCache:
+    """ Кэш данных в памяти процесса.
+        Актуальность проверяется по номеру версии в общем кэше Django:
+        invalidate() увеличивает версию, и каждый процесс перечитает данные
+        при следующем обращении.
+        Если кэш Django не общий (LocMemCache без REDIS_URL), версию видит
+        только процесс, который ее увеличил, поэтому данные в остальных
+        процессах дополнительно живут не дольше PROCESS_CACHE_TTL секунд.
+    """
+
+    def __init__(self, name, loader):
+        self.version_key = f'{name}:version'
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.version = None
+        self.expires = None
+        self.data = {}
+
+    def get(self, key):
+        version = cache.get(self.version_key, 0)
+        now = time.monotonic()
+        with self.lock:
+            if version != self.version or (self.expires is not None and now >= self.expires):
+                self.data = {}
+                self.version = version
+                self.expires = None if shared_cache() else now + settings.PROCESS_CACHE_TTL
+            if key in self.data:
+                return self.data[key]
+        value = self.loader(key)
+        with self.lock:
+            if version == self.version:
+                self.data[key] = value
+        return value
+
+    def invalidate(self):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 1, None)
+        with self.lock:
+            self.data = {}
+            self.version = None
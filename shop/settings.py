@@ -3,6 +3,7 @@ from pathlib import Path
 from dotenv import load_dotenv
 import os
 import dj_database_url
+from celery.schedules import crontab
 
 
 load_dotenv()
@@ -128,7 +129,10 @@ USE_TZ = False
 
 #STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 #STATIC_URL = '/static/'
-SESSION_SAVE_EVERY_REQUEST = True
+# сессия сохраняется только при изменении; движок можно сменить на
+# django.contrib.sessions.backends.cache / cached_db (через Redis из CACHES)
+SESSION_SAVE_EVERY_REQUEST = False
+SESSION_ENGINE = os.environ.get('SESSION_ENGINE', 'django.contrib.sessions.backends.db')
 """STATICFILES_DIRS = [os.path.join(BASE_DIR, 'shop/static')]
 #DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
 
@@ -175,8 +179,77 @@ REST_FRAMEWORK = {
 TOKEN_EXPIRED_AFTER_SECONDS = 60*60*24*365*3
 
 
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+        }
+    }
+# время жизни данных shop.process_cache.VersionedCache в памяти процесса,
+# если кэш не общий (без REDIS_URL)
+PROCESS_CACHE_TTL = 60
+
+
 CELERY_BROKER_URL = os.environ.get('REDIS_URL')
 CELERY_RESULT_BACKEND = os.environ.get('REDIS_URL')
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_RESULT_SERIALIZER = 'json'
-CELERY_TASK_SERIALIZER = 'json'
\ No newline at end of file
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_BEAT_SCHEDULE = {
+    'build-recommendations': {
+        'task': 'product.tasks.build_recommendations',
+        'schedule': crontab(hour=3, minute=0),
+    },
+    'reconcile-ratings': {
+        'task': 'product.tasks.reconcile_ratings',
+        'schedule': crontab(hour=4, minute=0),
+    },
+    'relay-product-events': {
+        'task': 'product.tasks.relay_product_events',
+        'schedule': float(os.environ.get('OUTBOX_RELAY_INTERVAL', 10)),
+    },
+}
+
+
+NP_API_URL = os.environ.get('NP_API_URL', 'https://api.novaposhta.ua/v2.0/json/')
+NP_API_TIMEOUT = 5
+NP_QUOTE_TTL = 60*60
+NP_QUOTE_CACHE_SIZE = 5000
+NP_QUOTE_COST_BUCKET = 100
+NP_SYNC_PAGE_SIZE = 500
+NP_SYNC_BATCH_SIZE = 1000
+NP_SYNC_MIN_KEEP_RATIO = 0.5
+
+EXPORT_CHUNK_SIZE = 2000
+IMPORT_PAGE_SIZE = 2000
+IMPORT_BATCH_SIZE = 500
+REPRICE_BATCH_SIZE = 2000
+
+ROZETKA_API_URL = os.environ.get('ROZETKA_API_URL', 'https://xl-catalog-api.rozetka.com.ua')
+ROZETKA_TIMEOUT = 10
+ROZETKA_CONCURRENCY = int(os.environ.get('ROZETKA_CONCURRENCY', 4))
+ROZETKA_RATE = float(os.environ.get('ROZETKA_RATE', 5))
+
+TG_API_URL = os.environ.get('TG_API_URL', 'https://api.telegram.org')
+TG_TIMEOUT = 10
+TG_RATE = 30
+TG_CONCURRENCY = 8
+TG_MAX_RETRIES = 3
+
+PROMO_BATCH_SIZE = 5000
+PROMO_MAX_GENERATE = 500000
+PROMO_CACHE_TTL = 60
+
+PRODUCT_CARD_TTL = 60*10
+
+RECOMMEND_SIMILAR_LIMIT = 20
+RECOMMEND_TOGETHER_LIMIT = 10
+RECOMMEND_BATCH_SIZE = 2000
+
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_DEDUPE_WINDOW = int(os.environ.get('OUTBOX_DEDUPE_WINDOW', 30))
+
+ORDERS_PER_PAGE = 50
+COURIERS_CACHE_TTL = 60*60
+INVOICE_CACHE_TTL = 60*60*24
\ No newline at end of file
@@ -0,0 +1,79 @@
+import threading
+import time
+
+from django.core.cache import cache
+
+
+class TokenBucket:
+    """ Ограничение частоты запросов к внешним API.
+        В ведро помещается capacity жетонов, они пополняются со скоростью
+        rate в секунду. acquire() забирает жетон, при пустом ведре - ждет.
+        Безопасен для использования из нескольких потоков.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def delay(self, seconds):
+        """ не выдавать жетоны ближайшие seconds секунд (например, по ответу 429) """
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class SharedRateLimiter:
+    """ Ограничение частоты, общее для всех процессов (счетчики в кэше Django).
+        Время делится на окна по max(0.1, 1/rate) секунд, в каждом окне
+        выдается не больше rate * окно разрешений; acquire() при исчерпанном
+        окне ждет следующего. delay() ставит паузу, которую видят все процессы.
+        Без общего кэша (LocMemCache) ограничение действует в пределах процесса.
+    """
+
+    def __init__(self, name, rate):
+        self.name = name
+        self.window = max(0.1, 1 / float(rate))
+        self.quota = max(1, round(float(rate) * self.window))
+        self.pause_key = f'throttle:{name}:pause'
+
+    def acquire(self):
+        while True:
+            now = time.time()
+            pause = cache.get(self.pause_key)
+            if pause and pause > now:
+                time.sleep(pause - now)
+                continue
+            slot = int(now / self.window)
+            key = f'throttle:{self.name}:{slot}'
+            cache.add(key, 0, 2 + int(self.window))
+            try:
+                used = cache.incr(key)
+            except ValueError:
+                # окно истекло между add и incr
+                continue
+            if used <= self.quota:
+                return
+            time.sleep(max((slot + 1) * self.window - time.time(), 0))
+
+    def delay(self, seconds):
+        """ не выдавать разрешения ближайшие seconds секунд (например, по ответу 429) """
+        until = time.time() + seconds
+        cache.set(self.pause_key, until, int(seconds) + 1)